@@ -0,0 +1,339 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+"""
+End-to-end transition latency of the handler backends under the same load.
+
+Every backend runs in a fresh scratch directory whose state scripts are
+replaced by instrumented ones: the first thing such a script does is to
+append its start time to a shared file, then it idles until terminated.
+A GameController stand-in on loopback plays the same scripted match to each
+GameController driven backend, and the latency of a transition is the time
+from sending the first packet of the new state to the first action of the
+script started for it.  Transitions without a script starting before the
+next one are counted as missed.
+
+The orchestrators ``state.py``, ``async.py`` and ``multi.py`` do not listen
+to a GameController, they step an internal counter every two seconds and
+start a script at 5 and 10.  They can be selected too, their transitions
+are taken from the counter lines they print (time of arrival) and last
+about 25 seconds per run whatever the match is::
+
+    python backend_bench.py
+    python backend_bench.py --rounds 20 --hold 0.5 handler handler_old
+    python backend_bench.py --script match.txt state async multi
+
+The match is either ``--rounds`` of INITIAL, READY, SET, PLAYING, FINISHED
+held ``--hold`` seconds each or a script in the format of :mod:`simulation`.
+Besides the latency percentiles the table has the CPU time of the backend
+and the scripts it reaped (``wait4``) and the backend's peak RSS
+(``VmHWM``, read just before it is stopped).
+"""
+
+import os
+import re
+import sys
+import time
+import shutil
+import signal
+import socket
+import struct
+import argparse
+import tempfile
+import threading
+import subprocess
+
+from latency import StageLatencyTracker
+from startup_bench import port_bound, GAME_CONTROLLER_PORT
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# Where the instrumented scripts append "<time> <script> <pid>"
+ACTIONS_ENV = "BENCH_ACTIONS_FILE"
+INSTRUMENTED_SCRIPT = f'''# Instrumented state script of backend_bench.py
+import os
+import sys
+import time
+
+started = time.time()
+with open(os.environ["{ACTIONS_ENV}"], "a") as actions:
+    actions.write(f"{{started:.6f}} {{os.path.basename(sys.argv[0])}} {{os.getpid()}}\\n")
+while True:
+    time.sleep(0.05)
+'''
+
+PROTOCOL_V12 = "v12"
+PROTOCOL_2014 = "2014"
+# Orchestrators trigger themselves, see the module documentation
+INTERNAL = "internal"
+
+# name: (command line after the interpreter, packets it understands)
+BACKENDS = {
+    "handler": (["handler.py"], PROTOCOL_V12),
+    "handler-asyncio": (["handler.py", "--asyncio"], PROTOCOL_V12),
+    "handler_old": (["handler_old.py"], PROTOCOL_V12),
+    "handler_2014": (["handler_2014.py"], PROTOCOL_2014),
+    "state": (["state.py"], INTERNAL),
+    "async": (["async.py"], INTERNAL),
+    "multi": (["multi.py"], INTERNAL),
+}
+DEFAULT_BACKENDS = ("handler", "handler-asyncio", "handler_old", "handler_2014")
+
+# The orchestrators announce a new counter value, they start scripts at 5 and 10
+ORCHESTRATOR_TRIGGER = re.compile(rb"Current (?:diubah ke|updated:) (5|10)\s*$")
+# multi.py runs its "scripts" as functions in forked processes, their first line is the action
+ORCHESTRATOR_ACTION = re.compile(rb"\.py - Counter: 1\s*$")
+# Seconds the orchestrators need to get past their second script
+ORCHESTRATOR_RUN = 24.0
+
+MATCH = ("INITIAL", "READY", "SET", "PLAYING", "FINISHED")
+
+
+def script_names(backend):
+    """The scripts *backend* may start, relative to its directory"""
+    if backend.startswith("handler_2014"):
+        import handler_2014
+        return set(handler_2014.SCRIPTS.values())
+    if backend.startswith("handler_old"):
+        import handler_old
+        return set(handler_old.SCRIPTS.values())
+    if backend.startswith("handler"):
+        import handler
+        from composition import Composition
+        return {member.script for entry in handler.STATE_FILES.values() for member in Composition.of(entry)}
+    return {"lima.py", "sepuluh.py"}
+
+
+def prepare_directory(backend):
+    """A scratch directory holding instrumented versions of the backend's scripts"""
+    directory = tempfile.mkdtemp(prefix=f"backend_bench_{backend}_")
+    for name in script_names(backend):
+        path = os.path.join(directory, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as f:
+            f.write(INSTRUMENTED_SCRIPT)
+    return directory
+
+
+class PacketEncoder(object):
+    """ GameController packets of one protocol version, built once per state and patched """
+
+    def __init__(self, protocol):
+        self.protocol = protocol
+        self.templates = {}
+        if protocol == PROTOCOL_2014:
+            import gamestate_2014
+            self.struct = gamestate_2014.GameState
+            # packet_number, seconds_remaining
+            self.offsets = (5, 14)
+        else:
+            import gamestate
+            self.struct = gamestate.GameState
+            self.offsets = (6, 20)
+
+    def _template(self, state):
+        if self.protocol == PROTOCOL_2014:
+            robot = dict(penalty=0, secs_till_unpenalized=0)
+            team = lambda number: dict(team_number=number, team_color="BLUE" if number == 1 else "RED", score=0,
+                                       penalty_shot=0, single_shots=0, coach_message=b"\0" * 40,
+                                       players=[robot] * 11)
+            return self.struct.build(dict(
+                packet_number=0, players_per_team=4, game_state=f"STATE_{state}", first_half=1, kick_of_team=1,
+                secondary_state="STATE2_NORMAL", drop_in_team=0, drop_in_time=0, seconds_remaining=0,
+                secondary_seconds_remaining=0, teams=[team(1), team(2)]))
+        from simulation import PacketFactory
+        return PacketFactory().packet(0, f"STATE_{state}", 0)
+
+    def packet(self, packet_number, state, seconds):
+        template = self.templates.get(state)
+        if template is None:
+            template = self.templates[state] = self._template(state)
+        packet = bytearray(template)
+        packet[self.offsets[0]] = packet_number & 0xFF
+        struct.pack_into("<h", packet, self.offsets[1], seconds)
+        return bytes(packet)
+
+
+def match_steps(args):
+    """(state, seconds) of the match, SILENCE steps send nothing"""
+    if args.script:
+        from simulation import load_script
+        return [(step.state, step.seconds) for step in load_script(args.script)]
+    return [(state, args.hold) for _ in range(args.rounds) for state in MATCH]
+
+
+class Run(object):
+    """ One backend playing the match """
+
+    def __init__(self, backend, steps, period, warmup):
+        self.backend = backend
+        self.arguments, self.protocol = BACKENDS[backend]
+        self.steps = steps
+        self.period = period
+        self.warmup = warmup
+        self.directory = prepare_directory(backend)
+        self.actions_file = os.path.join(self.directory, "actions.log")
+        # Times of the transitions and of the scripts' first actions
+        self.triggers = []
+        self.actions = []
+        self.cpu = None
+        self.peak_rss_kb = None
+        self.output = []
+
+    def start(self):
+        env = dict(os.environ, PYTHONUNBUFFERED="1", **{ACTIONS_ENV: self.actions_file})
+        env["PYTHONPATH"] = os.pathsep.join(filter(None, [HERE, os.environ.get("PYTHONPATH")]))
+        command = [sys.executable, os.path.join(HERE, self.arguments[0])] + self.arguments[1:]
+        self.process = subprocess.Popen(command, cwd=self.directory, env=env, stdout=subprocess.PIPE,
+                                        stderr=subprocess.STDOUT, start_new_session=True)
+        self.reader = threading.Thread(target=self._read_output, daemon=True)
+        self.reader.start()
+
+    def _read_output(self):
+        for line in self.process.stdout:
+            arrival = time.time()
+            self.output.append(line)
+            if self.protocol != INTERNAL:
+                continue
+            if ORCHESTRATOR_TRIGGER.search(line):
+                self.triggers.append(arrival)
+            elif ORCHESTRATOR_ACTION.search(line):
+                self.actions.append(arrival)
+
+    def play(self, timeout):
+        """Sends the match, or waits for an orchestrator to go through its schedule"""
+        if self.protocol == INTERNAL:
+            time.sleep(ORCHESTRATOR_RUN)
+            return True
+        deadline = time.time() + timeout
+        while not port_bound(GAME_CONTROLLER_PORT):
+            if time.time() > deadline or self.process.poll() is not None:
+                return False
+            time.sleep(0.01)
+
+        encoder = PacketEncoder(self.protocol)
+        sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        packet_number = 0
+        previous = None
+        steps = [(self.steps[0][0], self.warmup)] + self.steps if self.warmup else self.steps
+        measure_from = time.time() + self.warmup
+        try:
+            for state, seconds in steps:
+                end = time.time() + seconds
+                while time.time() < end:
+                    if state != "SILENCE":
+                        sent = time.time()
+                        sender.sendto(encoder.packet(packet_number, state, 600), ("127.0.0.1", GAME_CONTROLLER_PORT))
+                        packet_number += 1
+                        if state != previous and sent >= measure_from:
+                            self.triggers.append(sent)
+                        previous = state
+                    time.sleep(max(0.0, min(self.period, end - time.time())))
+        finally:
+            sender.close()
+        return True
+
+    def stop(self):
+        self.peak_rss_kb = peak_rss_kb(self.process.pid)
+        try:
+            os.kill(self.process.pid, signal.SIGINT)
+        except ProcessLookupError:
+            pass
+        deadline = time.time() + 5.0
+        rusage = None
+        while rusage is None:
+            pid, _, usage = os.wait4(self.process.pid, os.WNOHANG)
+            if pid:
+                rusage = usage
+            elif time.time() > deadline:
+                os.killpg(self.process.pid, signal.SIGKILL)
+                deadline = float("inf")
+            else:
+                time.sleep(0.02)
+        self.cpu = rusage.ru_utime + rusage.ru_stime
+        try:
+            # Scripts the backend left behind
+            os.killpg(self.process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        self.reader.join(2)
+        if os.path.exists(self.actions_file):
+            with open(self.actions_file) as f:
+                self.actions.extend(float(line.split()[0]) for line in f if line.strip())
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def latencies(self):
+        """Milliseconds from each transition to the first action before the next one, None if there was none"""
+        actions = sorted(self.actions)
+        triggers = sorted(self.triggers)
+        result = []
+        for index, trigger in enumerate(triggers):
+            until = triggers[index + 1] if index + 1 < len(triggers) else float("inf")
+            first = next((action for action in actions if trigger <= action < until), None)
+            result.append(None if first is None else (first - trigger) * 1000)
+        return result
+
+
+def peak_rss_kb(pid):
+    """VmHWM of a running process in kB, None if it is gone"""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Compare the transition latency of the handler backends")
+    parser.add_argument('backends', nargs='*', metavar='backend',
+                        help=f"any of {', '.join(BACKENDS)} (default: {' '.join(DEFAULT_BACKENDS)})")
+    parser.add_argument('--rounds', type=int, default=5, help="rounds of INITIAL..FINISHED (default: 5)")
+    parser.add_argument('--hold', type=float, default=1.0, help="seconds each state is held (default: 1.0)")
+    parser.add_argument('--script', help="play this script of game states (simulation.py format) instead")
+    parser.add_argument('--period', type=float, default=0.5, help="seconds between packets (default: 0.5)")
+    parser.add_argument('--warmup', type=float, default=2.0,
+                        help="seconds of the first state before measuring, keeps the cold start out (default: 2.0)")
+    parser.add_argument('--timeout', type=float, default=10.0, help="seconds to wait for a backend's socket")
+    parser.add_argument('--verbose', action='store_true', help="show the output of backends that failed")
+    args = parser.parse_args()
+    unknown = [backend for backend in args.backends if backend not in BACKENDS]
+    if unknown:
+        parser.error(f"unknown backends: {', '.join(unknown)}")
+
+    if port_bound(GAME_CONTROLLER_PORT):
+        sys.exit(f"UDP port {GAME_CONTROLLER_PORT} is already in use")
+
+    steps = match_steps(args)
+    latencies = StageLatencyTracker(stages=())
+    rows = []
+    for backend in args.backends or DEFAULT_BACKENDS:
+        print(f"running {backend} ...", file=sys.stderr)
+        run = Run(backend, steps, args.period, args.warmup)
+        run.start()
+        try:
+            played = run.play(args.timeout)
+        finally:
+            run.stop()
+        measured = run.latencies()
+        for latency in measured:
+            if latency is not None:
+                latencies.record(backend, latency)
+        rows.append((backend, played, measured, run.cpu, run.peak_rss_kb))
+        if not played and args.verbose:
+            sys.stderr.write(b"".join(run.output[-20:]).decode("utf-8", "replace"))
+        # The next backend binds the same port
+        while port_bound(GAME_CONTROLLER_PORT):
+            time.sleep(0.05)
+
+    stats = latencies.get_statistics()
+    print(f"{'backend':<16} {'n':>4} {'missed':>6} {'p50 ms':>8} {'p90 ms':>8} {'p99 ms':>8} {'max ms':>8} "
+          f"{'cpu s':>7} {'peak rss MB':>11}")
+    for backend, played, measured, cpu, rss in rows:
+        values = stats.get(backend)
+        timing = " ".join(f"{values[key]:8.2f}" if values else f"{'-':>8}" for key in ("p50", "p90", "p99", "max"))
+        note = "" if played else "  (did not bind its socket)"
+        print(f"{backend:<16} {len(measured):4d} {sum(l is None for l in measured):6d} {timing} "
+              f"{cpu:7.2f} {rss / 1024 if rss else 0:11.1f}{note}")
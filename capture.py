@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+"""
+Capture files of raw GameController packets.
+
+A capture is a small file header followed by fixed-size records, so a whole
+file can be indexed (or mapped onto a NumPy record array) without parsing it
+record by record::
+
+    header  6s magic b"GCcap\\0", H format version, H packet size
+    record  d receive time (time.time()), H length on the wire,
+            packet size bytes of packet data, zero padded
+"""
+
+import struct
+
+MAGIC = b"GCcap\0"
+FORMAT_VERSION = 1
+FILE_HEADER = struct.Struct("<6sHH")
+RECORD_HEADER = struct.Struct("<dH")
+
+
+class CaptureWriter(object):
+    """ Appends packets to a capture file """
+
+    def __init__(self, path, packet_size, buffering=64 * 1024):
+        self.path = path
+        self.packet_size = packet_size
+        self.record_size = RECORD_HEADER.size + packet_size
+        self.file = open(path, "wb", buffering=buffering)
+        self.file.write(FILE_HEADER.pack(MAGIC, FORMAT_VERSION, packet_size))
+        self.count = 0
+
+    def write(self, data, receive_time):
+        data = data[:self.packet_size]
+        self.file.write(RECORD_HEADER.pack(receive_time, len(data)))
+        self.file.write(data)
+        if len(data) < self.packet_size:
+            self.file.write(b"\0" * (self.packet_size - len(data)))
+        self.count += 1
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+def read_header(f):
+    """Reads the file header, returns the packet size"""
+    magic, version, packet_size = FILE_HEADER.unpack(f.read(FILE_HEADER.size))
+    if magic != MAGIC:
+        raise ValueError(f"{getattr(f, 'name', 'file')} is not a packet capture")
+    if version != FORMAT_VERSION:
+        raise ValueError(f"Unsupported capture format version {version}")
+    return packet_size
+
+
+def read_capture(path):
+    """Yields (receive_time, packet bytes) for every record of a capture file"""
+    with open(path, "rb") as f:
+        packet_size = read_header(f)
+        record_size = RECORD_HEADER.size + packet_size
+        while True:
+            record = f.read(record_size)
+            if len(record) < record_size:
+                return
+            receive_time, length = RECORD_HEADER.unpack_from(record)
+            yield receive_time, record[RECORD_HEADER.size:RECORD_HEADER.size + length]
@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+"""
+Several processes making up the behavior of one game state.
+
+A ``STATE_FILES`` entry is either a script or a :class:`Composition` of
+:class:`Member` scripts with the members each one has to wait for::
+
+    3: Composition(
+        Member("team_comm.py", ready=READY_STARTED),
+        Member("vision.py"),
+        Member("localization.py", after=["vision.py"]),
+        Member("playing_state.py", after=["localization.py"]),
+    )
+
+The supervisor launches members without pending prerequisites at once, in
+parallel, and each dependent as soon as its prerequisites are ready: they
+called ``state_report.report_ready()`` (:data:`READY_REPORTED`), or simply
+run (:data:`READY_STARTED`).  A prerequisite that does not get ready within
+its ``ready_timeout`` holds nobody back any longer, it is logged and its
+dependents start anyway.
+
+Members of the old and the new state's composition with the same script
+keep running across the transition, only the others are stopped and
+started.  The primary member (the last one unless given) is the one the
+transition latency is measured on, a plain script is a composition of one.
+
+This module only describes compositions, :mod:`supervisor` runs them.
+"""
+
+# Dependents wait for the member's state_report.report_ready()
+READY_REPORTED = "reported"
+# Dependents start once the member's process runs
+READY_STARTED = "started"
+
+# Seconds dependents wait for a member to get ready
+READY_TIMEOUT = 2.0
+
+
+class Member(object):
+    """ One script of a composition and what it waits for """
+
+    def __init__(self, script, after=(), ready=READY_REPORTED, ready_timeout=READY_TIMEOUT):
+        if ready not in (READY_REPORTED, READY_STARTED):
+            raise ValueError(f"Unknown readiness {ready!r} of {script}")
+        self.script = script
+        self.after = tuple(after)
+        self.ready = ready
+        self.ready_timeout = ready_timeout
+
+    def __repr__(self):
+        return f"Member({self.script!r}, after={list(self.after)!r}, ready={self.ready!r})"
+
+
+class Composition(object):
+    """ Scripts run together for one state, see the module documentation """
+
+    def __init__(self, *members, primary=None):
+        if not members:
+            raise ValueError("A composition needs at least one member")
+        self.members = {}
+        for member in members:
+            if member.script in self.members:
+                raise ValueError(f"{member.script} is in the composition twice")
+            self.members[member.script] = member
+        for member in members:
+            for prerequisite in member.after:
+                if prerequisite not in self.members:
+                    raise ValueError(f"{member.script} waits for {prerequisite}, which is not a member")
+        self.order = self._launch_order()
+        self.primary = primary if primary is not None else members[-1].script
+        if self.primary not in self.members:
+            raise ValueError(f"Primary {self.primary} is not a member")
+
+    def _launch_order(self):
+        """Scripts with every prerequisite in front of its dependents, rejects cycles"""
+        order = []
+        done = set()
+        visiting = set()
+
+        def visit(script, path):
+            if script in done:
+                return
+            if script in visiting:
+                raise ValueError("Members wait for each other: " + " -> ".join(path + [script]))
+            visiting.add(script)
+            for prerequisite in self.members[script].after:
+                visit(prerequisite, path + [script])
+            visiting.discard(script)
+            done.add(script)
+            order.append(script)
+
+        for script in self.members:
+            visit(script, [])
+        return order
+
+    @classmethod
+    def of(cls, entry):
+        """*entry* as a composition, a plain script becomes its only member"""
+        if isinstance(entry, cls):
+            return entry
+        return cls(Member(entry, ready=READY_STARTED))
+
+    def __iter__(self):
+        return (self.members[script] for script in self.order)
+
+    def __len__(self):
+        return len(self.members)
+
+    def __contains__(self, script):
+        return script in self.members
+
+    def __str__(self):
+        return "+".join(self.order)
+
+    def __repr__(self):
+        return f"Composition({', '.join(repr(member) for member in self)}, primary={self.primary!r})"
@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+"""
+Send cadence, clock skew and queuing delay of a GameController stream.
+
+The GC sends on a fixed period of its own clock, so packet ``n`` (the
+unwrapped packet number) leaves at ``s0 + n * period``.  Its arrival in our
+clock is that plus the path delay, which is a fixed minimum plus queuing::
+
+    arrival(n) = offset + n * period + queuing(n)
+
+A line fitted through (n, arrival) with exponentially weighted moments
+gives the period as our clock measures it; its ratio to the nominal period
+is the rate difference (skew) of the two clocks.  Packets that were not
+queued anywhere lie on the lower envelope of the residuals, so a floor that
+follows the smallest residual (and creeps up slowly, to let go of outliers
+and of a changing route) stands for the minimum path delay, and each packet's
+distance above it is its queuing delay.  Without timestamps from the GC the
+absolute one-way delay and clock offset stay unknown: :meth:`expected_arrival`
+is the GC schedule in our clock including the minimum delay, and queuing
+delay is what the network added on top of the best case.
+
+Everything is updated per packet in constant memory.
+"""
+
+# Nominal send period of the GameController (2 Hz)
+NOMINAL_PERIOD = 0.5
+# Weight of a new packet in the line fit
+FIT_GAIN = 1.0 / 64
+# Weight of a new packet in the jitter estimate (RFC 3550)
+JITTER_GAIN = 1.0 / 16
+# How fast the minimum delay floor may rise, seconds per second
+FLOOR_RISE = 0.0001
+# A larger difference to the nominal period is not clock skew but another send rate
+MAX_SKEW = 0.05
+# Packets needed before estimates are reported
+WARMUP = 8
+
+
+class DelayEstimator(object):
+    """ Streaming estimate for one packet source, fed with unwrapped packet numbers """
+
+    def __init__(self, nominal_period=NOMINAL_PERIOD):
+        self.nominal_period = nominal_period
+        self.reset()
+
+    def reset(self):
+        """Forgets everything, e.g. after the GC restarted"""
+        self.count = 0
+        # Origin of the fit, keeps the numbers small
+        self.index0 = None
+        self.arrival0 = None
+        self.mean_index = 0.0
+        self.mean_arrival = 0.0
+        self.var_index = 0.0
+        self.cov = 0.0
+        self.floor = None
+        self.floor_time = None
+        self.latest = None
+        self.jitter = 0.0
+
+    def observe(self, index, arrival):
+        """Feeds packet *index* received at *arrival*, returns its queuing delay (None while warming up)"""
+        if self.index0 is None:
+            self.index0, self.arrival0 = index, arrival
+        x = float(index - self.index0)
+        y = arrival - self.arrival0
+        self.count += 1
+        if self.count == 1:
+            self.mean_index, self.mean_arrival = x, y
+            return None
+
+        gain = max(FIT_GAIN, 1.0 / self.count)
+        dx = x - self.mean_index
+        dy = y - self.mean_arrival
+        self.mean_index += gain * dx
+        self.mean_arrival += gain * dy
+        self.var_index = (1 - gain) * (self.var_index + gain * dx * dx)
+        self.cov = (1 - gain) * (self.cov + gain * dx * dy)
+        if self.var_index <= 0.0:
+            return None
+
+        residual = self._residual(x, y)
+        if self.floor is None or residual < self.floor:
+            self.floor = residual
+        else:
+            self.floor += min(FLOOR_RISE * (arrival - self.floor_time), residual - self.floor)
+        self.floor_time = arrival
+        if self.count < WARMUP:
+            return None
+
+        queuing = residual - self.floor
+        if self.latest is not None:
+            self.jitter += (abs(queuing - self.latest) - self.jitter) * JITTER_GAIN
+        self.latest = queuing
+        return queuing
+
+    def _residual(self, x, y):
+        return y - (self.mean_arrival + self.period() * (x - self.mean_index))
+
+    def period(self):
+        """Send period of the GC measured with our clock"""
+        if self.var_index <= 0.0:
+            return self.nominal_period
+        return self.cov / self.var_index
+
+    def queuing_delay(self, index, arrival):
+        """Queuing delay of a packet with the current fit, without feeding it"""
+        if self.count < WARMUP or self.floor is None:
+            return None
+        return max(self._residual(float(index - self.index0), arrival - self.arrival0) - self.floor, 0.0)
+
+    def skew_ppm(self):
+        """How much faster our clock runs than the GC's in parts per million, None if
+        the GC does not send on the nominal period at all"""
+        ratio = self.period() / self.nominal_period - 1.0
+        if abs(ratio) > MAX_SKEW:
+            return None
+        return ratio * 1e6
+
+    def expected_arrival(self, index):
+        """When packet *index* arrives (or arrived) without queuing: GC schedule plus minimum delay"""
+        if self.floor is None:
+            return None
+        x = float(index - self.index0)
+        return self.arrival0 + self.mean_arrival + self.period() * (x - self.mean_index) + self.floor
+
+    def get_statistics(self):
+        ready = self.count >= WARMUP
+        return {
+            "packets": self.count,
+            "period_ms": self.period() * 1000 if ready else None,
+            "skew_ppm": self.skew_ppm() if ready else None,
+            "queuing_delay_ms": self.latest * 1000 if self.latest is not None else None,
+            "jitter_ms": self.jitter * 1000,
+        }
@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+"""
+Construct free decoding of the general part of a GameController packet.
+
+The state scripts only depend on the fields in front of the team blocks, and
+those sit at fixed offsets, so one precompiled :class:`struct.Struct` reads
+them without importing construct or building the ``gamestate.GameState``
+definition.  That keeps ``handler.py`` lean on a cold start; the full parse
+is still available through :func:`construct_decoder`.
+
+Both decoders raise :class:`MalformedPacket` for packets that are not
+version 12 GameController data::
+
+    state = decode(data)
+    state.game_state, state.packet_number, state.seconds_remaining
+"""
+
+import struct
+from collections import namedtuple
+
+HEADER = b"RGme"
+VERSION = 12
+# gamestate.GameState.sizeof()
+PACKET_SIZE = 688
+
+_GENERAL = struct.Struct("<4sHBBBBBBB4sBHhh")
+
+GeneralState = namedtuple("GeneralState", [
+    "packet_number", "players_per_team", "game_type", "game_state", "first_half", "kick_of_team",
+    "secondary_state", "secondary_state_info", "drop_in_team", "drop_in_time", "seconds_remaining",
+    "secondary_seconds_remaining"])
+
+
+class MalformedPacket(ValueError):
+    """ Not a (complete) GameController packet of the expected version """
+
+
+def decode(data):
+    """Decodes the general part of a packet into a :class:`GeneralState`, enums as plain integers"""
+    if len(data) < PACKET_SIZE:
+        raise MalformedPacket(f"Packet has {len(data)} bytes, expected {PACKET_SIZE}")
+    fields = _GENERAL.unpack_from(data)
+    if fields[0] != HEADER or fields[1] != VERSION:
+        raise MalformedPacket(f"Unexpected header {fields[0]!r} version {fields[1]}")
+    return GeneralState._make(fields[2:])
+
+
+def construct_decoder():
+    """``gamestate.GameState.parse`` with the errors of :func:`decode`, imports construct"""
+    from construct import ConstError
+    from gamestate import GameState
+
+    def parse(data):
+        try:
+            return GameState.parse(data)
+        except ConstError as e:
+            raise MalformedPacket(str(e))
+    return parse
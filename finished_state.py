@@ -1,8 +1,12 @@
 # finished_state.py
-import time
+import heartbeat
+import state_report
+
+state_report.report_ready()
 
 counter = 0
 while True:
     counter += 1
     print(f"FINISHED STATE - Counter: {counter}")
-    time.sleep(2)
+    state_report.report_first_action()
+    heartbeat.sleep(2)
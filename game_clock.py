@@ -0,0 +1,220 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+"""
+Local game clock interpolated between GameController packets.
+
+The GC sends ``seconds_remaining`` and ``secondary_seconds_remaining`` as
+whole seconds at 2 Hz.  Every packet where a timer ticks down by one bounds
+the moment of that tick to the interval since the previous packet; the bounds
+of successive ticks are intersected (they are one second apart on the GC), so
+after a few ticks the phase of the GC's second boundary is known to within
+the packet jitter.  Between packets :meth:`GameClock.remaining` extrapolates
+from the estimated tick with the monotonic clock.
+
+A value of ``v`` is taken to mean "v seconds left at the moment it first
+appeared", so the interpolated value runs from v down to v - 1 until the
+next tick.  Anything other than a regular tick (a timeout starting, the half
+changing, the clock being set by the referee) resynchronizes the timer and
+reschedules the pending callbacks.
+
+Callbacks such as "10 s left in the secondary state" are driven by a
+:class:`timer_wheel.TimerWheel`, nobody has to poll.
+"""
+
+import time
+import logging
+import threading
+
+from timer_wheel import TimerWheel, TimerWheelThread
+
+logger = logging.getLogger('game_clock')
+
+TIMER_MAIN = "main"
+TIMER_SECONDARY = "secondary"
+
+# Without a tick for this long the GC clock counts as stopped
+STOPPED_AFTER = 1.6
+# Never extrapolate further than this past the last observed tick
+MAX_EXTRAPOLATION = 2.0
+# Pending callbacks are only moved when their deadline changed more than this
+RESCHEDULE_THRESHOLD = 0.005
+
+
+class _TimerTrack(object):
+    """ One GC timer: its last value and the estimated moment it appeared """
+
+    def __init__(self, name):
+        self.name = name
+        self.value = None
+        self.last_update = None
+        # Bounds of the monotonic time at which self.value appeared
+        self.tick_low = None
+        self.tick_high = None
+        self.last_tick_seen = None
+        self.resyncs = 0
+
+    def tick_time(self):
+        return (self.tick_low + self.tick_high) / 2.0
+
+    def running(self, now):
+        return self.last_tick_seen is not None and now - self.last_tick_seen < STOPPED_AFTER
+
+    def update(self, value, now):
+        """Feeds one packet, returns True if the timer had to be resynchronized"""
+        previous, previous_update = self.value, self.last_update
+        self.value, self.last_update = value, now
+        if previous is None:
+            self._resync(now - 1.0, now)
+            return True
+
+        if value == previous:
+            # The next tick has not happened yet, so this value appeared less than a second ago
+            self.tick_low = max(self.tick_low, now - 1.0)
+            if self.tick_low > self.tick_high:
+                self._resync(now - 1.0, now)
+                return True
+            return False
+
+        ticks = previous - value
+        elapsed = now - previous_update
+        if 1 <= ticks <= elapsed + 1:
+            # Regular tick(s), possibly with lost packets in between
+            low = max(self.tick_low + ticks, previous_update)
+            high = min(self.tick_high + ticks, now)
+            if low > high:
+                # Drifted apart, start over from what this packet tells
+                low, high = previous_update, now
+            self.tick_low, self.tick_high = low, high
+            self.last_tick_seen = now
+            return False
+
+        logger.debug(f"{self.name} timer jumped from {previous} to {value}")
+        self.resyncs += 1
+        self._resync(previous_update, now)
+        self.last_tick_seen = None
+        return True
+
+    def _resync(self, low, high):
+        self.tick_low, self.tick_high = low, high
+
+    def remaining(self, now):
+        if self.value is None:
+            return None
+        if not self.running(now):
+            return float(self.value)
+        elapsed = min(now - self.tick_time(), MAX_EXTRAPOLATION)
+        return self.value - max(elapsed, 0.0)
+
+    def deadline_for(self, seconds, now):
+        """Monotonic time at which remaining() reaches *seconds*, None while stopped"""
+        if self.value is None or not self.running(now):
+            return None
+        return self.tick_time() + (self.value - seconds)
+
+
+class GameClock(object):
+    """
+    Sub-second view of the GC timers, fed with every parsed packet.
+
+    Usage:
+        clock = receiver.attach_game_clock()  # or GameClock().start(), fed with update()
+        clock.call_at_remaining(10, on_ten_seconds_left, timer=TIMER_SECONDARY)
+        clock.remaining()
+    """
+
+    def __init__(self, wheel=None, clock=time.monotonic):
+        self.clock = clock
+        self.wheel = wheel if wheel is not None else TimerWheel(tick=0.005, clock=clock)
+        self.wheel_thread = None
+        self.tracks = {TIMER_MAIN: _TimerTrack(TIMER_MAIN), TIMER_SECONDARY: _TimerTrack(TIMER_SECONDARY)}
+        # timer name -> PendingCallbacks not fired yet
+        self.pending = {TIMER_MAIN: set(), TIMER_SECONDARY: set()}
+        self.lock = threading.Lock()
+
+    def start(self):
+        """Drives the timer wheel from its own thread"""
+        self.wheel_thread = TimerWheelThread(self.wheel).start()
+        return self
+
+    def stop(self):
+        if self.wheel_thread is not None:
+            self.wheel_thread.stop()
+
+    def update(self, state, receive_time=None):
+        """
+        Anchors the timers to a packet.
+
+        Args:
+            state: The parsed game state
+            receive_time: Monotonic time the packet was received, now if omitted
+        """
+        now = receive_time if receive_time is not None else self.clock()
+        with self.lock:
+            for name, value in ((TIMER_MAIN, state.seconds_remaining),
+                                (TIMER_SECONDARY, state.secondary_seconds_remaining)):
+                track = self.tracks[name]
+                was_running = track.running(now)
+                resynced = track.update(value, now)
+                if self.pending[name] and (resynced or was_running != track.running(now) or track.running(now)):
+                    self._reschedule(name, now)
+
+    def remaining(self, timer=TIMER_MAIN, now=None):
+        """Interpolated seconds left on a timer, None before the first packet"""
+        return self.tracks[timer].remaining(self.clock() if now is None else now)
+
+    def running(self, timer=TIMER_MAIN):
+        return self.tracks[timer].running(self.clock())
+
+    def call_at_remaining(self, seconds, callback, timer=TIMER_MAIN):
+        """
+        Calls callback(timer, seconds) once when the timer reaches *seconds*.
+        Runs right away if the running timer is already below. Returns an
+        object whose cancel() withdraws the callback.
+        """
+        pending = PendingCallback(self, timer, seconds, callback)
+        with self.lock:
+            self.pending[timer].add(pending)
+            self._schedule(pending, self.clock())
+        return pending
+
+    def _schedule(self, pending, now):
+        deadline = self.tracks[pending.timer].deadline_for(pending.seconds, now)
+        if pending.handle is not None:
+            if deadline is not None and abs(pending.handle.deadline - deadline) < RESCHEDULE_THRESHOLD:
+                return
+            pending.handle.cancel()
+            pending.handle = None
+        if deadline is not None:
+            pending.handle = self.wheel.call_at(deadline, self._fire, pending)
+
+    def _reschedule(self, timer, now):
+        for pending in list(self.pending[timer]):
+            self._schedule(pending, now)
+
+    def _fire(self, pending):
+        with self.lock:
+            if pending not in self.pending[pending.timer]:
+                return
+            self.pending[pending.timer].discard(pending)
+        pending.callback(pending.timer, pending.seconds)
+
+    def _cancel(self, pending):
+        with self.lock:
+            self.pending[pending.timer].discard(pending)
+            if pending.handle is not None:
+                pending.handle.cancel()
+
+
+class PendingCallback(object):
+    """ A callback waiting for a timer to reach a value """
+
+    def __init__(self, game_clock, timer, seconds, callback):
+        self.game_clock = game_clock
+        self.timer = timer
+        self.seconds = seconds
+        self.callback = callback
+        self.handle = None
+
+    def cancel(self):
+        self.game_clock._cancel(self)
@@ -1,33 +1,76 @@
 # handler_with_latency.py
+# Cold start matters (a robot rebooting mid-match), so construct, subprocess and
+# the metrics HTTP server are only imported once they are needed
 import threading
-import subprocess
 import time
 import socket
-from construct import ConstError
-from gamestate import GameState
 import logging
-from collections import deque
-import statistics
+import os
+import select
+import selectors
+import sys
+from latency import (StageLatencyTracker, STAGES, STAGE_RECEIVE, STAGE_PARSE, STAGE_DISPATCH,
+                     STAGE_TERMINATE, STAGE_SPAWN, STAGE_FIRST_OUTPUT, STAGE_NETWORK)
+import metrics
+import log_pipeline
+from tracing import (TransitionTracer, read_report_line, MILESTONE_PARSED, MILESTONE_DISPATCHED,
+                     MILESTONE_TERMINATED, MILESTONE_SPAWNED, MILESTONE_FIRST_OUTPUT)
+from state_report import REPORT_FD_ENV
+from sequence import SequenceMonitor
+from socket_profile import SocketProfile, recv_timestamped, add_socket_arguments, profile_from_args
+from fast_decode import decode, construct_decoder, MalformedPacket, PACKET_SIZE
+import warm_restart
+from restart_policy import add_restart_arguments, policies_from_args
+from composition import Composition
+from hang_detector import add_heartbeat_arguments, detector_from_args
+from script_cache import add_hot_reload_arguments, index_from_args
+from proc_sampler import add_sampler_arguments, sampler_from_args
+from metrics import (PACKETS_RECEIVED, PACKETS_PARSED, PACKETS_DROPPED, PACKETS_MALFORMED,
+                     STATE_TRANSITIONS, COALESCED_TRANSITIONS, CHILD_RESTARTS)
 
 # Setup logging
 logger = logging.getLogger('state_monitor')
 logger.setLevel(logging.DEBUG)
-console_handler = logging.StreamHandler()
-console_handler.setFormatter(logging.Formatter("%(asctime)s [%(levelname)s] %(message)s"))
-logger.addHandler(console_handler)
+# Console and log file format, see log_pipeline.setup
+LOG_FORMAT = "%(asctime)s [%(levelname)s] %(message)s"
 
 # Game Controller configuration
 DEFAULT_LISTENING_HOST = '0.0.0.0'
 GAME_CONTROLLER_LISTEN_PORT = 3838
+# Every valid packet starts with these bytes, the packet number follows right after
+PACKET_PREFIX = b"RGme\x0c\x00"  # header and version 12
+PACKET_NUMBER_OFFSET = len(PACKET_PREFIX)
 
 # Global variables
 current_state = None
 lock = threading.Lock()
 
+# Set when the handler took over from a snapshot, see warm_restart
+recovery = None
+SNAPSHOT_FILE = "handler_snapshot.json"
+
+# Watches the heartbeats of the scripts, None unless --heartbeat-deadline was given
+hang_detector = None
+# Bytes read at once from a script's output and report pipes
+READ_SIZE = 65536
+# Seconds a hung script gets to exit after SIGTERM before it is killed
+HUNG_TERMINATE_TIMEOUT = 0.5
+
+# Precompiled scripts, None unless --hot-reload was given
+script_index = None
+
+# Resource profiles per state, None unless --proc-sample-period was given
+proc_sampler = None
+
 # Latency tracking
-state_change_times = {}  # Track when state changes were received
+state_change_times = {}  # Track when state changes were received (receive time, parsed time, packet number)
+STAGE_TOTAL = "total"
+STAGE_FIRST_ACTION = "first_action"  # receive to the script's first reported action
 
-# Mapping game states to Python files
+# Mapping game states to Python files. An entry may also be a Composition of several
+# scripts started in dependency order (see composition.py), those run with --asyncio, e.g.
+#   3: Composition(Member("vision.py"), Member("localization.py", after=["vision.py"]),
+#                  Member("playing_state.py", after=["localization.py"]))
 STATE_FILES = {
     0: "initial_state.py",    # STATE_INITIAL
     1: "ready_state.py",      # STATE_READY
@@ -45,108 +88,151 @@ STATE_NAMES = {
 }
 
 
-class LatencyTracker:
-    """Class to track and analyze latency metrics"""
+class LatencyTracker(StageLatencyTracker):
+    """Class to track and analyze latency metrics per pipeline stage"""
     
     def __init__(self):
-        self.measurements = deque(maxlen=1000)
-        self.lock = threading.Lock()
+        super(LatencyTracker, self).__init__(STAGES + (STAGE_TOTAL, STAGE_FIRST_ACTION, STAGE_NETWORK))
     
     def add_measurement(self, latency_ms):
-        """Add a latency measurement in milliseconds"""
-        with self.lock:
-            self.measurements.append(latency_ms)
-    
-    def get_statistics(self):
-        """Get latency statistics"""
-        with self.lock:
-            if not self.measurements:
-                return None
-            
-            measurements = list(self.measurements)
-            return {
-                'count': len(measurements),
-                'latest': measurements[-1],
-                'average': statistics.mean(measurements),
-                'median': statistics.median(measurements),
-                'min': min(measurements),
-                'max': max(measurements),
-                'std_dev': statistics.stdev(measurements) if len(measurements) > 1 else 0
-            }
+        """Add an end-to-end (receive to process start) measurement in milliseconds"""
+        self.record(STAGE_TOTAL, latency_ms)
     
     def print_statistics(self):
         """Print current latency statistics"""
-        stats = self.get_statistics()
-        if stats:
-            logger.info("=== LATENCY STATISTICS ===")
-            logger.info(f"Total measurements: {stats['count']}")
-            logger.info(f"Latest: {stats['latest']:.2f} ms")
-            logger.info(f"Average: {stats['average']:.2f} ms")
-            logger.info(f"Median: {stats['median']:.2f} ms")
-            logger.info(f"Min: {stats['min']:.2f} ms")
-            logger.info(f"Max: {stats['max']:.2f} ms")
-            logger.info(f"Std Dev: {stats['std_dev']:.2f} ms")
-            logger.info("========================")
+        super(LatencyTracker, self).print_statistics(logger)
+
+
+latency_tracker = LatencyTracker()
+transition_tracer = TransitionTracer()
+metrics.REGISTRY.stage_histograms("gc_stage_latency_seconds", "Latency of each game state pipeline stage", latency_tracker)
 
 
 class GameStateListener:
     """Class to listen for game state updates from Game Controller"""
     
-    def __init__(self, addr=(DEFAULT_LISTENING_HOST, GAME_CONTROLLER_LISTEN_PORT)):
+    def __init__(self, addr=(DEFAULT_LISTENING_HOST, GAME_CONTROLLER_LISTEN_PORT), socket_profile=None,
+                 full_parse=False):
         self.addr = addr
+        # The struct decoder covers every field used here, construct parses the teams as well
+        self.decode = construct_decoder() if full_parse else decode
+        self.socket_profile = socket_profile if socket_profile is not None else SocketProfile()
+        self.sequence = SequenceMonitor()
         self.socket = None
         self.running = True
+        self.time = None
+        # Refreshed on valid packets while the state holds, see warm_restart
+        self.snapshot_file = None
+        self.snapshot_refreshed = 0.0
         self._open_socket()
     
     def _open_socket(self):
         """Create and configure the socket"""
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
         self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self.socket.bind(self.addr)
-        self.socket.settimeout(0.5)
+        self.socket_profile.apply_receive(self.socket)
+        self.socket.bind(self.socket_profile.bind_address(self.addr))
+        self.socket_profile.join_multicast(self.socket)
+        self.socket_profile.log_results(logger)
+        self.socket.setblocking(False)
     
     def listen_forever(self):
         """Listen for game state updates in a loop"""
-        global current_state, state_change_times
-        
         while self.running:
             try:
-                # Record precise timestamp when data is received
-                receive_time = time.time()
-                data, peer = self.socket.recvfrom(GameState.sizeof())
-                
-                # Parse the game state
-                parsed_state = GameState.parse(data)
-                game_state_enum = parsed_state.game_state
-                
-                # Convert enum to integer value
-                if hasattr(game_state_enum, 'value'):
-                    game_state_value = game_state_enum.value
-                elif hasattr(game_state_enum, '_value'):
-                    game_state_value = game_state_enum._value
-                else:
-                    # Fallback: try to convert to int directly
-                    try:
-                        game_state_value = int(game_state_enum)
-                    except (ValueError, TypeError):
-                        logger.warning(f"Could not convert game state to integer: {game_state_enum}")
-                        continue
-                
-                # Update global state if it changed
-                with lock:
-                    if current_state != game_state_value:
-                        current_state = game_state_value
-                        state_change_times[game_state_value] = receive_time
-                        state_name = STATE_NAMES.get(game_state_value, f"UNKNOWN({game_state_value})")
-                        logger.info(f"Game state changed to: {state_name} ({game_state_value}) at {receive_time:.6f}")
-                
-            except socket.timeout:
-                # Timeout is expected, continue listening
+                # Wait for data first so the receive stage only measures the read itself
+                readable, _, _ = select.select([self.socket], [], [], 0.5)
+            except (OSError, ValueError):
+                # Closed by stop()
                 continue
-            except ConstError:
-                logger.warning("Parse Error: Probably using an old protocol!")
-            except Exception as e:
-                logger.error(f"Error receiving game state: {e}")
+            if readable and self.running:
+                self.receive_once()
+    
+    def receive_once(self):
+        """Reads and handles one datagram, returns the new game state value if it changed, else None"""
+        global current_state
+        
+        changed = None
+        try:
+            # Record precise timestamp when data is received, the kernel's if it gives us one
+            if self.socket_profile.timestamping:
+                data, peer, receive_time = recv_timestamped(self.socket, PACKET_SIZE)
+            else:
+                receive_time = time.time()
+                data, peer = self.socket.recvfrom(PACKET_SIZE)
+            PACKETS_RECEIVED.inc()
+            
+            # Loss and reordering statistics, late packets are optionally dropped. Foreign
+            # datagrams are left to the parser, their bytes are no packet number
+            sequenced = len(data) > PACKET_NUMBER_OFFSET and data.startswith(PACKET_PREFIX)
+            if sequenced and not self.sequence.accept(peer[0], data[PACKET_NUMBER_OFFSET], receive_time):
+                return None
+            
+            # Parse the game state
+            parse_start = time.time()
+            parsed_state = self.decode(data)
+            parsed_time = time.time()
+            PACKETS_PARSED.inc()
+            self.time = parsed_time
+            latency_tracker.record(STAGE_RECEIVE, (parse_start - receive_time) * 1000)
+            latency_tracker.record(STAGE_PARSE, (parsed_time - parse_start) * 1000)
+            network_delay = self.sequence.network_delay(peer[0], data[PACKET_NUMBER_OFFSET], receive_time) \
+                if sequenced else None
+            if network_delay is not None:
+                # The GC's share, everything from receive on is ours
+                latency_tracker.record(STAGE_NETWORK, network_delay * 1000)
+            
+            game_state_enum = parsed_state.game_state
+            
+            # Convert enum to integer value
+            if hasattr(game_state_enum, 'value'):
+                game_state_value = game_state_enum.value
+            elif hasattr(game_state_enum, '_value'):
+                game_state_value = game_state_enum._value
+            else:
+                # Fallback: try to convert to int directly
+                try:
+                    game_state_value = int(game_state_enum)
+                except (ValueError, TypeError):
+                    logger.warning(f"Could not convert game state to integer: {game_state_enum}")
+                    PACKETS_DROPPED.inc()
+                    return None
+            
+            if recovery is not None and recovery.confirmed_at is None:
+                recovery.reconcile(game_state_value, receive_time)
+            
+            # Update global state if it changed
+            with lock:
+                if current_state != game_state_value:
+                    # The monitor has not picked up the previous change yet
+                    if current_state in state_change_times:
+                        COALESCED_TRANSITIONS.inc()
+                    current_state = changed = game_state_value
+                    state_change_times[game_state_value] = (receive_time, parsed_time, parsed_state.packet_number)
+                    state_name = STATE_NAMES.get(game_state_value, f"UNKNOWN({game_state_value})")
+                    logger.info(f"Game state changed to: {state_name} ({game_state_value}) at {receive_time:.6f}")
+            
+            if self.snapshot_file and changed is None and \
+                    parsed_time - self.snapshot_refreshed >= warm_restart.REFRESH_INTERVAL:
+                warm_restart.refresh_snapshot(self.snapshot_file)
+                self.snapshot_refreshed = parsed_time
+            
+        except BlockingIOError:
+            # Another reader took the datagram, continue listening
+            pass
+        except MalformedPacket:
+            PACKETS_MALFORMED.inc()
+            logger.warning("Parse Error: Probably using an old protocol!")
+        except Exception as e:
+            PACKETS_DROPPED.inc()
+            logger.error(f"Error receiving game state: {e}")
+        return changed
+    
+    def get_time_since_last_package(self):
+        """Seconds since the last parsed packet, None before the first one"""
+        if self.time is None:
+            return None
+        return time.time() - self.time
     
     def stop(self):
         """Stop listening"""
@@ -155,37 +241,151 @@ class GameStateListener:
             self.socket.close()
 
 
-def monitor_game_state():
-    """Monitor game state and manage subprocess execution with latency tracking"""
+def forward_process_output(process, started_at, span=None, report_fd=None):
+    """Forward a child's output to our stdout, timing its first output and its state reports"""
+    # Raw reads, a buffered readline would keep further lines of the same write from select
+    selector = selectors.DefaultSelector()
+    selector.register(process.stdout.fileno(), selectors.EVENT_READ, "output")
+    if report_fd is not None:
+        selector.register(report_fd, selectors.EVENT_READ, "report")
+    pending = b""
+    
+    first_output = True
+    while selector.get_map():
+        for key, _ in selector.select():
+            data = os.read(key.fd, READ_SIZE)
+            if not data:
+                selector.unregister(key.fd)
+                if key.data == "report":
+                    os.close(key.fd)
+                continue
+            if key.data == "report":
+                *lines, pending = (pending + data).split(b"\n")
+                for line in lines:
+                    if span and span.duration_ms() is None:
+                        read_report_line(span, line.decode("ascii", "replace"))
+                        end_to_end_ms = span.duration_ms()
+                        if end_to_end_ms is not None:
+                            latency_tracker.record(STAGE_FIRST_ACTION, end_to_end_ms)
+                            logger.info(f"[MONITOR] {span.script} first action {end_to_end_ms:.2f}ms "
+                                        f"after packet {span.packet_number}")
+                continue
+            if first_output:
+                first_output_time = time.time()
+                latency_tracker.record(STAGE_FIRST_OUTPUT, (first_output_time - started_at) * 1000)
+                if span:
+                    span.mark(MILESTONE_FIRST_OUTPUT, first_output_time)
+                first_output = False
+            sys.stdout.buffer.write(data)
+            sys.stdout.flush()
+    selector.close()
+    process.stdout.close()
+
+
+def monitor_game_state(snapshot_file=None):
+    """Monitor game state and manage subprocess execution with latency tracking,
+    writing each transition to *snapshot_file* for a warm restart"""
+    # Imported here, while the listener waits for the first packet
+    import subprocess
     current_process = None
     current_file = None
+    heartbeat = None
+    if recovery is not None and recovery.process is not None:
+        current_process = recovery.process
+        current_file = recovery.script
     
     while True:
         with lock:
             state = current_state
-            receive_time = state_change_times.get(state) if state is not None else None
+            receive_time, parsed_time, packet_number = state_change_times.get(state, (None, None, None)) if state is not None else (None, None, None)
         
         # Check if we have a valid state and corresponding file
         if state is not None and state in STATE_FILES:
             target_file = STATE_FILES[state]
             
+            if isinstance(current_process, warm_restart.AdoptedProcess) and current_process.poll() is not None:
+                # Its output went to the previous handler, start one of our own
+                logger.warning(f"[MONITOR] Adopted {current_file} (PID: {current_process.pid}) exited, relaunching")
+                current_process = None
+                current_file = None
+            
+            if heartbeat is not None and heartbeat.hung:
+                # Alive to poll() but stuck, e.g. in a blocking read
+                logger.warning(f"[MONITOR] {current_file} stopped beating (PID: {current_process.pid}), restarting it")
+                CHILD_RESTARTS.inc()
+                current_process.terminate()
+                try:
+                    current_process.wait(HUNG_TERMINATE_TIMEOUT)
+                except subprocess.TimeoutExpired:
+                    current_process.kill()
+                    current_process.wait()
+                hang_detector.unwatch(heartbeat)
+                heartbeat = None
+                current_file = None
+            
             # If we need to switch to a different file
             if current_file != target_file:
                 # Record when we start processing the state change
                 process_start_time = time.time()
+                span = None
+                if parsed_time:
+                    latency_tracker.record(STAGE_DISPATCH, (process_start_time - parsed_time) * 1000)
+                    span = transition_tracer.begin(STATE_NAMES.get(state, state), packet_number, receive_time, target_file)
+                    span.mark(MILESTONE_PARSED, parsed_time)
+                    span.mark(MILESTONE_DISPATCHED, process_start_time)
+                
+                STATE_TRANSITIONS.inc()
+                if proc_sampler is not None:
+                    proc_sampler.set_state(STATE_NAMES.get(state, state))
                 
                 # Terminate current process if running
                 if current_process and current_process.poll() is None:
+                    CHILD_RESTARTS.inc()
                     current_process.terminate()
                     current_process.wait()  # Wait for process to actually terminate
+                    terminated_time = time.time()
+                    latency_tracker.record(STAGE_TERMINATE, (terminated_time - process_start_time) * 1000)
+                    if span:
+                        span.mark(MILESTONE_TERMINATED, terminated_time)
                     logger.info(f"[MONITOR] {current_file} terminated")
                 
                 # Start new process
+                if hang_detector is not None:
+                    hang_detector.unwatch(heartbeat)
+                    heartbeat = hang_detector.watch(target_file)
+                report_read, report_write = os.pipe()
                 try:
-                    current_process = subprocess.Popen(["python3", target_file])
+                    env = dict(os.environ, PYTHONUNBUFFERED="1", **{REPORT_FD_ENV: str(report_write)})
+                    if heartbeat is not None:
+                        env.update(heartbeat.env())
+                    spawn_start_time = time.time()
+                    current_process = subprocess.Popen(
+                        [sys.executable, script_index.launch(target_file, env) if script_index is not None else target_file],
+                        stdout=subprocess.PIPE,
+                        pass_fds=(report_write,) + (heartbeat.pass_fds if heartbeat is not None else ()),
+                        env=env
+                    )
                     process_execution_time = time.time()
+                    if heartbeat is not None:
+                        hang_detector.spawned(heartbeat, current_process)
+                    if proc_sampler is not None:
+                        proc_sampler.track(current_process.pid, target_file)
+                    latency_tracker.record(STAGE_SPAWN, (process_execution_time - spawn_start_time) * 1000)
+                    if span:
+                        span.pid = current_process.pid
+                        span.mark(MILESTONE_SPAWNED, process_execution_time)
+                    threading.Thread(
+                        target=forward_process_output,
+                        args=(current_process, process_execution_time, span, report_read),
+                        daemon=True
+                    ).start()
+                    report_read = None
                     current_file = target_file
                     state_name = STATE_NAMES.get(state, f"UNKNOWN({state})")
+                    if recovery is not None:
+                        recovery.mark_ready(process_execution_time)
+                    if snapshot_file:
+                        save_snapshot(snapshot_file, state, target_file, current_process, packet_number, receive_time)
                     
                     # Calculate and display latency only once when executing
                     if receive_time:
@@ -193,6 +393,7 @@ def monitor_game_state():
                         total_latency_ms = (process_execution_time - receive_time) * 1000
                         # Processing latency (from start of processing to execution)
                         processing_latency_ms = (process_execution_time - process_start_time) * 1000
+                        latency_tracker.add_measurement(total_latency_ms)
                         
                         logger.info(f"[MONITOR] {target_file} started for {state_name} - Latency: {total_latency_ms:.2f}ms (Processing: {processing_latency_ms:.2f}ms)")
                         
@@ -209,6 +410,14 @@ def monitor_game_state():
                 except Exception as e:
                     logger.error(f"[MONITOR] Error starting {target_file}: {e}")
                     current_file = None
+                finally:
+                    # The child holds its own copy of the write end
+                    os.close(report_write)
+                    if report_read is not None:
+                        os.close(report_read)
+                    if heartbeat is not None and current_file is None:
+                        hang_detector.unwatch(heartbeat)
+                        heartbeat = None
         
         else:
             # No valid state or file, terminate any running process
@@ -217,67 +426,240 @@ def monitor_game_state():
                 current_process.wait()
                 logger.info(f"[MONITOR] {current_file} terminated (invalid state)")
                 current_file = None
+                if hang_detector is not None:
+                    hang_detector.unwatch(heartbeat)
+                    heartbeat = None
+                if snapshot_file:
+                    save_snapshot(snapshot_file, state)
         
         time.sleep(0.1)
 
 
+def save_snapshot(path, state, script=None, process=None, packet_number=None, receive_time=None):
+    """Persists the transition for a warm restart, a failure only costs the restart"""
+    try:
+        warm_restart.save_snapshot(path, state, script, process, packet_number, receive_time)
+    except OSError as e:
+        logger.error(f"[MONITOR] Could not write snapshot {path}: {e}")
+
+
+def create_supervisor(snapshot_file=None, policies=None, default_policy=None):
+    """The asyncio supervisor (see :mod:`supervisor`) recording this handler's latency stages, snapshots
+    and recovery. Imported on demand, the thread based monitor does not need asyncio"""
+    from supervisor import Supervisor
+    
+    class HandlerSupervisor(Supervisor):
+        
+        def on_started(self, child):
+            super(HandlerSupervisor, self).on_started(child)
+            if proc_sampler is not None:
+                proc_sampler.track(child.pid, child.script)
+            if not self.is_primary(child):
+                return
+            if recovery is not None:
+                recovery.mark_ready(child.started_at)
+            if snapshot_file:
+                save_snapshot(snapshot_file, child.context["state"], child.script, child.process)
+        
+        def on_first_output(self, child):
+            latency_tracker.record(STAGE_FIRST_OUTPUT, (child.first_output_at - child.started_at) * 1000)
+            span = child.context["span"]
+            if span and not child.attempt and self.is_primary(child):
+                span.mark(MILESTONE_FIRST_OUTPUT, child.first_output_at)
+        
+        def on_hang(self, child, silence):
+            super(HandlerSupervisor, self).on_hang(child, silence)
+            CHILD_RESTARTS.inc()
+        
+        def on_report(self, child, line):
+            span = child.context["span"]
+            if not span or child.attempt or span.duration_ms() is not None or not self.is_primary(child):
+                return
+            read_report_line(span, line)
+            end_to_end_ms = span.duration_ms()
+            if end_to_end_ms is not None:
+                latency_tracker.record(STAGE_FIRST_ACTION, end_to_end_ms)
+                logger.info(f"[MONITOR] {span.script} first action {end_to_end_ms:.2f}ms "
+                            f"after packet {span.packet_number}")
+    
+    return HandlerSupervisor(command=[sys.executable], policies=policies, default_policy=default_policy,
+                             hang_detector=hang_detector, script_index=script_index)
+
+
+async def monitor_async(supervisor, wakeup, snapshot_file=None):
+    """monitor_game_state on an event loop: woken by the listener instead of polling, the
+    scripts are run by *supervisor*"""
+    current_file = None
+    
+    while True:
+        await wakeup.wait()
+        wakeup.clear()
+        with lock:
+            state = current_state
+            receive_time, parsed_time, packet_number = state_change_times.get(state, (None, None, None)) if state is not None else (None, None, None)
+        
+        if state is None or state not in STATE_FILES:
+            # No valid state or file, terminate any running process
+            if supervisor.children:
+                await supervisor.transition(None)
+                logger.info(f"[MONITOR] {current_file} terminated (invalid state)")
+                current_file = None
+                if snapshot_file:
+                    save_snapshot(snapshot_file, state)
+            continue
+        
+        target_file = STATE_FILES[state]
+        if current_file == target_file:
+            continue
+        
+        process_start_time = time.time()
+        span = None
+        if parsed_time:
+            latency_tracker.record(STAGE_DISPATCH, (process_start_time - parsed_time) * 1000)
+            span = transition_tracer.begin(STATE_NAMES.get(state, state), packet_number, receive_time,
+                                           str(target_file))
+            span.mark(MILESTONE_PARSED, parsed_time)
+            span.mark(MILESTONE_DISPATCHED, process_start_time)
+        STATE_TRANSITIONS.inc()
+        if proc_sampler is not None:
+            proc_sampler.set_state(STATE_NAMES.get(state, state))
+        
+        previous = supervisor.current
+        target = Composition.of(target_file)
+        # Members shared with the new state keep running
+        terminating = previous is not None and previous.returncode is None and previous.script not in target
+        CHILD_RESTARTS.inc(sum(1 for script, running in supervisor.children.items()
+                               if script not in target and running.returncode is None))
+        child = await supervisor.transition(target, {"state": state, "span": span})
+        if child is None:
+            current_file = None
+            continue
+        current_file = target_file
+        if child is previous:
+            logger.info(f"[MONITOR] {child.script} kept running for {STATE_NAMES.get(state, state)}")
+            continue
+        if terminating:
+            latency_tracker.record(STAGE_TERMINATE, (child.spawn_started - process_start_time) * 1000)
+            if span:
+                span.mark(MILESTONE_TERMINATED, child.spawn_started)
+        latency_tracker.record(STAGE_SPAWN, (child.started_at - child.spawn_started) * 1000)
+        if span:
+            span.pid = child.pid
+            span.mark(MILESTONE_SPAWNED, child.started_at)
+        state_name = STATE_NAMES.get(state, f"UNKNOWN({state})")
+        
+        if receive_time:
+            total_latency_ms = (child.started_at - receive_time) * 1000
+            processing_latency_ms = (child.started_at - process_start_time) * 1000
+            latency_tracker.add_measurement(total_latency_ms)
+            logger.info(f"[MONITOR] {target_file} started for {state_name} - Latency: {total_latency_ms:.2f}ms (Processing: {processing_latency_ms:.2f}ms)")
+            with lock:
+                if state in state_change_times:
+                    del state_change_times[state]
+        else:
+            logger.info(f"[MONITOR] {target_file} started for {state_name}")
+
+
+async def run_async(listener, snapshot_file=None, policies=None, default_policy=None):
+    """Listener, monitor and scripts on one event loop, until cancelled"""
+    import asyncio
+    loop = asyncio.get_running_loop()
+    supervisor = create_supervisor(snapshot_file, policies, default_policy)
+    wakeup = asyncio.Event()
+    
+    def on_readable():
+        if listener.receive_once() is not None:
+            wakeup.set()
+    
+    loop.add_reader(listener.socket, on_readable)
+    # A restored state starts its script right away
+    wakeup.set()
+    monitor = asyncio.ensure_future(monitor_async(supervisor, wakeup, snapshot_file))
+    try:
+        await asyncio.Event().wait()
+    finally:
+        loop.remove_reader(listener.socket)
+        monitor.cancel()
+        await supervisor.stop()
+
+
 def create_sample_state_files():
     """Create sample state files for testing with latency measurement"""
     sample_files = {
         "initial_state.py": '''# initial_state.py
 import time
 import os
+import heartbeat
+import state_report
 
 print(f"[{os.getpid()}] INITIAL STATE started at {time.time():.6f}")
+state_report.report_ready()
 counter = 0
 while True:
     counter += 1
     print(f"[{os.getpid()}] INITIAL STATE - Counter: {counter}")
-    time.sleep(1)
+    state_report.report_first_action()
+    heartbeat.sleep(1)
 ''',
         "ready_state.py": '''# ready_state.py
 import time
 import os
+import heartbeat
+import state_report
 
 print(f"[{os.getpid()}] READY STATE started at {time.time():.6f}")
+state_report.report_ready()
 counter = 0
 while True:
     counter += 1
     print(f"[{os.getpid()}] READY STATE - Counter: {counter}")
-    time.sleep(1)
+    state_report.report_first_action()
+    heartbeat.sleep(1)
 ''',
         "set_state.py": '''# set_state.py
 import time
 import os
+import heartbeat
+import state_report
 
 print(f"[{os.getpid()}] SET STATE started at {time.time():.6f}")
+state_report.report_ready()
 counter = 0
 while True:
     counter += 1
     print(f"[{os.getpid()}] SET STATE - Counter: {counter}")
-    time.sleep(1)
+    state_report.report_first_action()
+    heartbeat.sleep(1)
 ''',
         "playing_state.py": '''# playing_state.py
 import time
 import os
+import heartbeat
+import state_report
 
 print(f"[{os.getpid()}] PLAYING STATE started at {time.time():.6f}")
+state_report.report_ready()
 counter = 0
 while True:
     counter += 1
     print(f"[{os.getpid()}] PLAYING STATE - Counter: {counter}")
-    time.sleep(0.5)
+    state_report.report_first_action()
+    heartbeat.sleep(0.5)
 ''',
         "finished_state.py": '''# finished_state.py
 import time
 import os
+import heartbeat
+import state_report
 
 print(f"[{os.getpid()}] FINISHED STATE started at {time.time():.6f}")
+state_report.report_ready()
 counter = 0
 while True:
     counter += 1
     print(f"[{os.getpid()}] FINISHED STATE - Counter: {counter}")
-    time.sleep(2)
+    state_report.report_first_action()
+    heartbeat.sleep(2)
 '''
     }
     
@@ -290,21 +672,73 @@ while True:
 
 
 if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Game state monitor with latency tracking")
+    metrics.add_metrics_arguments(parser)
+    add_socket_arguments(parser)
+    log_pipeline.add_logging_arguments(parser)
+    parser.add_argument('--drop-late', action='store_true',
+                        help="drop duplicate and out-of-order packets before parsing")
+    parser.add_argument('--trace-file', type=str, default=None,
+                        help="write transition spans as Chrome trace JSON to this file on shutdown")
+    parser.add_argument('--full-parse', action='store_true',
+                        help="parse the whole packet with construct instead of the general part with struct")
+    parser.add_argument('--snapshot-file', type=str, default=SNAPSHOT_FILE,
+                        help="persist each transition here and restart warm from it, empty to disable")
+    parser.add_argument('--snapshot-max-age', type=float, default=warm_restart.MAX_AGE,
+                        help="ignore snapshots older than this many seconds")
+    parser.add_argument('--asyncio', action='store_true',
+                        help="run listener, monitor and scripts on one asyncio event loop with restart policies")
+    add_restart_arguments(parser)
+    add_heartbeat_arguments(parser)
+    add_hot_reload_arguments(parser)
+    add_sampler_arguments(parser)
+    args = parser.parse_args()
+    log_pipeline.setup_from_args(args, LOG_FORMAT)
+    
+    # Bind first, packets that arrive meanwhile wait in the socket buffer
+    listener = GameStateListener(socket_profile=profile_from_args(args), full_parse=args.full_parse)
+    listener.sequence.drop_late = args.drop_late
+    listener.snapshot_file = args.snapshot_file
+    
     # Create sample state files if they don't exist
     create_sample_state_files()
     
-    # Create game state listener
-    listener = GameStateListener()
-    
-    # Create and start threads
-    listener_thread = threading.Thread(target=listener.listen_forever)
-    monitor_thread = threading.Thread(target=monitor_game_state)
+    # Take over the last state (and its script, if it still runs) until the first live packet
+    if args.snapshot_file:
+        recovery = warm_restart.restore(args.snapshot_file, args.snapshot_max_age)
+        if recovery is not None:
+            current_state = recovery.state
+            metrics.REGISTRY.gauge("gc_recovery_seconds", "Process start to the restored script running",
+                                   lambda: recovery.recovery_ms() / 1000 if recovery.ready_at is not None else None)
+    hang_detector = detector_from_args(args)
+    script_index = index_from_args(args, {os.path.dirname(os.path.abspath(member.script))
+                                          for entry in STATE_FILES.values() for member in Composition.of(entry)})
+    proc_sampler = sampler_from_args(args)
+    metrics.REGISTRY.gauge("gc_seconds_since_last_packet", "Seconds since the last valid GameController packet",
+                           listener.get_time_since_last_package)
     
-    listener_thread.daemon = True
-    monitor_thread.daemon = True
+    if not args.asyncio and any(isinstance(entry, Composition) for entry in STATE_FILES.values()):
+        logger.info("STATE_FILES has compositions, running them on the asyncio supervisor")
+        args.asyncio = True
     
-    listener_thread.start()
-    monitor_thread.start()
+    listener_thread = monitor_thread = None
+    if not args.asyncio:
+        # Create and start threads
+        listener_thread = threading.Thread(target=listener.listen_forever)
+        monitor_thread = threading.Thread(target=monitor_game_state, args=(args.snapshot_file,))
+        
+        listener_thread.daemon = True
+        monitor_thread.daemon = True
+        
+        listener_thread.start()
+        monitor_thread.start()
+    elif recovery is not None and recovery.process is not None:
+        # Its output went to the previous handler, the supervisor starts its own
+        recovery.process.terminate()
+        recovery.process = recovery.ready_at = None
+        recovery.mode = "relaunched"
+    metrics_server = metrics.start_from_args(args)
     
     logger.info("State monitor with latency tracking started.")
     logger.info("Listening for game state changes...")
@@ -314,11 +748,32 @@ if __name__ == "__main__":
         logger.info(f"  {state_name} ({state_id}) -> {filename}")
     
     try:
-        # Keep main thread alive
-        while True:
-            time.sleep(1)
+        if args.asyncio:
+            import asyncio
+            asyncio.run(run_async(listener, args.snapshot_file, *policies_from_args(args)))
+        else:
+            # Keep main thread alive
+            while True:
+                time.sleep(1)
     except KeyboardInterrupt:
         logger.info("Shutting down...")
+        latency_tracker.print_statistics()
+        if proc_sampler is not None:
+            proc_sampler.stop()
+            proc_sampler.print_statistics(logger)
+        if hang_detector is not None:
+            logger.info("Script loop lag:")
+            hang_detector.lag_tracker.print_statistics(logger)
+            hang_detector.stop()
+        if script_index is not None:
+            script_index.stop()
+            logger.info("Script compile times, off the transition path:")
+            script_index.compile_times.print_statistics(logger)
+        listener.sequence.print_statistics(logger)
+        if args.trace_file:
+            count = transition_tracer.export_chrome_trace(args.trace_file)
+            logger.info(f"Wrote {count} transition spans to {args.trace_file}")
         listener.stop()
-        listener_thread.join(timeout=2)
-        monitor_thread.join(timeout=2)
+        if listener_thread is not None:
+            listener_thread.join(timeout=2)
+            monitor_thread.join(timeout=2)
@@ -5,7 +5,6 @@ from __future__ import unicode_literals, print_function
 
 import os
 import time
-import signal
 import logging
 import threading
 import subprocess
@@ -13,16 +12,23 @@ import argparse
 import sys
 from enum import Enum
 
+import metrics
+import log_pipeline
+from metrics import STATE_TRANSITIONS, CHILD_RESTARTS
+from link_watchdog import StalenessWatchdog, add_watchdog_arguments
+from hang_detector import add_heartbeat_arguments, detector_from_args
+from script_cache import add_hot_reload_arguments, index_from_args
+from socket_profile import add_socket_arguments, profile_from_args
+from state_channel import StateChannelWriter, snapshot_from_state, STATE_FD_ENV
+
 # Import from receiver_2014.py
 from receiver_2014 import GameStateReceiver
 
 # Configure logging
 logger = logging.getLogger('game_state_handler')
 logger.setLevel(logging.DEBUG)
-
-console_handler = logging.StreamHandler()
-console_handler.setFormatter(logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s"))
-logger.addHandler(console_handler)
+# Console and log file format, see log_pipeline.setup
+LOG_FORMAT = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
 
 # Define game states as Enum for better clarity
 class GameStates(Enum):
@@ -48,7 +54,7 @@ class GameStateHandler(GameStateReceiver):
     for each state change received from the GameController.
     """
     
-    def __init__(self, team, player, scripts_directory="."):
+    def __init__(self, team, player, scripts_directory=".", socket_profile=None):
         """
         Initialize the GameStateHandler.
         
@@ -56,15 +62,33 @@ class GameStateHandler(GameStateReceiver):
             team (int): Team number
             player (int): Player number
             scripts_directory (str): Directory containing state scripts
+            socket_profile (SocketProfile): Options of the GameController socket
         """
-        super(GameStateHandler, self).__init__(team, player)
+        super(GameStateHandler, self).__init__(team, player, socket_profile=socket_profile)
         self.scripts_directory = scripts_directory
         self.current_state = None
         self.current_process = None
+        # Creates the script processes, simulation.py swaps in fake ones
+        self.launcher = subprocess.Popen
         self.process_lock = threading.Lock()
         self.state_thread = None
         self.running = True
         
+        # Live snapshot stream to the running script, swapped on every launch
+        self.state_channel = None
+        self.channel_lock = threading.Lock()
+        
+        # Reaction to GameController silence, see start_watchdog()
+        self.watchdog = None
+        self.safe_state = None
+        
+        # Heartbeats of the running script, see watch_heartbeats()
+        self.hang_detector = None
+        self.heartbeat = None
+        
+        # Precompiled scripts, launched instead of the sources if set
+        self.script_index = None
+        
         # Initialize state display
         logger.info("GameStateHandler initialized for team %d, player %d", team, player)
         logger.info("Ready to handle game state changes...")
@@ -76,20 +100,34 @@ class GameStateHandler(GameStateReceiver):
         Args:
             state: The game state received from GameController
         """
-        state_value = state.game_state
+        # construct hands out enum strings, SCRIPTS is keyed by the numeric value
+        state_value = int(state.game_state)
         state_name = GameStates(state_value).name if state_value in [s.value for s in GameStates] else "UNKNOWN"
         
-        logger.info(f"Received game state: {state_value} - {state_name}")
+        # Keep the running script's view of the game current
+        self.push_state_update(state)
         
         # Skip if state hasn't changed
         if self.current_state == state_value:
             logger.debug(f"State {state_name} unchanged, not restarting script")
             return
             
+        # Only changes are logged at INFO, the unchanged path repeats one message the log pipeline collapses
+        logger.info(f"Received game state: {state_value} - {state_name}")
         # Update state and launch appropriate script in a new thread
         self.current_state = state_value
+        STATE_TRANSITIONS.inc()
+        self.dispatch_state_change(state_value, state)
+    
+    def dispatch_state_change(self, state_value, state):
+        """
+        Runs handle_state_change on a new thread so the receiver is not
+        blocked while the previous script terminates.
         
-        # Launch in thread to avoid blocking receiver
+        Args:
+            state_value: The numeric game state value
+            state: The complete state object with all data
+        """
         if self.state_thread and self.state_thread.is_alive():
             logger.debug("Waiting for previous state thread to complete...")
             self.state_thread.join(1.0)  # Wait max 1 second
@@ -101,7 +139,7 @@ class GameStateHandler(GameStateReceiver):
         self.state_thread.daemon = True
         self.state_thread.start()
         
-    def handle_state_change(self, state_value, full_state):
+    def handle_state_change(self, state_value, full_state, hung_watch=None):
         """
         Handles state change by terminating any running script
         and launching the appropriate one for the new state.
@@ -109,8 +147,16 @@ class GameStateHandler(GameStateReceiver):
         Args:
             state_value: The numeric game state value
             full_state: The complete state object with all data
+            hung_watch: Only restart if this heartbeat watch still belongs to the running script
+        
+        Returns:
+            bool: Whether a script is running for the new state
         """
         with self.process_lock:
+            if hung_watch is not None and self.heartbeat is not hung_watch:
+                # A transition replaced the hung script meanwhile
+                return self.current_process is not None
+            
             # Terminate any running process
             self.terminate_current_process()
             
@@ -134,27 +180,57 @@ class GameStateHandler(GameStateReceiver):
                         "--secondary-state", str(full_state.secondary_state)
                     ]
                     
+                    # Later changes are streamed through the state channel
+                    channel_read, channel_write = os.pipe()
+                    env = dict(os.environ, **{STATE_FD_ENV: str(channel_read)})
+                    env["PYTHONPATH"] = os.pathsep.join(
+                        p for p in (os.path.dirname(os.path.abspath(__file__)), env.get("PYTHONPATH")) if p)
+                    pass_fds = (channel_read,)
+                    if self.script_index is not None:
+                        cmd[1] = self.script_index.launch(script_path, env)
+                    if self.hang_detector is not None:
+                        self.heartbeat = self.hang_detector.watch(script_path)
+                        env.update(self.heartbeat.env())
+                        pass_fds += self.heartbeat.pass_fds
+                    
                     # Launch the process
                     try:
-                        self.current_process = subprocess.Popen(
+                        self.current_process = self.launcher(
                             cmd,
                             stdout=subprocess.PIPE,
                             stderr=subprocess.PIPE,
-                            universal_newlines=True
+                            universal_newlines=True,
+                            pass_fds=pass_fds,
+                            env=env
                         )
                         logger.debug(f"Process started with PID: {self.current_process.pid}")
+                        if self.heartbeat is not None:
+                            self.hang_detector.spawned(self.heartbeat, self.current_process)
+                        
+                        channel = StateChannelWriter(channel_write)
+                        channel.push(snapshot_from_state(full_state, self.team, self.player))
+                        with self.channel_lock:
+                            self.state_channel = channel
+                        channel_write = None
                         
                         # Optional: Monitor process output in separate thread
-                        threading.Thread(
-                            target=self.monitor_process_output,
-                            args=(self.current_process,),
-                            daemon=True
-                        ).start()
+                        if self.current_process.stdout is not None:
+                            threading.Thread(
+                                target=self.monitor_process_output,
+                                args=(self.current_process,),
+                                daemon=True
+                            ).start()
                         
                     except Exception as e:
                         logger.error(f"Failed to start script {script_path}: {e}")
+                        self.stop_watching_heartbeat()
+                    finally:
+                        os.close(channel_read)
+                        if channel_write is not None:
+                            os.close(channel_write)
                 else:
                     logger.warning(f"Script {script_path} for state {state_value} not found")
+            return self.current_process is not None
     
     def monitor_process_output(self, process):
         """
@@ -169,34 +245,128 @@ class GameStateHandler(GameStateReceiver):
         for line in process.stderr:
             logger.error(f"Script error: {line.strip()}")
     
+    def start_watchdog(self, stale_after=1.5, lost_after=5.0, grace=5.0, safe_state=None, clock=time.monotonic,
+                       start=True):
+        """
+        Starts watching for GameController silence. The current script keeps
+        running on the last known state until the grace period after losing
+        the link is over, then the safe behavior takes over.
+        
+        Args:
+            stale_after (float): Seconds without a packet before the state is stale
+            lost_after (float): Seconds without a packet before the link is lost
+            grace (float): Seconds to keep the current script after the link is lost
+            safe_state (int): State whose script is the safe behavior, None stops the script
+            clock: Monotonic clock of the watchdog
+            start (bool): Whether to start the watchdog thread, else whoever drives the clock calls check()
+        """
+        self.safe_state = safe_state
+        self.watchdog = StalenessWatchdog(self, stale_after, lost_after, grace,
+                                          on_fallback=self.enter_safe_behavior, clock=clock)
+        if start:
+            self.watchdog.start()
+    
+    def watch_heartbeats(self, hang_detector):
+        """
+        Restarts scripts that beat through the heartbeat module and then stay
+        silent for longer than the detector's deadline.
+        
+        Args:
+            hang_detector: A started hang_detector.HangDetector
+        """
+        self.hang_detector = hang_detector
+        hang_detector.on_hang = self.on_heartbeat_lost
+    
+    def on_heartbeat_lost(self, watch, silence):
+        """
+        Called by the hang detector, restarts the script off the detector thread.
+        
+        Args:
+            watch: The heartbeat watch of the hung script
+            silence: Seconds since its last beat
+        """
+        threading.Thread(target=self.restart_hung_script, args=(watch,), daemon=True).start()
+    
+    def restart_hung_script(self, watch):
+        """Restarts the script of the current state if *watch* still belongs to it."""
+        last_state = self.state
+        if self.heartbeat is not watch or self.current_state is None or last_state is None:
+            return
+        logger.warning(f"Script {watch.script} stopped beating (PID: {watch.pid}), restarting it")
+        # Checked again under the process lock, a transition may launch a new script meanwhile
+        self.handle_state_change(self.current_state, last_state, hung_watch=watch)
+    
+    def stop_watching_heartbeat(self):
+        """Stops judging the current script's heartbeat, if any."""
+        if self.hang_detector is not None:
+            self.hang_detector.unwatch(self.heartbeat)
+        self.heartbeat = None
+    
+    def enter_safe_behavior(self, silence):
+        """
+        Called by the watchdog when the GameController stayed silent too long.
+        
+        Args:
+            silence: Seconds since the last packet, None if there never was one
+        """
+        last_state = self.state
+        # The first packet after recovery has to trigger a transition again, unless
+        # it is the safe state and its script already runs
+        if self.safe_state is not None and last_state is not None:
+            logger.warning(f"Falling back to the script of state {self.safe_state}")
+            self.current_state = self.safe_state
+            if not self.handle_state_change(self.safe_state, last_state) and self.current_state == self.safe_state:
+                self.current_state = None
+        else:
+            logger.warning("Falling back to no script, stopping the current one")
+            self.current_state = None
+            with self.process_lock:
+                self.terminate_current_process()
+    
+    def push_state_update(self, state):
+        """
+        Sends the fields that changed since the last packet to the running script.
+        
+        Args:
+            state: The game state received from GameController
+        """
+        with self.channel_lock:
+            if self.state_channel is None:
+                return
+            if not self.state_channel.push(snapshot_from_state(state, self.team, self.player)):
+                # The script exited, nobody is listening anymore
+                self.state_channel.close()
+                self.state_channel = None
+    
+    def close_state_channel(self):
+        """Closes the channel to the current script, if any."""
+        with self.channel_lock:
+            if self.state_channel is not None:
+                self.state_channel.close()
+                self.state_channel = None
+    
     def terminate_current_process(self):
         """Safely terminates the currently running process, if any."""
+        self.close_state_channel()
+        self.stop_watching_heartbeat()
         if self.current_process:
+            CHILD_RESTARTS.inc()
             try:
                 logger.info(f"Terminating previous process (PID: {self.current_process.pid})")
                 
-                # On Windows, terminate() is the only option
-                if os.name == 'nt':
-                    self.current_process.terminate()
-                else:
-                    # On Linux/Unix we can try SIGTERM first, then SIGKILL
-                    os.kill(self.current_process.pid, signal.SIGTERM)
-                    
-                    # Give it a moment to terminate gracefully
-                    start_time = time.time()
-                    while time.time() - start_time < 1.0:
-                        if self.current_process.poll() is not None:
-                            break
-                        time.sleep(0.1)
-                    
-                    # If still running, force kill
-                    if self.current_process.poll() is None:
-                        logger.warning(f"Process didn't terminate, sending SIGKILL to PID: {self.current_process.pid}")
-                        os.kill(self.current_process.pid, signal.SIGKILL)
+                # SIGTERM first (TerminateProcess on Windows), SIGKILL if it
+                # does not exit within a second
+                self.current_process.terminate()
+                try:
+                    self.current_process.wait(timeout=1.0)
+                except subprocess.TimeoutExpired:
+                    logger.warning(f"Process didn't terminate, sending SIGKILL to PID: {self.current_process.pid}")
+                    self.current_process.kill()
                 
                 # Wait for process to finish to avoid zombies
                 self.current_process.wait(timeout=1.0)
-                logger.debug(f"Process terminated with return code: {self.current_process.returncode}")
+                logger.debug(f"Process terminated with return code: {self.current_process.returncode} "
+                             f"(PID: {self.current_process.pid})")
                 
             except subprocess.TimeoutExpired:
                 logger.error("Process termination timed out")
@@ -209,8 +379,20 @@ class GameStateHandler(GameStateReceiver):
         """Stop the handler and clean up resources."""
         logger.info("Stopping GameStateHandler")
         self.running = False
+        if self.watchdog is not None:
+            self.watchdog.stop()
         self.terminate_current_process()
+        if self.hang_detector is not None:
+            self.hang_detector.stop()
+            logger.info("Script loop lag:")
+            self.hang_detector.lag_tracker.print_statistics(logger)
+        if self.script_index is not None:
+            self.script_index.stop()
+            logger.info("Script compile times, off the transition path:")
+            self.script_index.compile_times.print_statistics(logger)
         super(GameStateHandler, self).stop()
+        self.delay_stats.print_statistics(logger)
+        self.sequence.print_statistics(logger)
 
 
 def create_dummy_scripts():
@@ -225,6 +407,9 @@ import sys
 import time
 import argparse
 
+import heartbeat
+from state_channel import StateChannelReader
+
 parser = argparse.ArgumentParser()
 parser.add_argument('--team', type=int, required=True)
 parser.add_argument('--player', type=int, required=True)
@@ -235,15 +420,23 @@ parser.add_argument('--secondary-state', type=str, required=True)
 
 args = parser.parse_args()
 
-print(f"Running state {args.state} script for team {args.team}, player {args.player}")
-print(f"First half: {args.first_half}, Kick-off team: {args.kick_off_team}, Secondary state: {args.secondary_state}")
+print(f"Running state {{args.state}} script for team {{args.team}}, player {{args.player}}")
+print(f"First half: {{args.first_half}}, Kick-off team: {{args.kick_off_team}}, Secondary state: {{args.secondary_state}}")
 
 # Simulate some work
+# Live updates of the game, the argv values above are only the launch snapshot
+channel = StateChannelReader.from_env()
+
 for i in range(10):
-    print(f"State {args.state} working... {i+1}/10")
-    time.sleep(1)
+    snapshot = channel.latest()
+    if snapshot:
+        print(f"State {{args.state}} working... {{i+1}}/10, {{snapshot['seconds_remaining']}} s remaining, "
+              f"score {{snapshot['own_score']}}:{{snapshot['opponent_score']}}")
+    else:
+        print(f"State {{args.state}} working... {{i+1}}/10")
+    heartbeat.sleep(1)
     
-print(f"State {args.state} script completed")
+print(f"State {{args.state}} script completed")
 """)
             print(f"Created dummy script: {script_name}")
             # Make the script executable on Unix/Linux
@@ -257,15 +450,60 @@ if __name__ == "__main__":
     parser.add_argument('--player', type=int, default=1, help="Player number (default: 1)")
     parser.add_argument('--scripts-dir', type=str, default=".", help="Directory containing state scripts")
     parser.add_argument('--create-dummy-scripts', action='store_true', help="Create dummy scripts for testing")
+    parser.add_argument('--drain', action='store_true',
+                        help="After a stall only handle the newest queued packet")
+    parser.add_argument('--drop-late', action='store_true',
+                        help="Drop duplicate and out-of-order packets before parsing")
+    parser.add_argument('--ring', action='store_true',
+                        help="Parse and dispatch packets from a ring buffer off the receive thread")
+    parser.add_argument('--record', type=str, default=None,
+                        help="Record all packets into this capture file (implies --ring)")
+    parser.add_argument('--shared-state', type=str, default=None,
+                        help="Publish the latest game state in this shared memory block")
+    parser.add_argument('--store', type=str, default=None,
+                        help="Keep every decoded packet in a columnar match store in this directory")
+    parser.add_argument('--game-clock', action='store_true',
+                        help="Interpolate the GC timers between packets")
+    add_watchdog_arguments(parser)
+    add_heartbeat_arguments(parser)
+    add_hot_reload_arguments(parser)
+    add_socket_arguments(parser)
+    log_pipeline.add_logging_arguments(parser)
+    parser.add_argument('--safe-state', type=int, default=None, choices=[s.value for s in GameStates],
+                        help="State whose script runs once the GameController link is lost (default: stop the script)")
+    metrics.add_metrics_arguments(parser)
     
     args = parser.parse_args()
+    log_pipeline.setup_from_args(args, LOG_FORMAT)
     
     # Create dummy scripts if requested
     if args.create_dummy_scripts:
         create_dummy_scripts()
     
+    metrics_server = metrics.start_from_args(args)
+    
     try:
-        handler = GameStateHandler(args.team, args.player, args.scripts_dir)
+        handler = GameStateHandler(args.team, args.player, args.scripts_dir,
+                                   socket_profile=profile_from_args(args))
+        
+        handler.start_watchdog(args.stale_after, args.lost_after, args.lost_grace, args.safe_state)
+        hang_detector = detector_from_args(args)
+        if hang_detector is not None:
+            handler.watch_heartbeats(hang_detector)
+        handler.script_index = index_from_args(args, {
+            os.path.dirname(os.path.abspath(os.path.join(args.scripts_dir, script))) for script in SCRIPTS.values()})
+        handler.sequence.drop_late = args.drop_late
+        if args.drain:
+            handler.enable_drain()
+        if args.ring or args.record:
+            from packet_ring import PacketRing
+            handler.attach_ring(PacketRing(), args.record)
+        if args.shared_state:
+            handler.publish_shared_state(args.shared_state)
+        if args.store:
+            handler.record_match(args.store)
+        if args.game_clock:
+            handler.attach_game_clock()
         
         # Run the receiver in the main thread
         handler.receive_forever()
@@ -0,0 +1,222 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+"""
+Notices state scripts that hang while their process is still alive.
+
+``poll()`` cannot tell a script blocked in a serial read from one at work,
+so each script gets the write end of a heartbeat pipe and beats through
+:mod:`heartbeat` every ``interval``.  One thread serves every script: it
+selects on all heartbeat pipes and advances a :class:`TimerWheel` holding a
+single deadline timer per script.  The timer is not moved on every beat, when
+it fires early (the script beat meanwhile) it is re-armed at the last beat
+plus the deadline, so a script beating ten times a second costs a wheel
+operation per deadline, not per beat.
+
+Watching is opt-in twice: the handler only passes a pipe with a deadline
+set, and a script's deadline is only armed after its first beat, so scripts
+that do not know about heartbeats keep running untouched::
+
+    detector = HangDetector(deadline=1.0, on_hang=restart).start()
+    watch = detector.watch("playing_state.py")
+    process = subprocess.Popen(cmd, pass_fds=watch.pass_fds, env=dict(os.environ, **watch.env()))
+    detector.spawned(watch, process)
+    ...
+    detector.unwatch(watch)
+
+Each beat carries the script's monotonic time, how much later than
+``interval`` it came is recorded per script as its loop lag.
+"""
+
+import os
+import time
+import logging
+import selectors
+import threading
+
+from heartbeat import HEARTBEAT_FD_ENV, HEARTBEAT_INTERVAL_ENV
+from latency import StageLatencyTracker
+from metrics import REGISTRY
+from timer_wheel import TimerWheel
+
+logger = logging.getLogger('hang_detector')
+
+# Seconds between beats the scripts are asked for
+INTERVAL = 0.1
+READ_SIZE = 4096
+
+SCRIPT_HANGS = REGISTRY.counter("gc_script_hangs", "State scripts whose heartbeat stopped for longer than the deadline")
+
+
+class Watch(object):
+    """ The heartbeat pipe of one script """
+
+    def __init__(self, script, interval):
+        self.script = script
+        self.interval = interval
+        self.read_fd, self.write_fd = os.pipe()
+        self.pid = None
+        self.buffer = b""
+        self.beats = 0
+        # Monotonic arrival and script side time of the last beat
+        self.last_beat = None
+        self.last_stamp = None
+        self.timer = None
+        self.hung = False
+        self.closed = False
+
+    @property
+    def pass_fds(self):
+        return (self.write_fd,)
+
+    def env(self):
+        """Environment variables telling the script where and how often to beat"""
+        return {HEARTBEAT_FD_ENV: str(self.write_fd), HEARTBEAT_INTERVAL_ENV: str(self.interval)}
+
+    def silence(self, now=None):
+        """Seconds since the last beat, None before the first one"""
+        if self.last_beat is None:
+            return None
+        return (now if now is not None else time.monotonic()) - self.last_beat
+
+
+class HangDetector(object):
+    """ Watches the heartbeats of any number of scripts from one thread, see the module documentation """
+
+    def __init__(self, deadline, interval=INTERVAL, on_hang=None, tick=0.01):
+        self.deadline = deadline
+        self.interval = interval
+        # Called as on_hang(watch, silence) from the detector thread
+        self.on_hang = on_hang
+        # One histogram per script, "stage" is the script name
+        self.lag_tracker = StageLatencyTracker(stages=())
+        self.wheel = TimerWheel(tick)
+        self.selector = selectors.DefaultSelector()
+        # Registrations are only touched by the detector thread
+        self._pending = []
+        self._pending_lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def watch(self, script):
+        """A new heartbeat pipe for *script*, to be passed to its process"""
+        watch = Watch(script, self.interval)
+        with self._pending_lock:
+            self._pending.append(watch)
+        return watch
+
+    def spawned(self, watch, process):
+        """The script runs, closes our copy of the write end so its exit shows as end of file"""
+        watch.pid = process.pid
+        self._close_write_end(watch)
+
+    def unwatch(self, watch):
+        """Stops judging the script, e.g. because it is being replaced. Safe to call more than once"""
+        if watch is None or watch.closed:
+            return
+        watch.closed = True
+        if watch.timer is not None:
+            watch.timer.cancel()
+        self._close_write_end(watch)
+        with self._pending_lock:
+            self._pending.append(watch)
+
+    def _close_write_end(self, watch):
+        if watch.write_fd is not None:
+            os.close(watch.write_fd)
+            watch.write_fd = None
+
+    def _apply_pending(self):
+        with self._pending_lock:
+            pending, self._pending = self._pending, []
+        for watch in pending:
+            if watch.read_fd is None:
+                continue
+            registered = watch.read_fd in self.selector.get_map()
+            if watch.closed:
+                if registered:
+                    self.selector.unregister(watch.read_fd)
+                os.close(watch.read_fd)
+                watch.read_fd = None
+            elif not registered:
+                self.selector.register(watch.read_fd, selectors.EVENT_READ, watch)
+
+    def _read(self, watch):
+        try:
+            data = os.read(watch.read_fd, READ_SIZE)
+        except OSError:
+            data = b""
+        if not data:
+            # The script exited, whoever started it deals with that
+            self.unwatch(watch)
+            self._apply_pending()
+            return
+        now = self.wheel.clock()
+        lines = (watch.buffer + data).split(b"\n")
+        watch.buffer = lines.pop()
+        for line in lines:
+            try:
+                stamp = float(line)
+            except ValueError:
+                continue
+            if watch.last_stamp is not None:
+                self.lag_tracker.record(watch.script, (stamp - watch.last_stamp - watch.interval) * 1000)
+            watch.last_stamp = stamp
+            watch.beats += 1
+        watch.last_beat = now
+        if watch.timer is None and not watch.hung:
+            watch.timer = self.wheel.call_at(now + self.deadline, self._check, watch)
+
+    def _check(self, watch):
+        watch.timer = None
+        if watch.closed or watch.hung:
+            return
+        due = watch.last_beat + self.deadline
+        now = self.wheel.clock()
+        if due > now:
+            # It beat since the timer was armed
+            watch.timer = self.wheel.call_at(due, self._check, watch)
+            return
+        watch.hung = True
+        silence = watch.silence(now)
+        SCRIPT_HANGS.inc()
+        logger.warning(f"{watch.script} (PID: {watch.pid}) missed its heartbeat for {silence:.2f} s")
+        if self.on_hang is not None:
+            self.on_hang(watch, silence)
+
+    def run(self):
+        while not self.stop_event.is_set():
+            self._apply_pending()
+            for key, _ in self.selector.select(self.wheel.tick):
+                if not key.data.closed:
+                    self._read(key.data)
+            self.wheel.advance()
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name="hang_detector", daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join(timeout=1.0)
+
+
+def add_heartbeat_arguments(parser):
+    """Adds the opt-in heartbeat options to an argument parser"""
+    parser.add_argument('--heartbeat-deadline', type=float, default=None,
+                        help="restart a script that beat once and then stays silent for this many seconds "
+                             "(default: no heartbeats)")
+    parser.add_argument('--heartbeat-interval', type=float, default=INTERVAL,
+                        help=f"seconds between the beats scripts are asked for (default: {INTERVAL})")
+
+
+def detector_from_args(args, on_hang=None):
+    """A started :class:`HangDetector` exporting its loop lag, None unless --heartbeat-deadline was given"""
+    if args.heartbeat_deadline is None:
+        return None
+    detector = HangDetector(args.heartbeat_deadline, args.heartbeat_interval, on_hang).start()
+    REGISTRY.stage_histograms("gc_script_loop_lag_seconds", "How much later than the interval each script's heartbeat came",
+                              detector.lag_tracker)
+    return detector
@@ -0,0 +1,59 @@
+# heartbeat.py
+"""
+Tiny helper for state scripts to show the handler they are not stuck.
+
+A handler started with a heartbeat deadline passes the write end of a pipe
+in GC_HEARTBEAT_FD and the expected beat interval (seconds) in
+GC_HEARTBEAT_INTERVAL. Once a script beat, the handler restarts it if it
+stays silent for longer than the deadline, e.g. while blocked in a serial
+read. Scripts that never beat are never judged, and without the variables
+every call is a no-op, so scripts keep working when started by hand.
+
+    import heartbeat
+    while True:
+        act()
+        heartbeat.sleep(0.5)    # beats every interval while sleeping
+
+Long computations call heartbeat.beat() now and then instead.
+"""
+
+import os
+import time
+
+HEARTBEAT_FD_ENV = "GC_HEARTBEAT_FD"
+HEARTBEAT_INTERVAL_ENV = "GC_HEARTBEAT_INTERVAL"
+
+_fd = int(os.environ[HEARTBEAT_FD_ENV]) if os.environ.get(HEARTBEAT_FD_ENV) else None
+interval = float(os.environ.get(HEARTBEAT_INTERVAL_ENV) or 0.1)
+# Monotonic time of the last beat, None before the first
+_last_beat = None
+
+
+def beat():
+    """Tells the handler the script is alive, with the monotonic time for its loop lag"""
+    global _fd, _last_beat
+    if _fd is None:
+        return
+    _last_beat = time.monotonic()
+    try:
+        os.write(_fd, f"{_last_beat:.6f}\n".encode("ascii"))
+    except OSError:
+        # The handler went away, stop trying
+        _fd = None
+
+
+def sleep(seconds):
+    """time.sleep that beats every interval, counted across calls so back to back
+    sleeps do not beat twice in a row"""
+    deadline = time.monotonic() + seconds
+    while _fd is not None:
+        now = time.monotonic()
+        if _last_beat is None or now - _last_beat >= interval:
+            beat()
+        if now >= deadline:
+            return
+        next_beat = _last_beat + interval if _last_beat is not None else deadline
+        time.sleep(max(min(next_beat, deadline) - now, 0.0))
+    remaining = deadline - time.monotonic()
+    if remaining > 0:
+        time.sleep(remaining)
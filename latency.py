@@ -0,0 +1,222 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+"""
+Constant-memory latency histograms for the game state pipeline.
+
+Values are bucketed HDR-style: exact below 2^SUB_BUCKET_BITS microseconds,
+then every power of two is split into 2^(SUB_BUCKET_BITS - 1) linear
+sub-buckets, which keeps the relative error of every reported percentile
+below ~3%.  Recording is O(1), percentile queries are O(buckets).
+
+Each recording thread writes into its own shard of the histogram, so the
+hot path never takes a lock; readers merge the shards when asked.
+"""
+
+import threading
+
+# Pipeline stages measured by the handlers, in pipeline order
+STAGE_RECEIVE = "receive"
+STAGE_PARSE = "parse"
+STAGE_DISPATCH = "dispatch"
+STAGE_TERMINATE = "terminate"
+STAGE_SPAWN = "spawn"
+STAGE_FIRST_OUTPUT = "first_output"
+
+# Where the receive delay of a packet went, see delay_estimator
+STAGE_NETWORK = "network"  # queuing the network added to the GC's schedule
+STAGE_HANDLER = "handler"  # kernel receive to the end of on_new_gamestate
+DELAY_STAGES = (STAGE_NETWORK, STAGE_HANDLER)
+
+STAGES = (
+    STAGE_RECEIVE,
+    STAGE_PARSE,
+    STAGE_DISPATCH,
+    STAGE_TERMINATE,
+    STAGE_SPAWN,
+    STAGE_FIRST_OUTPUT,
+)
+
+PERCENTILES = (50.0, 90.0, 99.0, 99.9)
+
+SUB_BUCKET_BITS = 5
+SUB_BUCKET_COUNT = 1 << SUB_BUCKET_BITS
+SUB_BUCKET_HALF = SUB_BUCKET_COUNT >> 1
+# Largest shift we keep apart; anything above lands in the last bucket (~1.2 h)
+MAX_SHIFT = 28
+BUCKET_COUNT = SUB_BUCKET_COUNT + MAX_SHIFT * SUB_BUCKET_HALF
+
+
+def _bucket_index(value_us):
+    """Maps a non-negative integer value in microseconds to its bucket"""
+    if value_us < SUB_BUCKET_COUNT:
+        return value_us
+    shift = value_us.bit_length() - SUB_BUCKET_BITS
+    if shift > MAX_SHIFT:
+        return BUCKET_COUNT - 1
+    return SUB_BUCKET_COUNT + (shift - 1) * SUB_BUCKET_HALF + (value_us >> shift) - SUB_BUCKET_HALF
+
+
+def _bucket_bounds(index):
+    """Returns the (lowest, highest) microsecond value stored in a bucket"""
+    if index < SUB_BUCKET_COUNT:
+        return index, index
+    shift = (index - SUB_BUCKET_COUNT) // SUB_BUCKET_HALF + 1
+    top = (index - SUB_BUCKET_COUNT) % SUB_BUCKET_HALF + SUB_BUCKET_HALF
+    return top << shift, ((top + 1) << shift) - 1
+
+
+class _Shard(object):
+    """ Per-thread part of a histogram, only ever written by its owner """
+
+    __slots__ = ("counts", "count", "total", "total_squares", "min", "max")
+
+    def __init__(self):
+        self.counts = [0] * BUCKET_COUNT
+        self.count = 0
+        self.total = 0.0
+        self.total_squares = 0.0
+        self.min = None
+        self.max = None
+
+
+class LatencyHistogram(object):
+    """ HDR-style histogram of latencies given in milliseconds """
+
+    def __init__(self):
+        self._local = threading.local()
+        self._shards = []
+        self.latest = None
+        # Only taken the first time a thread records a value
+        self._register_lock = threading.Lock()
+
+    def _shard(self):
+        shard = getattr(self._local, "shard", None)
+        if shard is None:
+            shard = _Shard()
+            with self._register_lock:
+                self._shards.append(shard)
+            self._local.shard = shard
+        return shard
+
+    def record(self, latency_ms):
+        """Records a latency measurement in milliseconds"""
+        if latency_ms < 0:
+            latency_ms = 0.0
+        shard = self._shard()
+        # min and max first, a reader that sees the count must find them set
+        if shard.min is None or latency_ms < shard.min:
+            shard.min = latency_ms
+        if shard.max is None or latency_ms > shard.max:
+            shard.max = latency_ms
+        shard.counts[_bucket_index(int(latency_ms * 1000))] += 1
+        shard.total += latency_ms
+        shard.total_squares += latency_ms * latency_ms
+        shard.count += 1
+        # A single store, the last writer wins
+        self.latest = latency_ms
+
+    def buckets(self):
+        """Returns the merged per-bucket counts of all shards"""
+        merged = [0] * BUCKET_COUNT
+        for shard in list(self._shards):
+            counts = shard.counts
+            for index in range(BUCKET_COUNT):
+                if counts[index]:
+                    merged[index] += counts[index]
+        return merged
+
+    def total(self):
+        """Returns the sum of all recorded latencies in milliseconds"""
+        return sum(shard.total for shard in list(self._shards))
+
+    @staticmethod
+    def bucket_upper_bound(index):
+        """Upper bound of a bucket in milliseconds"""
+        return (_bucket_bounds(index)[1] + 1) / 1000.0
+
+    def get_statistics(self):
+        """Returns count, mean, std dev, min, max and percentiles, or None if empty"""
+        shards = list(self._shards)
+        count = sum(shard.count for shard in shards)
+        if not count:
+            return None
+
+        total = sum(shard.total for shard in shards)
+        total_squares = sum(shard.total_squares for shard in shards)
+        mean = total / count
+        variance = (total_squares - count * mean * mean) / (count - 1) if count > 1 else 0.0
+
+        buckets = self.buckets()
+        # The shards may have moved on while merging, rank against the merged view
+        bucket_total = sum(buckets)
+        percentiles = {}
+        ranks = [(p, max(1, int(p / 100.0 * bucket_total + 0.5))) for p in PERCENTILES]
+        seen = 0
+        rank_index = 0
+        for index, bucket_count in enumerate(buckets):
+            if not bucket_count:
+                continue
+            seen += bucket_count
+            while rank_index < len(ranks) and seen >= ranks[rank_index][1]:
+                low, high = _bucket_bounds(index)
+                percentiles[ranks[rank_index][0]] = (low + high) / 2000.0
+                rank_index += 1
+            if rank_index == len(ranks):
+                break
+
+        lowest = min((shard.min for shard in shards if shard.min is not None), default=0.0)
+        highest = max((shard.max for shard in shards if shard.max is not None), default=0.0)
+        # Bucket midpoints may lie outside of what was actually observed
+        for p, value in percentiles.items():
+            percentiles[p] = min(max(value, lowest), highest)
+
+        return {
+            'count': count,
+            'latest': self.latest,
+            'average': mean,
+            'median': percentiles.get(50.0),
+            'p50': percentiles.get(50.0),
+            'p90': percentiles.get(90.0),
+            'p99': percentiles.get(99.0),
+            'p99.9': percentiles.get(99.9),
+            'min': lowest,
+            'max': highest,
+            'std_dev': max(variance, 0.0) ** 0.5,
+        }
+
+
+class StageLatencyTracker(object):
+    """ Keeps one :class:`LatencyHistogram` per pipeline stage """
+
+    def __init__(self, stages=STAGES):
+        self.stages = tuple(stages)
+        self.histograms = {stage: LatencyHistogram() for stage in self.stages}
+
+    def record(self, stage, latency_ms):
+        """Records a measurement for a stage, unknown stages are created on first use"""
+        histogram = self.histograms.get(stage)
+        if histogram is None:
+            histogram = self.histograms.setdefault(stage, LatencyHistogram())
+        histogram.record(latency_ms)
+
+    def get_statistics(self):
+        """Returns the statistics of every stage that has measurements"""
+        result = {}
+        for stage, histogram in list(self.histograms.items()):
+            stats = histogram.get_statistics()
+            if stats:
+                result[stage] = stats
+        return result
+
+    def print_statistics(self, logger):
+        """Logs one line per stage with the percentile breakdown"""
+        stats = self.get_statistics()
+        if not stats:
+            return
+        logger.info("=== LATENCY STATISTICS (ms) ===")
+        for stage, values in stats.items():
+            logger.info(f"{stage:>12}: n={values['count']} p50={values['p50']:.2f} "
+                        f"p90={values['p90']:.2f} p99={values['p99']:.2f} "
+                        f"p99.9={values['p99.9']:.2f} max={values['max']:.2f}")
+        logger.info("===============================")
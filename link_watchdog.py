@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+"""
+Notices when the GameController goes silent and falls back to a safe behavior.
+
+The watchdog runs on its own thread and never touches the receive path: it
+samples ``receiver.state``, which the receiver replaces with a new object for
+every valid packet, and timestamps changes with the monotonic clock itself.
+Its resolution is therefore one ``period``, which is plenty for thresholds of
+a second and more.
+
+Link states and the events emitted on entering them::
+
+    FRESH --stale_after--> STALE --lost_after--> LOST --grace--> FALLBACK
+      ^                                                             |
+      +---------------------- next valid packet --------------------+
+"""
+
+import time
+import logging
+import threading
+
+from metrics import REGISTRY
+
+logger = logging.getLogger('link_watchdog')
+
+LINK_FRESH = "fresh"
+LINK_STALE = "stale"
+LINK_LOST = "lost"
+LINK_FALLBACK = "fallback"
+
+STALE_EVENTS = REGISTRY.counter("gc_link_stale", "Times the GameController went quiet for longer than the stale threshold")
+LOST_EVENTS = REGISTRY.counter("gc_link_lost", "Times the GameController link was considered lost")
+FALLBACKS = REGISTRY.counter("gc_link_fallbacks", "Times the handler switched to the safe behavior")
+
+
+class StalenessWatchdog(object):
+    """
+    Watches a :class:`receiver.GameStateReceiver` for missing packets.
+
+    Callbacks are called from the watchdog thread with the seconds since the
+    last packet (None if there never was one):
+
+        on_stale, on_lost, on_fallback, on_recovered
+    """
+
+    def __init__(self, receiver, stale_after=1.5, lost_after=5.0, grace=5.0, period=0.1,
+                 on_stale=None, on_lost=None, on_fallback=None, on_recovered=None, clock=time.monotonic):
+        if not 0 < stale_after <= lost_after:
+            raise ValueError("Thresholds must satisfy 0 < stale_after <= lost_after")
+        self.receiver = receiver
+        self.stale_after = stale_after
+        self.lost_after = lost_after
+        self.grace = grace
+        self.period = period
+        self.on_stale = on_stale
+        self.on_lost = on_lost
+        self.on_fallback = on_fallback
+        self.on_recovered = on_recovered
+        self.clock = clock
+
+        self.link = LINK_FRESH
+        self.last_state = None
+        self.last_packet = clock()
+        self.seen_packet = False
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def silence(self):
+        """Seconds since the last packet was noticed (since start if there was none)"""
+        return self.clock() - self.last_packet
+
+    def check(self):
+        """Samples the receiver once and emits events, returns the link state"""
+        now = self.clock()
+        state = self.receiver.state
+        if state is not None and state is not self.last_state:
+            self.last_state = state
+            self.last_packet = now
+            self.seen_packet = True
+            if self.link != LINK_FRESH:
+                logger.info(f"GameController link recovered (was {self.link})")
+                self._set_link(LINK_FRESH, self.on_recovered, 0.0)
+            return self.link
+
+        silence = now - self.last_packet
+        if self.link == LINK_FRESH and silence >= self.stale_after:
+            logger.warning(f"No GameController packet for {silence:.1f}s, state is stale")
+            STALE_EVENTS.inc()
+            self._set_link(LINK_STALE, self.on_stale, silence)
+        if self.link == LINK_STALE and silence >= self.lost_after:
+            logger.error(f"No GameController packet for {silence:.1f}s, link lost; "
+                         f"keeping the last known state for {self.grace:.1f}s")
+            LOST_EVENTS.inc()
+            self._set_link(LINK_LOST, self.on_lost, silence)
+        if self.link == LINK_LOST and silence >= self.lost_after + self.grace:
+            logger.error("GameController still silent, switching to the safe behavior")
+            FALLBACKS.inc()
+            self._set_link(LINK_FALLBACK, self.on_fallback, silence)
+        return self.link
+
+    def _set_link(self, link, callback, silence):
+        self.link = link
+        if callback is not None:
+            try:
+                callback(silence if self.seen_packet else None)
+            except Exception as e:
+                logger.exception(e)
+
+    def run(self):
+        while not self.stop_event.wait(self.period):
+            self.check()
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name="watchdog", daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join(timeout=1.0)
+
+
+def add_watchdog_arguments(parser):
+    """Adds the watchdog thresholds to an argument parser"""
+    parser.add_argument('--stale-after', type=float, default=1.5,
+                        help="Seconds without a packet before the state counts as stale (default: 1.5)")
+    parser.add_argument('--lost-after', type=float, default=5.0,
+                        help="Seconds without a packet before the link counts as lost (default: 5.0)")
+    parser.add_argument('--lost-grace', type=float, default=5.0,
+                        help="Seconds to keep the current script running after the link is lost (default: 5.0)")
@@ -0,0 +1,348 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+"""
+Streaming analysis of handler logs.
+
+Reads the logs of ``handler.py``, ``handler_old.py`` and ``handler_2014.py``
+(plain or gzip rotated, see :mod:`log_pipeline`) line by line, so a file of
+any size only costs one line of memory, and rebuilds the game state
+timeline from them:
+
+* dwell time per state,
+* per transition the reaction of the handler: packet received, old script
+  terminated, new script launched and started,
+* kill escalations (SIGKILL after an ignored SIGTERM, termination timeouts),
+* bursts of parse errors.
+
+Lines are recognized by their message, the three formats only differ in the
+prefix.  Summaries of repeats collapsed by the log pipeline
+(``... (×N in 10 s)``) only add to the parse error count, everything else
+they stand for was an unchanged state.  The result is written as JSON, or as one CSV file per table::
+
+    python log_analyzer.py logs/game_state_handler.log* --json report.json
+    python log_analyzer.py logs/*.log --csv reports/match
+"""
+
+import re
+import sys
+import csv
+import gzip
+import json
+import time
+import argparse
+
+from latency import LatencyHistogram
+
+STATE_NAMES = ("STATE_INITIAL", "STATE_READY", "STATE_SET", "STATE_PLAYING", "STATE_FINISHED")
+
+# Parse errors further apart than this start a new burst
+BURST_GAP = 2.0
+
+COLLAPSED = re.compile(r" \(×(\d+) in \d+ s\)$")
+STARTED_FOR = re.compile(r"^\[MONITOR\] (\S+) started for (\S+)")
+LAUNCHING = re.compile(r"^Launching script for state (\S+): (.*)$")
+
+# Messages that are neither needed nor rare, skipped before anything else is looked at
+NOISE = ("Script output: ", "unchanged, not restarting script", "Socket timeout")
+
+
+def open_log(path):
+    if path.endswith(".gz"):
+        return gzip.open(path, "rt", encoding="utf-8", errors="replace")
+    return open(path, "r", encoding="utf-8", errors="replace")
+
+
+def read_records(paths):
+    """
+    Yields (timestamp, level, message) for every timestamped line of the
+    files, in order. Lines without a timestamp (script prints, tracebacks)
+    are skipped, level is None for the bare receiver format.
+    """
+    day = None
+    midnight = 0.0
+    for path in paths:
+        with open_log(path) as f:
+            for line in f:
+                # "2025-06-02 16:06:18,237 ..."
+                if len(line) < 25 or line[4] != "-" or line[19] != ",":
+                    continue
+                if line[:10] != day:
+                    try:
+                        midnight = time.mktime(time.strptime(line[:10], "%Y-%m-%d"))
+                    except ValueError:
+                        continue
+                    day = line[:10]
+                try:
+                    timestamp = (midnight + int(line[11:13]) * 3600 + int(line[14:16]) * 60 + int(line[17:19])
+                                 + int(line[20:23]) / 1000.0)
+                except ValueError:
+                    continue
+
+                rest = line[24:].rstrip("\n")
+                if rest.startswith("- "):
+                    # handler_old / handler_2014: "- name - LEVEL - message"
+                    parts = rest[2:].split(" - ", 2)
+                    if len(parts) < 3:
+                        continue
+                    yield timestamp, parts[1], parts[2]
+                elif rest.startswith("["):
+                    # handler.py: "[LEVEL] message"
+                    end = rest.find("] ")
+                    if end < 0:
+                        continue
+                    yield timestamp, rest[1:end], rest[end + 2:]
+                else:
+                    yield timestamp, None, rest
+
+
+def state_name(token):
+    token = token.strip()
+    if token.isdigit():
+        value = int(token)
+        return STATE_NAMES[value] if value < len(STATE_NAMES) else f"UNKNOWN({value})"
+    return token
+
+
+class Transition(object):
+    """ One state change and the handler's reaction to it """
+
+    FIELDS = ("state", "previous", "received", "terminate_started", "terminated", "launched", "started",
+              "script", "killed")
+
+    def __init__(self, state, previous, received):
+        self.state = state
+        self.previous = previous
+        self.received = received
+        self.terminate_started = None
+        self.terminated = None
+        self.launched = None
+        self.started = None
+        self.script = None
+        self.killed = False
+
+    def latency_ms(self, milestone):
+        value = getattr(self, milestone)
+        return (value - self.received) * 1000 if value is not None else None
+
+    def as_dict(self):
+        row = {field: getattr(self, field) for field in self.FIELDS}
+        for milestone in ("terminated", "launched", "started"):
+            row[f"{milestone}_ms"] = self.latency_ms(milestone)
+        return row
+
+
+class TimelineAnalyzer(object):
+    """ Rebuilds the state timeline from a stream of (timestamp, level, message) """
+
+    def __init__(self, burst_gap=BURST_GAP):
+        self.burst_gap = burst_gap
+        self.lines = 0
+        self.sessions = 0
+        self.first_timestamp = None
+        self.last_timestamp = None
+        # state -> [seconds, intervals]
+        self.dwell = {}
+        self.current_state = None
+        self.current_since = None
+        self.transitions = []
+        self.pending = None
+        self.kills = []
+        self.parse_errors = 0
+        self.bursts = []
+        self.burst = None
+
+    def feed(self, timestamp, level, message):
+        self.lines += 1
+        if self.first_timestamp is None:
+            self.first_timestamp = timestamp
+        previous, self.last_timestamp = self.last_timestamp, timestamp
+        for noise in NOISE:
+            if noise in message:
+                return
+
+        if message.endswith(" s)"):
+            match = COLLAPSED.search(message)
+            if match:
+                # Summary of repeats written later, only the count is of use
+                if message.startswith("Parse Error") or message.startswith("Dropped "):
+                    self._parse_error(timestamp, int(match.group(1)))
+                return
+
+        if message.startswith("Received game state: "):
+            self._state(state_name(message[21:].split(" - ")[0]), timestamp)
+        elif message.startswith("Game state changed to: "):
+            # handler.py: "Game state changed to: NAME (value) at <receive time>"
+            name, _, received = message[23:].partition(" at ")
+            try:
+                timestamp = float(received)
+            except ValueError:
+                pass
+            self._state(state_name(name.split(" (")[0]), timestamp)
+        elif message.startswith("Terminating previous process"):
+            if self.pending is not None and self.pending.terminate_started is None:
+                self.pending.terminate_started = timestamp
+        elif message.startswith("Process terminated with return code") or \
+                (message.startswith("[MONITOR] ") and message.endswith(" terminated")):
+            if self.pending is not None and self.pending.terminated is None:
+                self.pending.terminated = timestamp
+        elif message.startswith("Launching script for state "):
+            match = LAUNCHING.match(message)
+            if self.pending is not None and match:
+                self.pending.launched = timestamp
+                self.pending.script = match.group(2)
+        elif message.startswith("Process started with PID"):
+            if self.pending is not None and self.pending.started is None:
+                self.pending.started = timestamp
+        elif message.startswith("[MONITOR] ") and " started for " in message:
+            match = STARTED_FOR.match(message)
+            if self.pending is not None and match:
+                self.pending.launched = self.pending.launched or timestamp
+                self.pending.started = timestamp
+                self.pending.script = match.group(1)
+        elif message.startswith("Process didn't terminate") or message == "Process termination timed out":
+            kind = "sigkill" if "SIGKILL" in message else "timeout"
+            self.kills.append({"timestamp": timestamp, "kind": kind, "state": self.current_state,
+                               "message": message})
+            if self.pending is not None:
+                self.pending.killed = True
+        elif message.startswith("Parse Error") or (message.startswith("Dropped ") and "foreign header" in message):
+            self._parse_error(timestamp, 1)
+        elif message.startswith("GameStateHandler initialized") or \
+                message.startswith("State monitor with latency tracking started"):
+            # A session that ended without saying so ended with its last line
+            self._end_session(previous)
+            self.sessions += 1
+        elif message.startswith("Stopping GameStateHandler") or message == "Shutting down...":
+            self._end_session(timestamp)
+
+    def _state(self, state, timestamp):
+        if state == self.current_state:
+            return
+        self._close_dwell(timestamp)
+        self.pending = Transition(state, self.current_state, timestamp)
+        self.transitions.append(self.pending)
+        self.current_state = state
+        self.current_since = timestamp
+
+    def _close_dwell(self, timestamp):
+        if self.current_state is None or timestamp is None:
+            return
+        entry = self.dwell.setdefault(self.current_state, [0.0, 0])
+        entry[0] += max(timestamp - self.current_since, 0.0)
+        entry[1] += 1
+
+    def _end_session(self, timestamp):
+        self._close_dwell(timestamp)
+        self.current_state = None
+        self.pending = None
+
+    def _parse_error(self, timestamp, count):
+        self.parse_errors += count
+        if self.burst is not None and timestamp - self.burst["end"] <= self.burst_gap:
+            self.burst["end"] = timestamp
+            self.burst["count"] += count
+            return
+        self.burst = {"start": timestamp, "end": timestamp, "count": count}
+        self.bursts.append(self.burst)
+
+    def finish(self):
+        self._end_session(self.last_timestamp)
+        return self
+
+    def summary(self):
+        reactions = {}
+        for milestone in ("terminated", "launched", "started"):
+            histogram = LatencyHistogram()
+            for transition in self.transitions:
+                value = transition.latency_ms(milestone)
+                if value is not None:
+                    histogram.record(value)
+            stats = histogram.get_statistics()
+            reactions[milestone] = {key: stats[key] for key in ("count", "p50", "p90", "p99", "max")} \
+                if stats else {"count": 0}
+        return {
+            "lines": self.lines,
+            "sessions": self.sessions,
+            "first": self.first_timestamp,
+            "last": self.last_timestamp,
+            "dwell": {state: {"seconds": seconds, "intervals": intervals}
+                      for state, (seconds, intervals) in sorted(self.dwell.items())},
+            "transitions": len(self.transitions),
+            "reaction_ms": reactions,
+            "kills": len(self.kills),
+            "parse_errors": self.parse_errors,
+            "parse_error_bursts": len(self.bursts),
+        }
+
+    def report(self):
+        return {
+            "summary": self.summary(),
+            "transitions": [transition.as_dict() for transition in self.transitions],
+            "kills": self.kills,
+            "parse_error_bursts": self.bursts,
+        }
+
+
+def analyze(paths, burst_gap=BURST_GAP):
+    """Runs the analyzer over log files (oldest first), returns it finished"""
+    analyzer = TimelineAnalyzer(burst_gap)
+    feed = analyzer.feed
+    for timestamp, level, message in read_records(paths):
+        feed(timestamp, level, message)
+    return analyzer.finish()
+
+
+def write_csv(analyzer, prefix):
+    """Writes <prefix>_transitions.csv, _dwell.csv, _kills.csv and _parse_errors.csv"""
+    tables = {
+        "transitions": [transition.as_dict() for transition in analyzer.transitions],
+        "dwell": [{"state": state, "seconds": seconds, "intervals": intervals}
+                  for state, (seconds, intervals) in sorted(analyzer.dwell.items())],
+        "kills": analyzer.kills,
+        "parse_errors": analyzer.bursts,
+    }
+    headers = {
+        "transitions": list(Transition.FIELDS) + ["terminated_ms", "launched_ms", "started_ms"],
+        "dwell": ["state", "seconds", "intervals"],
+        "kills": ["timestamp", "kind", "state", "message"],
+        "parse_errors": ["start", "end", "count"],
+    }
+    written = []
+    for name, rows in tables.items():
+        path = f"{prefix}_{name}.csv"
+        with open(path, "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=headers[name])
+            writer.writeheader()
+            writer.writerows(rows)
+        written.append(path)
+    return written
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Rebuild state timelines from handler logs")
+    parser.add_argument('logs', nargs='+', help="log files, oldest first, .gz is read transparently")
+    parser.add_argument('--json', type=str, default=None, help="write the report as JSON to this file, - for stdout")
+    parser.add_argument('--csv', type=str, default=None, help="write CSV tables with this path prefix")
+    parser.add_argument('--burst-gap', type=float, default=BURST_GAP,
+                        help="seconds between parse errors that still belong to one burst")
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    result = analyze(args.logs, args.burst_gap)
+    elapsed = time.perf_counter() - started
+
+    if args.csv:
+        for path in write_csv(result, args.csv):
+            print(f"Wrote {path}", file=sys.stderr)
+    if args.json:
+        if args.json == "-":
+            json.dump(result.report(), sys.stdout, indent=1)
+            print()
+        else:
+            with open(args.json, "w") as f:
+                json.dump(result.report(), f, indent=1)
+    if not args.json and not args.csv:
+        json.dump(result.summary(), sys.stdout, indent=1)
+        print()
+    print(f"Analyzed {result.lines} lines in {elapsed:.2f} s", file=sys.stderr)
@@ -0,0 +1,267 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+"""
+Non-blocking logging: records go through a queue to one writer thread.
+
+Logging calls only turn the record into plain text and put it on a bounded
+queue; if the queue is full the record is dropped and counted instead of
+blocking the caller, so the receive thread never waits for a terminal or a
+disk.  The writer thread does all the I/O:
+
+* Runs of the same message from the same logger are collapsed.  The first
+  one is written right away, the rest of the run is summarized as
+  ``<message> (×N in 10 s)`` as soon as the logger says something else or
+  the window is over, so an A, B, A sequence is never reordered.
+* Console and file output are flushed once per batch of records, not per
+  record.
+* The optional log file rotates by size, rotated files are gzip compressed.
+
+Entry points call :func:`setup` (or :func:`setup_from_args`) once, which
+routes the root logger and therefore every module through the pipeline.
+"""
+
+import os
+import time
+import queue
+import atexit
+import logging
+import threading
+import logging.handlers
+
+from metrics import REGISTRY
+
+LOG_RECORDS_DROPPED = REGISTRY.counter("gc_log_records_dropped", "Log records dropped because the log queue was full")
+LOG_RECORDS_COLLAPSED = REGISTRY.counter("gc_log_records_collapsed", "Repeated log records folded into a summary")
+
+DEFAULT_FORMAT = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+QUEUE_SIZE = 10000
+DEDUP_WINDOW = 10.0
+MAX_BYTES = 5 * 1024 * 1024
+BACKUP_COUNT = 5
+# The writer wakes up at least this often to close dedup windows
+WRITER_PERIOD = 0.5
+
+_STOP = object()
+
+
+class QueueingHandler(logging.Handler):
+    """ Puts records on the pipeline queue, never blocks """
+
+    def __init__(self, log_queue):
+        super(QueueingHandler, self).__init__()
+        self.queue = log_queue
+
+    def emit(self, record):
+        try:
+            # Render the arguments now, they may change after the call returns
+            record.msg = record.getMessage()
+            record.args = None
+            if record.exc_info:
+                record.exc_text = logging.Formatter().formatException(record.exc_info)
+                record.exc_info = None
+            self.queue.put_nowait(record)
+        except queue.Full:
+            LOG_RECORDS_DROPPED.inc()
+        except Exception:
+            self.handleError(record)
+
+
+class BatchFlushMixin(object):
+    """ Stream handlers that leave flushing to the writer thread """
+
+    def flush(self):
+        pass
+
+    def flush_batch(self):
+        super(BatchFlushMixin, self).flush()
+
+
+class BatchStreamHandler(BatchFlushMixin, logging.StreamHandler):
+    pass
+
+
+class CompressingRotatingFileHandler(BatchFlushMixin, logging.handlers.RotatingFileHandler):
+    """ Size based rotation, rotated files are gzipped """
+
+    def __init__(self, filename, max_bytes=MAX_BYTES, backup_count=BACKUP_COUNT):
+        super(CompressingRotatingFileHandler, self).__init__(filename, maxBytes=max_bytes,
+                                                             backupCount=backup_count, delay=True)
+        self.namer = lambda name: name + ".gz"
+        self.rotator = _gzip_rotator
+
+
+def _gzip_rotator(source, destination):
+    # Only needed once a file rotates, not worth their import on start
+    import gzip
+    import shutil
+    with open(source, "rb") as src, gzip.open(destination, "wb") as dst:
+        shutil.copyfileobj(src, dst)
+    os.remove(source)
+
+
+class _Repeat(object):
+    __slots__ = ("key", "started", "first_created", "count", "last")
+
+    def __init__(self, key, started, first_created):
+        self.key = key
+        self.started = started
+        self.first_created = first_created
+        self.count = 0
+        self.last = None
+
+
+class LogWriter(threading.Thread):
+    """ Drains the queue into the output handlers, collapsing repeats """
+
+    def __init__(self, log_queue, handlers, window=DEDUP_WINDOW, clock=time.monotonic):
+        super(LogWriter, self).__init__(name="log_writer", daemon=True)
+        self.queue = log_queue
+        self.handlers = handlers
+        self.window = window
+        self.clock = clock
+        # logger -> _Repeat of its current run of (level, message)
+        self.repeats = {}
+
+    def run(self):
+        while True:
+            try:
+                record = self.queue.get(timeout=WRITER_PERIOD)
+            except queue.Empty:
+                self._close_windows(self.clock())
+                self._flush()
+                continue
+            # Take everything that is queued already, then flush once
+            while True:
+                if record is _STOP:
+                    self._close_windows(None)
+                    self._flush()
+                    return
+                self._handle(record)
+                try:
+                    record = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+            self._close_windows(self.clock())
+            self._flush()
+
+    def _handle(self, record):
+        now = self.clock()
+        if self.window <= 0:
+            self._write(record)
+            return
+        key = (record.levelno, record.msg)
+        repeat = self.repeats.pop(record.name, None)
+        if repeat is not None:
+            if repeat.key == key and not record.exc_text and now - repeat.started < self.window:
+                repeat.count += 1
+                repeat.last = record
+                self.repeats[record.name] = repeat
+                LOG_RECORDS_COLLAPSED.inc()
+                return
+            # The run is over, its summary goes before the new message
+            self._summarize(repeat)
+        if not record.exc_text:
+            self.repeats[record.name] = _Repeat(key, now, record.created)
+        self._write(record)
+
+    def _close_windows(self, now):
+        """Writes the summaries of windows that are over (all of them if now is None)"""
+        for name, repeat in list(self.repeats.items()):
+            if now is None or now - repeat.started >= self.window:
+                self._summarize(repeat)
+                del self.repeats[name]
+
+    def _summarize(self, repeat):
+        if not repeat.count:
+            return
+        record = repeat.last
+        span = self.window if self.clock() - repeat.started >= self.window else record.created - repeat.first_created
+        record.msg = f"{record.msg} (×{repeat.count} in {span:.0f} s)"
+        # Stamped when it is written, so the log stays in order
+        record.created = time.time()
+        record.msecs = (record.created - int(record.created)) * 1000
+        self._write(record)
+
+    def _write(self, record):
+        for handler in self.handlers:
+            if record.levelno >= handler.level:
+                handler.handle(record)
+
+    def _flush(self):
+        for handler in self.handlers:
+            handler.flush_batch()
+
+
+class LogPipeline(object):
+    """
+    The queue, the writer thread and its output handlers.
+
+    Usage:
+        pipeline = LogPipeline(fmt, log_file="logs/game_state_handler.log").start()
+        logging.getLogger().addHandler(pipeline.handler)
+    """
+
+    def __init__(self, fmt=DEFAULT_FORMAT, log_file=None, window=DEDUP_WINDOW, max_bytes=MAX_BYTES,
+                 backup_count=BACKUP_COUNT, stream=None, queue_size=QUEUE_SIZE):
+        formatter = logging.Formatter(fmt)
+        handlers = [BatchStreamHandler(stream)]
+        if log_file:
+            directory = os.path.dirname(log_file)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            handlers.append(CompressingRotatingFileHandler(log_file, max_bytes, backup_count))
+        for handler in handlers:
+            handler.setFormatter(formatter)
+        self.queue = queue.Queue(queue_size)
+        self.handler = QueueingHandler(self.queue)
+        self.writer = LogWriter(self.queue, handlers, window)
+
+    def start(self):
+        self.writer.start()
+        return self
+
+    def stop(self, timeout=2.0):
+        """Writes out everything queued so far and stops the writer"""
+        if not self.writer.is_alive():
+            return
+        try:
+            self.queue.put(_STOP, timeout=timeout)
+        except queue.Full:
+            pass
+        self.writer.join(timeout)
+        for handler in self.writer.handlers:
+            handler.close()
+
+
+_pipeline = None
+
+
+def setup(fmt=DEFAULT_FORMAT, log_file=None, window=DEDUP_WINDOW, max_bytes=MAX_BYTES, backup_count=BACKUP_COUNT,
+          level=logging.DEBUG):
+    """Routes the root logger through a new pipeline, stops it at exit. Returns the pipeline"""
+    global _pipeline
+    root = logging.getLogger()
+    if _pipeline is not None:
+        root.removeHandler(_pipeline.handler)
+        _pipeline.stop()
+    _pipeline = LogPipeline(fmt, log_file, window, max_bytes, backup_count).start()
+    root.addHandler(_pipeline.handler)
+    root.setLevel(level)
+    atexit.register(_pipeline.stop)
+    return _pipeline
+
+
+def add_logging_arguments(parser):
+    """Adds the log file and deduplication options to an argument parser"""
+    parser.add_argument('--log-file', type=str, default=None,
+                        help="also log to this file, rotated and gzip compressed")
+    parser.add_argument('--log-max-bytes', type=int, default=MAX_BYTES, help="rotate the log file at this size")
+    parser.add_argument('--log-backups', type=int, default=BACKUP_COUNT, help="number of rotated log files to keep")
+    parser.add_argument('--log-dedup-window', type=float, default=DEDUP_WINDOW,
+                        help="collapse runs of a repeated log message within this many seconds, 0 disables")
+
+
+def setup_from_args(args, fmt=DEFAULT_FORMAT):
+    """:func:`setup` with the options of :func:`add_logging_arguments`"""
+    return setup(fmt, args.log_file, args.log_dedup_window, args.log_max_bytes, args.log_backups)
@@ -0,0 +1,371 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+"""
+Columnar on-disk history of every decoded packet of a match.
+
+A store is a directory with one file per column, each a plain little endian
+array of a fixed width type, so a reader maps the files with NumPy and
+queries are vectorized scans instead of parsing text logs::
+
+    meta.json               protocol, column names and types
+    receive_time.col        f8, time.time() of every packet
+    game_state.col          u1
+    ...
+    team0_score.col         u1
+    team0_player3_penalty.col
+    time.idx                sparse index: (receive_time, row) every INDEX_STRIDE rows
+
+The writer collects rows in a small structured NumPy buffer and appends it
+column by column once it is full (or FLUSH_INTERVAL has passed), so a packet
+costs one tuple assignment on the receive path.  Readers may open a store
+that is still being written; they see the rows flushed so far.
+
+Examples::
+
+    store = MatchStore("matches/final")
+    store.changes("team0_score")                 # score over time
+    store.penalty_intervals(team_number=7, player=3)
+    store.at(store.start_time() + 742)           # the state 742 s into the recording
+
+    python match_store.py matches/final at 742s
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+from operator import itemgetter
+
+import numpy as np
+
+FORMAT_VERSION = 1
+META_FILE = "meta.json"
+INDEX_FILE = "time.idx"
+COLUMN_SUFFIX = ".col"
+
+# Rows per sparse index entry
+INDEX_STRIDE = 256
+# Rows buffered by the writer before they are appended to the column files
+CHUNK_ROWS = 256
+# Buffered rows are written at least this often (seconds)
+FLUSH_INTERVAL = 5.0
+
+PLAYERS = 11
+INDEX_DTYPE = np.dtype([("receive_time", "<f8"), ("row", "<i8")])
+
+
+class Layout(object):
+    """ The columns of one protocol version and how to fill them from a parsed packet """
+
+    def __init__(self, protocol, header, team, player, row):
+        self.protocol = protocol
+        self.columns = [("receive_time", "<f8")] + list(header)
+        for t in range(2):
+            self.columns += [(f"team{t}_{name}", dtype) for name, dtype in team]
+            for p in range(1, PLAYERS + 1):
+                self.columns += [(f"team{t}_player{p}_{name}", dtype) for name, dtype in player]
+        self.dtype = np.dtype(self.columns)
+        self.row = row
+
+
+# Item access, Container attribute lookups cost several times more
+_team = itemgetter("team_number", "team_color", "score", "penalty_shot", "single_shots")
+_player_v12 = itemgetter("penalty", "secs_till_unpenalized", "number_of_warnings", "number_of_yellow_cards",
+                         "number_of_red_cards")
+_player_2014 = itemgetter("penalty", "secs_till_unpenalized")
+
+
+def _row_v12(state, receive_time):
+    row = [receive_time, state["packet_number"], state["players_per_team"], state["game_type"],
+           int(state["game_state"]), state["first_half"], state["kick_of_team"], int(state["secondary_state"]),
+           state["secondary_state_info"], state["drop_in_team"], state["drop_in_time"], state["seconds_remaining"],
+           state["secondary_seconds_remaining"]]
+    for team in state["teams"]:
+        number, color, score, penalty_shot, single_shots = _team(team)
+        row += (number, int(color), score, penalty_shot, single_shots)
+        for player in team["players"]:
+            row += _player_v12(player)
+    return tuple(row)
+
+
+def _row_2014(state, receive_time):
+    row = [receive_time, state["packet_number"], state["players_per_team"], int(state["game_state"]),
+           state["first_half"], state["kick_of_team"], int(state["secondary_state"]), state["drop_in_team"],
+           state["drop_in_time"], state["seconds_remaining"], state["secondary_seconds_remaining"]]
+    for team in state["teams"]:
+        number, color, score, penalty_shot, single_shots = _team(team)
+        row += (number, int(color), score, penalty_shot, single_shots)
+        for player in team["players"]:
+            row += _player_2014(player)
+    return tuple(row)
+
+
+_TEAM = (("number", "u1"), ("color", "u1"), ("score", "u1"), ("penalty_shot", "u1"), ("single_shots", "<u2"))
+
+LAYOUTS = {
+    "v12": Layout(
+        "v12",
+        header=(("packet_number", "u1"), ("players_per_team", "u1"), ("game_type", "u1"), ("game_state", "u1"),
+                ("first_half", "u1"), ("kick_of_team", "u1"), ("secondary_state", "u1"),
+                ("secondary_state_info", "S4"), ("drop_in_team", "u1"), ("drop_in_time", "<u2"),
+                ("seconds_remaining", "<i2"), ("secondary_seconds_remaining", "<i2")),
+        team=_TEAM,
+        player=(("penalty", "u1"), ("secs_till_unpenalized", "u1"), ("warnings", "u1"), ("yellow_cards", "u1"),
+                ("red_cards", "u1")),
+        row=_row_v12),
+    "2014": Layout(
+        "2014",
+        header=(("packet_number", "u1"), ("players_per_team", "u1"), ("game_state", "u1"), ("first_half", "u1"),
+                ("kick_of_team", "u1"), ("secondary_state", "u1"), ("drop_in_team", "u1"), ("drop_in_time", "<u2"),
+                ("seconds_remaining", "<i2"), ("secondary_seconds_remaining", "<i2")),
+        team=_TEAM,
+        player=(("penalty", "u1"), ("secs_till_unpenalized", "u1")),
+        row=_row_2014),
+}
+
+
+class MatchStoreWriter(object):
+    """
+    Appends packets to a store, creating it or continuing an existing one.
+
+    Usage:
+        writer = MatchStoreWriter("matches/final", "v12")
+        writer.append(parsed_state, receive_time)
+        writer.close()
+    """
+
+    def __init__(self, directory, protocol="v12", chunk_rows=CHUNK_ROWS, flush_interval=FLUSH_INTERVAL):
+        self.directory = directory
+        self.layout = LAYOUTS[protocol]
+        self.flush_interval = flush_interval
+        os.makedirs(directory, exist_ok=True)
+        meta_path = os.path.join(directory, META_FILE)
+        if os.path.exists(meta_path):
+            meta = _read_meta(directory)
+            if meta["protocol"] != protocol:
+                raise ValueError(f"{directory} holds {meta['protocol']} packets, not {protocol}")
+            # Cut the columns back to the rows every one of them has
+            self.rows = _complete_rows(directory, self.layout.columns)
+            for name, dtype in self.layout.columns:
+                with open(_column_path(directory, name), "r+b") as f:
+                    f.truncate(self.rows * np.dtype(dtype).itemsize)
+        else:
+            with open(meta_path, "w") as f:
+                json.dump({"format": FORMAT_VERSION, "protocol": protocol, "index_stride": INDEX_STRIDE,
+                           "columns": self.layout.columns}, f, indent=1)
+            self.rows = 0
+        self.files = [open(_column_path(directory, name), "ab") for name, _ in self.layout.columns]
+        self.index_file = open(os.path.join(directory, INDEX_FILE), "ab")
+        self.chunk = np.zeros(chunk_rows, dtype=self.layout.dtype)
+        self.fill = 0
+        self.last_flush = time.monotonic()
+
+    def append(self, state, receive_time):
+        """Adds one parsed packet"""
+        self.chunk[self.fill] = self.layout.row(state, receive_time)
+        self.fill += 1
+        if self.fill == len(self.chunk) or time.monotonic() - self.last_flush > self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        """Appends the buffered rows to the column files"""
+        if self.fill:
+            rows = self.chunk[:self.fill]
+            for (name, _), f in zip(self.layout.columns, self.files):
+                f.write(rows[name].tobytes())
+                f.flush()
+            # Index entries at every multiple of INDEX_STRIDE in the new rows
+            first = -(-self.rows // INDEX_STRIDE) * INDEX_STRIDE
+            entries = np.arange(first, self.rows + self.fill, INDEX_STRIDE)
+            if len(entries):
+                index = np.empty(len(entries), dtype=INDEX_DTYPE)
+                index["row"] = entries
+                index["receive_time"] = rows["receive_time"][entries - self.rows]
+                self.index_file.write(index.tobytes())
+                self.index_file.flush()
+            self.rows += self.fill
+            self.fill = 0
+        self.last_flush = time.monotonic()
+
+    def close(self):
+        self.flush()
+        for f in self.files:
+            f.close()
+        self.index_file.close()
+
+
+def _column_path(directory, name):
+    return os.path.join(directory, name + COLUMN_SUFFIX)
+
+
+def _read_meta(directory):
+    with open(os.path.join(directory, META_FILE)) as f:
+        meta = json.load(f)
+    if meta.get("format") != FORMAT_VERSION:
+        raise ValueError(f"Unsupported match store format {meta.get('format')}")
+    return meta
+
+
+def _complete_rows(directory, columns):
+    rows = None
+    for name, dtype in columns:
+        path = _column_path(directory, name)
+        count = os.path.getsize(path) // np.dtype(dtype).itemsize if os.path.exists(path) else 0
+        rows = count if rows is None else min(rows, count)
+    return rows or 0
+
+
+class MatchStore(object):
+    """ Read side: memory-maps the columns of a store """
+
+    def __init__(self, directory):
+        self.directory = directory
+        meta = _read_meta(directory)
+        self.protocol = meta["protocol"]
+        self.index_stride = meta["index_stride"]
+        self.dtypes = {name: np.dtype(dtype) for name, dtype in meta["columns"]}
+        self.rows = _complete_rows(directory, meta["columns"])
+        self._columns = {}
+        index_path = os.path.join(directory, INDEX_FILE)
+        index = np.fromfile(index_path, dtype=INDEX_DTYPE) if os.path.exists(index_path) else \
+            np.empty(0, dtype=INDEX_DTYPE)
+        self.index = index[index["row"] < self.rows]
+        self.time = self.column("receive_time")
+
+    def column(self, name):
+        """The memory-mapped column *name* (read only)"""
+        column = self._columns.get(name)
+        if column is None:
+            if name not in self.dtypes:
+                raise KeyError(f"No column {name}, see {META_FILE} for the available ones")
+            if self.rows == 0:
+                column = np.empty(0, dtype=self.dtypes[name])
+            else:
+                column = np.memmap(_column_path(self.directory, name), dtype=self.dtypes[name], mode="r",
+                                   shape=(self.rows,))
+            self._columns[name] = column
+        return column
+
+    def start_time(self):
+        return float(self.time[0]) if self.rows else None
+
+    def end_time(self):
+        return float(self.time[-1]) if self.rows else None
+
+    def row_at(self, t):
+        """Index of the last row received at or before *t*, -1 if there is none"""
+        if not self.rows:
+            return -1
+        # The sparse index narrows the search down to one stride of the time column
+        block = int(np.searchsorted(self.index["receive_time"], t, side="right")) - 1
+        if block < 0:
+            low, high = 0, (int(self.index["row"][0]) if len(self.index) else self.rows)
+        else:
+            low = int(self.index["row"][block])
+            high = int(self.index["row"][block + 1]) if block + 1 < len(self.index) else self.rows
+        return low + int(np.searchsorted(self.time[low:high], t, side="right")) - 1
+
+    def rows_between(self, start=None, end=None):
+        """Row slice of the packets received in [start, end]"""
+        first = 0 if start is None else self.row_at(start - 1e-9) + 1
+        last = self.rows if end is None else self.row_at(end) + 1
+        return slice(first, max(first, last))
+
+    def at(self, t):
+        """All columns of the last packet at or before *t*, None before the first one"""
+        row = self.row_at(t)
+        if row < 0:
+            return None
+        return {name: self.column(name)[row].item() for name in self.dtypes}
+
+    def changes(self, name, start=None, end=None):
+        """(times, values) of the rows where column *name* changed, starting with the first row"""
+        rows = self.rows_between(start, end)
+        values = self.column(name)[rows]
+        if not len(values):
+            return np.empty(0), values[:0]
+        changed = np.concatenate(([0], np.flatnonzero(values[1:] != values[:-1]) + 1))
+        return self.time[rows][changed], values[changed]
+
+    def intervals(self, name, start=None, end=None):
+        """(begin, end, value at begin) of every run where column *name* is not zero"""
+        rows = self.rows_between(start, end)
+        values = self.column(name)[rows]
+        times = self.time[rows]
+        active = np.concatenate(([False], values != 0, [False]))
+        edges = np.flatnonzero(active[1:] != active[:-1])
+        begins, ends = edges[0::2], edges[1::2]
+        result = []
+        for begin, end_row in zip(begins, ends):
+            # A run still active at the last row ends there
+            end_time = times[end_row] if end_row < len(times) else times[-1]
+            result.append((float(times[begin]), float(end_time), values[begin].item()))
+        return result
+
+    def team_slot(self, team_number):
+        """0 or 1, the position of a team in the packets"""
+        for slot in (0, 1):
+            numbers = self.column(f"team{slot}_number")
+            if len(numbers) and numbers[-1] == team_number:
+                return slot
+        raise KeyError(f"Team {team_number} is not in this match")
+
+    def penalty_intervals(self, team_number, player, start=None, end=None):
+        """(begin, end, penalty code) of every penalty of a player"""
+        slot = self.team_slot(team_number)
+        return self.intervals(f"team{slot}_player{player}_penalty", start, end)
+
+    def score_over_time(self, start=None, end=None):
+        """{team number: (times, scores)} at every change of the score"""
+        return {int(self.column(f"team{slot}_number")[-1]): self.changes(f"team{slot}_score", start, end)
+                for slot in (0, 1)} if self.rows else {}
+
+
+def _parse_time(store, text):
+    """'742s' is relative to the first packet, a plain number is a time.time() value"""
+    if text.endswith("s"):
+        return store.start_time() + float(text[:-1])
+    return float(text)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Query a columnar match store")
+    parser.add_argument('store', help="store directory")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser('info', help="rows, time range and columns")
+    at = commands.add_parser('at', help="the packet at a time, e.g. 742s into the recording")
+    at.add_argument('time')
+    commands.add_parser('score', help="score over time")
+    penalties = commands.add_parser('penalties', help="penalty intervals of a player")
+    penalties.add_argument('team', type=int, help="team number")
+    penalties.add_argument('player', type=int, help="player number, 1 based")
+    changes = commands.add_parser('changes', help="changes of any column")
+    changes.add_argument('column')
+    args = parser.parse_args()
+
+    store = MatchStore(args.store)
+    start = store.start_time()
+    if not store.rows and args.command != 'info':
+        sys.exit(f"{args.store} holds no packets yet")
+    if args.command == 'info':
+        print(f"{store.rows} packets ({store.protocol}), {len(store.dtypes)} columns")
+        if store.rows:
+            print(f"{time.ctime(start)} .. {time.ctime(store.end_time())} ({store.end_time() - start:.1f} s)")
+    elif args.command == 'at':
+        values = store.at(_parse_time(store, args.time))
+        if values is None:
+            sys.exit("No packet at that time")
+        for name, value in values.items():
+            if "_player" not in name or value:
+                print(f"{name:>32} {value}")
+    elif args.command == 'score':
+        for team, (times, scores) in store.score_over_time().items():
+            print(f"Team {team}: " + ", ".join(f"{t - start:.1f}s={score}" for t, score in zip(times, scores)))
+    elif args.command == 'penalties':
+        for begin, end, code in store.penalty_intervals(args.team, args.player):
+            print(f"{begin - start:8.1f}s .. {end - start:8.1f}s  penalty {code}")
+    elif args.command == 'changes':
+        for t, value in zip(*store.changes(args.column)):
+            print(f"{t - start:8.1f}s  {value}")
@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+"""
+Process-local counters and an optional OpenMetrics endpoint.
+
+Counters are sharded per thread like :class:`latency.LatencyHistogram`, so
+incrementing one on the receive path is a thread-local lookup and an add.
+Scrapes are served from a background thread and only ever read the shards.
+The HTTP server lives in :mod:`metrics_http` and is only imported when it is
+started, ``http.server`` alone costs a noticeable part of a cold start.
+"""
+
+import os
+import threading
+import logging
+
+logger = logging.getLogger('metrics')
+
+CONTENT_TYPE = "application/openmetrics-text; version=1.0.0; charset=utf-8"
+
+# Bucket bounds (ms) the latency histograms are folded into when scraped, exported in seconds
+EXPORT_BUCKETS_MS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500)
+
+
+class Counter(object):
+    """ Monotonic counter, incremented without taking a lock """
+
+    def __init__(self, name, documentation):
+        self.name = name
+        self.documentation = documentation
+        self._local = threading.local()
+        self._shards = []
+        self._register_lock = threading.Lock()
+
+    def inc(self, amount=1):
+        shard = getattr(self._local, "shard", None)
+        if shard is None:
+            shard = [0]
+            with self._register_lock:
+                self._shards.append(shard)
+            self._local.shard = shard
+        shard[0] += amount
+
+    def value(self):
+        return sum(shard[0] for shard in list(self._shards))
+
+    def render(self):
+        return [
+            f"# TYPE {self.name} counter",
+            f"# HELP {self.name} {self.documentation}",
+            f"{self.name}_total {self.value()}",
+        ]
+
+
+class Gauge(object):
+    """ Gauge whose value is read from a callback at scrape time """
+
+    def __init__(self, name, documentation, callback):
+        self.name = name
+        self.documentation = documentation
+        self.callback = callback
+
+    def render(self):
+        lines = [
+            f"# TYPE {self.name} gauge",
+            f"# HELP {self.name} {self.documentation}",
+        ]
+        try:
+            value = self.callback()
+        except Exception as e:
+            logger.debug(f"Gauge {self.name} failed: {e}")
+            value = None
+        if value is not None:
+            lines.append(f"{self.name} {value}")
+        return lines
+
+
+class StageHistograms(object):
+    """ Exports a :class:`latency.StageLatencyTracker` as one labelled histogram family in seconds """
+
+    def __init__(self, name, documentation, tracker):
+        self.name = name
+        self.documentation = documentation
+        self.tracker = tracker
+
+    def render(self):
+        lines = [
+            f"# TYPE {self.name} histogram",
+            f"# UNIT {self.name} seconds",
+            f"# HELP {self.name} {self.documentation}",
+        ]
+        for stage, histogram in list(self.tracker.histograms.items()):
+            # Buckets, +Inf and count all come from this one snapshot
+            buckets = histogram.buckets()
+            count = sum(buckets)
+            if not count:
+                continue
+            cumulative = 0
+            index = 0
+            for bound in EXPORT_BUCKETS_MS:
+                while index < len(buckets) and histogram.bucket_upper_bound(index) <= bound:
+                    cumulative += buckets[index]
+                    index += 1
+                lines.append(f'{self.name}_bucket{{stage="{stage}",le="{bound / 1000}"}} {cumulative}')
+            lines.append(f'{self.name}_bucket{{stage="{stage}",le="+Inf"}} {count}')
+            lines.append(f'{self.name}_count{{stage="{stage}"}} {count}')
+            lines.append(f'{self.name}_sum{{stage="{stage}"}} {histogram.total() / 1000}')
+        return lines
+
+
+class MetricsRegistry(object):
+    """ Collection of metrics rendered together on scrape """
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _get_or_create(self, name, factory):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = factory()
+            return metric
+
+    def counter(self, name, documentation):
+        """Returns the counter with this name, creating it on first use"""
+        return self._get_or_create(name, lambda: Counter(name, documentation))
+
+    def gauge(self, name, documentation, callback):
+        """Registers (or replaces the callback of) a gauge"""
+        gauge = self._get_or_create(name, lambda: Gauge(name, documentation, callback))
+        gauge.callback = callback
+        return gauge
+
+    def stage_histograms(self, name, documentation, tracker):
+        """Registers a per-stage latency tracker, *name* ends in ``_seconds`` as OpenMetrics requires"""
+        histograms = self._get_or_create(name, lambda: StageHistograms(name, documentation, tracker))
+        histograms.tracker = tracker
+        return histograms
+
+    def render(self):
+        """Returns the OpenMetrics text exposition of all metrics"""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        lines.append("# EOF")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = MetricsRegistry()
+
+# Counters shared by the receivers and handlers
+PACKETS_RECEIVED = REGISTRY.counter("gc_packets_received", "Datagrams read from the GameController socket")
+PACKETS_PARSED = REGISTRY.counter("gc_packets_parsed", "Datagrams parsed into a game state")
+PACKETS_DROPPED = REGISTRY.counter("gc_packets_dropped", "Datagrams read but never handed to the handler")
+PACKETS_MALFORMED = REGISTRY.counter("gc_packets_malformed", "Datagrams that failed to parse")
+PACKETS_COALESCED = REGISTRY.counter("gc_packets_coalesced", "Backlogged datagrams skipped because a newer one from the same source was queued")
+ANSWERS_SENT = REGISTRY.counter("gc_answers_sent", "Answer packets sent back to the GameController")
+STATE_TRANSITIONS = REGISTRY.counter("gc_state_transitions", "Game state changes acted upon")
+COALESCED_TRANSITIONS = REGISTRY.counter("gc_coalesced_transitions", "Game state changes superseded before they were acted upon")
+CHILD_RESTARTS = REGISTRY.counter("gc_child_restarts", "State scripts terminated to make room for another one")
+
+
+class MetricsServer(object):
+    """ Serves a registry over HTTP on a TCP port or a Unix socket from its own thread """
+
+    def __init__(self, registry=REGISTRY, port=None, host="127.0.0.1", unix_path=None):
+        if port is None and unix_path is None:
+            raise ValueError("Either port or unix_path is needed")
+        from metrics_http import MetricsRequestHandler, TCPMetricsServer, UnixMetricsServer
+        self.unix_path = unix_path
+        if unix_path is not None:
+            if os.path.exists(unix_path):
+                os.unlink(unix_path)
+            self.server = UnixMetricsServer(unix_path, MetricsRequestHandler)
+        else:
+            self.server = TCPMetricsServer((host, port), MetricsRequestHandler)
+        self.server.registry = registry
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, name="metrics", daemon=True)
+        self.thread.start()
+        if self.unix_path:
+            logger.info(f"Serving metrics on unix:{self.unix_path}")
+        else:
+            logger.info(f"Serving metrics on http://{self.server.server_address[0]}:{self.server.server_address[1]}/metrics")
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        if self.unix_path and os.path.exists(self.unix_path):
+            os.unlink(self.unix_path)
+
+
+def add_metrics_arguments(parser):
+    """Adds the --metrics-port/--metrics-socket options to an argument parser"""
+    parser.add_argument('--metrics-port', type=int, default=None, help="serve OpenMetrics on this local TCP port")
+    parser.add_argument('--metrics-socket', type=str, default=None, help="serve OpenMetrics on this Unix socket")
+
+
+def start_from_args(args, registry=REGISTRY):
+    """Starts a MetricsServer if requested on the command line, returns it or None"""
+    if args.metrics_port is None and args.metrics_socket is None:
+        return None
+    return MetricsServer(registry, port=args.metrics_port, unix_path=args.metrics_socket).start()
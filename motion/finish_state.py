@@ -1,6 +1,11 @@
 # sepuluh.py
-import time
+try:
+    # Beats while sleeping if the handler asked for heartbeats
+    from heartbeat import sleep
+except ImportError:
+    # Started by hand without the handler's directory on the path
+    from time import sleep
 
 while True:
     print("FINISHED")
-    time.sleep(0.5)
+    sleep(0.5)
@@ -1,4 +1,9 @@
-import time
+try:
+    # Beats while sleeping if the handler asked for heartbeats
+    from heartbeat import sleep
+except ImportError:
+    # Started by hand without the handler's directory on the path
+    from time import sleep
 
 counter = 0
 while True:
@@ -6,4 +11,4 @@ while True:
     if counter > 1000:
         counter = 1
     print(f"Set State - Counter: {counter}")
-    time.sleep(0.5)
+    sleep(0.5)
@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+"""
+Bounded single-producer / multi-consumer ring of raw packets.
+
+The receive thread is the only producer: it copies the datagram into the next
+preallocated slot, bumps the head and wakes up waiting consumers, which is
+the same amount of work however many consumers are attached.  Every consumer
+keeps its own cursor and reads at its own pace.  A consumer that falls more
+than ``capacity`` packets behind has lost the oldest ones; it jumps forward
+to the oldest packet still in the ring and counts the gap as an overrun.
+"""
+
+import logging
+import threading
+from collections import namedtuple
+
+from metrics import REGISTRY
+
+logger = logging.getLogger('packet_ring')
+
+RING_OVERRUNS = REGISTRY.counter("gc_ring_overruns", "Packets a ring consumer lost by falling behind")
+BYTES_RECEIVED = REGISTRY.counter("gc_bytes_received", "Bytes of GameController datagrams received")
+
+RingEntry = namedtuple("RingEntry", ["sequence", "data", "receive_time", "peer"])
+
+
+class PacketRing(object):
+    """ Fixed number of fixed-size slots, written by exactly one thread """
+
+    def __init__(self, capacity=256, slot_size=1024):
+        self.capacity = capacity
+        self.slot_size = slot_size
+        self.slots = [bytearray(slot_size) for _ in range(capacity)]
+        self.lengths = [0] * capacity
+        self.receive_times = [0.0] * capacity
+        self.peers = [None] * capacity
+        # Sequence number of the next packet, i.e. the number of packets written so far
+        self.head = 0
+        self.condition = threading.Condition()
+        self.closed = False
+
+    def publish(self, data, receive_time, peer):
+        """Copies a packet into the ring (producer thread only)"""
+        index = self.head % self.capacity
+        length = min(len(data), self.slot_size)
+        self.slots[index][:length] = data[:length]
+        self.lengths[index] = length
+        self.receive_times[index] = receive_time
+        self.peers[index] = peer
+        self.head += 1
+        with self.condition:
+            self.condition.notify_all()
+
+    def close(self):
+        """Wakes up all consumers for good"""
+        self.closed = True
+        with self.condition:
+            self.condition.notify_all()
+
+    def cursor(self, name):
+        """A new consumer cursor starting at the next packet"""
+        return RingCursor(self, name)
+
+
+class RingCursor(object):
+    """ Read position of one consumer """
+
+    def __init__(self, ring, name):
+        self.ring = ring
+        self.name = name
+        self.next_sequence = ring.head
+        self.overruns = 0
+        self.consumed = 0
+
+    def lag(self):
+        return self.ring.head - self.next_sequence
+
+    def read(self, timeout=None):
+        """Returns all entries available now, waiting up to *timeout* if there are none"""
+        ring = self.ring
+        if ring.head == self.next_sequence and not ring.closed:
+            with ring.condition:
+                ring.condition.wait_for(lambda: ring.head != self.next_sequence or ring.closed, timeout)
+
+        entries = []
+        while self.next_sequence < ring.head:
+            head = ring.head
+            oldest = head - ring.capacity + 1
+            if self.next_sequence < oldest:
+                # Leave one slot of headroom: the producer may be writing slot `head` already
+                skipped = oldest - self.next_sequence
+                self.overruns += skipped
+                RING_OVERRUNS.inc(skipped)
+                logger.warning(f"Consumer {self.name} fell behind, lost {skipped} packets")
+                self.next_sequence = oldest
+
+            sequence = self.next_sequence
+            index = sequence % ring.capacity
+            entry = RingEntry(sequence, bytes(ring.slots[index][:ring.lengths[index]]),
+                              ring.receive_times[index], ring.peers[index])
+            if ring.head - sequence >= ring.capacity:
+                # Overwritten while copying, the overrun check above handles it next round
+                continue
+            entries.append(entry)
+            self.next_sequence = sequence + 1
+        self.consumed += len(entries)
+        return entries
+
+
+class RingConsumer(threading.Thread):
+    """ Thread draining a cursor into :meth:`handle`, one entry at a time """
+
+    def __init__(self, ring, name):
+        super(RingConsumer, self).__init__(name=name, daemon=True)
+        self.cursor = ring.cursor(name)
+        self.running = True
+
+    def run(self):
+        ring = self.cursor.ring
+        while self.running and not (ring.closed and self.cursor.lag() == 0):
+            for entry in self.cursor.read(timeout=0.5):
+                try:
+                    self.handle(entry)
+                except Exception as e:
+                    logger.exception(e)
+        self.finish()
+
+    def handle(self, entry):
+        """Needs to be implemented by consumers"""
+        raise NotImplementedError()
+
+    def finish(self):
+        """Called once the ring is closed and drained"""
+        pass
+
+    def stop(self):
+        self.running = False
+
+
+class DispatchConsumer(RingConsumer):
+    """ Parses packets and hands them to a receiver's handler, off the receive thread """
+
+    def __init__(self, ring, receiver):
+        super(DispatchConsumer, self).__init__(ring, "dispatch")
+        self.receiver = receiver
+
+    def handle(self, entry):
+        self.receiver.process_packet(entry.data, entry.peer, entry.receive_time)
+
+
+class RecorderConsumer(RingConsumer):
+    """ Writes every packet into a capture file (see :mod:`capture`) """
+
+    def __init__(self, ring, path, packet_size):
+        super(RecorderConsumer, self).__init__(ring, "recorder")
+        from capture import CaptureWriter
+        self.writer = CaptureWriter(path, packet_size)
+
+    def handle(self, entry):
+        self.writer.write(entry.data, entry.receive_time)
+
+    def finish(self):
+        self.writer.close()
+
+
+class LoggerConsumer(RingConsumer):
+    """ Logs a one line summary of every packet at debug level """
+
+    def __init__(self, ring, log=logger):
+        super(LoggerConsumer, self).__init__(ring, "logger")
+        self.log = log
+
+    def handle(self, entry):
+        self.log.debug(f"Packet #{entry.sequence} from {entry.peer[0] if entry.peer else '?'}: {len(entry.data)} bytes")
+
+
+class MetricsConsumer(RingConsumer):
+    """ Feeds traffic counters and the lag of the other consumers to the metrics registry """
+
+    def __init__(self, ring, consumers=()):
+        super(MetricsConsumer, self).__init__(ring, "metrics")
+        for consumer in consumers:
+            REGISTRY.gauge(f"gc_ring_lag_{consumer.cursor.name}",
+                           f"Packets the {consumer.cursor.name} consumer is behind the receiver",
+                           consumer.cursor.lag)
+
+    def handle(self, entry):
+        BYTES_RECEIVED.inc(len(entry.data))
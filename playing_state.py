@@ -1,8 +1,12 @@
 # playing_state.py
-import time
+import heartbeat
+import state_report
+
+state_report.report_ready()
 
 counter = 0
 while True:
     counter += 1
     print(f"PLAYING STATE - Counter: {counter}")
-    time.sleep(0.5)
+    state_report.report_first_action()
+    heartbeat.sleep(0.5)
@@ -0,0 +1,273 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+"""
+Resource profiles of the handler and its scripts per game state, from /proc.
+
+A slow transition is either a script that is slow to start or a host that
+is overloaded; the profiles tell the two apart.  One thread samples every
+tracked process per ``period``, all in one pass behind a single timer, and
+adds what changed since the previous pass to the profile of the state the
+handler is in:
+
+* CPU time (``/proc/<pid>/stat``, for the handler ``getrusage``),
+* resident set size (``stat`` for scripts, ``/proc/self/statm`` for the handler),
+* voluntary and involuntary context switches (``/proc/<pid>/status``,
+  for the handler ``getrusage``, which covers all of its threads),
+* for each script, the time it spent runnable but waiting for a CPU up to
+  its first sample (``/proc/<pid>/schedstat``), the run-queue delay a new
+  script sees before it gets going.
+
+The /proc files of a script are opened once and re-read with ``pread``, a
+pass costs a few microseconds per process::
+
+    sampler = ProcSampler(period=0.1).start()
+    sampler.set_state("STATE_READY")
+    process = subprocess.Popen(cmd)
+    sampler.track(process.pid, "ready_state.py")
+    ...
+    sampler.print_statistics(logger)
+
+Scripts are dropped once their process is gone.  Linux only, elsewhere the
+sampler only profiles the handler.
+"""
+
+import os
+import time
+import logging
+import resource
+import threading
+
+from latency import StageLatencyTracker
+from metrics import REGISTRY
+
+logger = logging.getLogger('proc_sampler')
+
+# Seconds between two passes
+PERIOD = 0.1
+READ_SIZE = 4096
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+PAGE_SIZE = resource.getpagesize()
+
+
+def _read(fd):
+    return os.pread(fd, READ_SIZE, 0)
+
+
+class TrackedProcess(object):
+    """ The open /proc files of one script and its values at the previous pass """
+
+    def __init__(self, pid, script):
+        self.pid = pid
+        self.script = script
+        self.stat_fd = os.open(f"/proc/{pid}/stat", os.O_RDONLY)
+        self.status_fd = os.open(f"/proc/{pid}/status", os.O_RDONLY)
+        try:
+            self.schedstat_fd = os.open(f"/proc/{pid}/schedstat", os.O_RDONLY)
+        except OSError:
+            # Kernel without CONFIG_SCHED_INFO
+            self.schedstat_fd = None
+        # From zero, so the interpreter start up counts toward the state it was launched for
+        self.cpu = 0.0
+        self.switches = (0, 0)
+        self.sampled = False
+
+    def read(self):
+        """(cpu seconds, rss bytes, (voluntary, involuntary) switches), raises OSError once the process is gone"""
+        stat = _read(self.stat_fd)
+        # The command name may contain spaces, the fields after it do not
+        fields = stat[stat.rindex(b")") + 2:].split()
+        if fields[0] == b"Z":
+            raise ProcessLookupError(self.pid)
+        cpu = (int(fields[11]) + int(fields[12])) / CLOCK_TICKS
+        rss = int(fields[21]) * PAGE_SIZE
+        voluntary = involuntary = 0
+        for line in _read(self.status_fd).splitlines():
+            if line.startswith(b"voluntary_ctxt_switches:"):
+                voluntary = int(line.split()[1])
+            elif line.startswith(b"nonvoluntary_ctxt_switches:"):
+                involuntary = int(line.split()[1])
+        return cpu, rss, (voluntary, involuntary)
+
+    def run_delay(self):
+        """Seconds spent runnable but not running, None if the kernel does not say"""
+        if self.schedstat_fd is None:
+            return None
+        return int(_read(self.schedstat_fd).split()[1]) / 1e9
+
+    def close(self):
+        for fd in (self.stat_fd, self.status_fd, self.schedstat_fd):
+            if fd is not None:
+                os.close(fd)
+
+
+class StateProfile(object):
+    """ Resource use summed over the time spent in one state """
+
+    def __init__(self):
+        self.seconds = 0.0
+        self.samples = 0
+        self.handler_cpu = 0.0
+        self.handler_switches = [0, 0]
+        self.handler_rss_max = 0
+        self.scripts_cpu = 0.0
+        self.scripts_switches = [0, 0]
+        self.scripts_rss_max = 0
+        self.scripts_rss_total = 0
+
+    def rate(self, value):
+        return value / self.seconds if self.seconds else 0.0
+
+
+class ProcSampler(object):
+    """ Samples the handler and its scripts from one thread, see the module documentation """
+
+    def __init__(self, period=PERIOD):
+        self.period = period
+        self.state = None
+        self.profiles = {}
+        # Run-queue delay of new scripts until their first sample, one histogram per state
+        self.start_wait = StageLatencyTracker(stages=())
+        self.processes = {}
+        # Registrations are only applied by the sampler thread
+        self._pending = []
+        self._pending_lock = threading.Lock()
+        self._last_pass = None
+        self._last_usage = None
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def set_state(self, state):
+        """Attributes everything from the next pass on to *state*"""
+        self.state = state
+
+    def track(self, pid, script):
+        """Starts sampling the process of *script*"""
+        with self._pending_lock:
+            self._pending.append((pid, script))
+
+    def _apply_pending(self):
+        with self._pending_lock:
+            pending, self._pending = self._pending, []
+        for pid, script in pending:
+            if pid in self.processes:
+                continue
+            try:
+                self.processes[pid] = TrackedProcess(pid, script)
+            except OSError:
+                # Gone already
+                pass
+
+    def _handler_rss(self):
+        try:
+            with open("/proc/self/statm", "rb") as f:
+                return int(f.read().split()[1]) * PAGE_SIZE
+        except OSError:
+            return 0
+
+    def sample(self):
+        """One pass over the handler and every tracked script"""
+        self._apply_pending()
+        now = time.monotonic()
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        profile = self.profiles.get(self.state)
+        if profile is None:
+            profile = self.profiles[self.state] = StateProfile()
+
+        if self._last_pass is not None:
+            last = self._last_usage
+            profile.seconds += now - self._last_pass
+            profile.handler_cpu += (usage.ru_utime + usage.ru_stime) - (last.ru_utime + last.ru_stime)
+            profile.handler_switches[0] += usage.ru_nvcsw - last.ru_nvcsw
+            profile.handler_switches[1] += usage.ru_nivcsw - last.ru_nivcsw
+        profile.samples += 1
+        profile.handler_rss_max = max(profile.handler_rss_max, self._handler_rss())
+        self._last_pass = now
+        self._last_usage = usage
+
+        scripts_rss = 0
+        for pid, process in list(self.processes.items()):
+            try:
+                cpu, rss, switches = process.read()
+                if not process.sampled:
+                    process.sampled = True
+                    run_delay = process.run_delay()
+                    if run_delay is not None:
+                        self.start_wait.record(self.state, run_delay * 1000)
+            except (OSError, ValueError, IndexError):
+                del self.processes[pid]
+                process.close()
+                continue
+            profile.scripts_cpu += cpu - process.cpu
+            profile.scripts_switches[0] += switches[0] - process.switches[0]
+            profile.scripts_switches[1] += switches[1] - process.switches[1]
+            process.cpu = cpu
+            process.switches = switches
+            scripts_rss += rss
+        profile.scripts_rss_max = max(profile.scripts_rss_max, scripts_rss)
+        profile.scripts_rss_total += scripts_rss
+
+    def run(self):
+        while True:
+            try:
+                self.sample()
+            except Exception as e:
+                logger.exception(e)
+            if self.stop_event.wait(self.period):
+                return
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name="proc_sampler", daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join(timeout=1.0)
+        for process in self.processes.values():
+            process.close()
+        self.processes = {}
+
+    def print_statistics(self, logger):
+        """Logs the resource profile of every state the handler was in"""
+        if not self.profiles:
+            return
+        start_wait = self.start_wait.get_statistics()
+        logger.info("=== RESOURCES PER STATE ===")
+        mb = 1024.0 * 1024.0
+        for state, profile in self.profiles.items():
+            if not profile.seconds:
+                continue
+            logger.info(f"{state if state is not None else 'no state'} ({profile.seconds:.1f} s): "
+                        f"handler cpu={profile.rate(profile.handler_cpu) * 100:.1f}% "
+                        f"rss={profile.handler_rss_max / mb:.1f} MB "
+                        f"switches/s={profile.rate(profile.handler_switches[0]):.0f}"
+                        f"+{profile.rate(profile.handler_switches[1]):.0f} involuntary")
+            logger.info(f"    scripts cpu={profile.rate(profile.scripts_cpu) * 100:.1f}% "
+                        f"rss={profile.scripts_rss_total / profile.samples / mb:.1f} MB "
+                        f"(max {profile.scripts_rss_max / mb:.1f}) "
+                        f"switches/s={profile.rate(profile.scripts_switches[0]):.0f}"
+                        f"+{profile.rate(profile.scripts_switches[1]):.0f} involuntary")
+            values = start_wait.get(state)
+            if values:
+                logger.info(f"    cpu wait at start: n={values['count']} p50={values['p50']:.2f} "
+                            f"p99={values['p99']:.2f} max={values['max']:.2f} ms")
+        logger.info("===========================")
+
+
+def add_sampler_arguments(parser):
+    """Adds the resource sampling options to an argument parser"""
+    parser.add_argument('--proc-sample-period', type=float, default=None,
+                        help="sample CPU, RSS and context switches of the handler and its scripts from /proc "
+                             "every this many seconds and report them per state (default: off)")
+
+
+def sampler_from_args(args):
+    """A started :class:`ProcSampler` exporting the scripts' start wait, None without --proc-sample-period"""
+    if args.proc_sample_period is None:
+        return None
+    sampler = ProcSampler(args.proc_sample_period).start()
+    REGISTRY.stage_histograms("gc_script_start_cpu_wait_seconds", "Run-queue delay of new scripts up to their first sample",
+                              sampler.start_wait)
+    return sampler
@@ -10,6 +10,7 @@ version used in the KRI competition.
 
 """
 
+import os
 import socket
 import time
 import logging
@@ -19,21 +20,43 @@ import sys
 # Requires construct==2.5.3
 from construct import Container, ConstError
 from gamestate_2014 import GameState, ReturnData, GAME_CONTROLLER_RESPONSE_VERSION
+from metrics import (REGISTRY, PACKETS_RECEIVED, PACKETS_PARSED, PACKETS_DROPPED, PACKETS_MALFORMED,
+                     PACKETS_COALESCED, ANSWERS_SENT)
+from state_channel import snapshot_from_state
+from game_clock import TIMER_MAIN, TIMER_SECONDARY
+from sequence import SequenceMonitor
+from latency import StageLatencyTracker, DELAY_STAGES, STAGE_NETWORK, STAGE_HANDLER
+import log_pipeline
+from socket_profile import SocketProfile, recv_timestamped, add_socket_arguments, profile_from_args
 
 logger = logging.getLogger('game_controller')
 logger.setLevel(logging.DEBUG)
-
-console_handler = logging.StreamHandler()
-console_handler.setFormatter(logging.Formatter("%(asctime)s %(message)s"))
-logger.addHandler(console_handler)
+# Console and log file format, see log_pipeline.setup
+LOG_FORMAT = "%(asctime)s %(message)s"
 
 DEFAULT_LISTENING_HOST = '0.0.0.0'
 GAME_CONTROLLER_LISTEN_PORT = 3838  # Same port in 2014 version
 GAME_CONTROLLER_ANSWER_PORT = 3838  # In 2014, send responses back to same port
 
+# Every valid package starts with these bytes
+PACKET_PREFIX = b"RGme\x08"  # header and version 8
+# The packet number follows right after the prefix
+PACKET_NUMBER_OFFSET = len(PACKET_PREFIX)
+# Upper bound of datagrams read in one drain, so a flood cannot starve the handler
+MAX_DRAIN = 1024
+
 parser = argparse.ArgumentParser()
 parser.add_argument('--team', type=int, default=1, help="team ID, default is 1")
 parser.add_argument('--player', type=int, default=1, help="player ID, default is 1")
+parser.add_argument('--drain', action="store_true", help="after a stall only handle the newest queued package")
+parser.add_argument('--drop-late', action="store_true", help="drop duplicate and out-of-order packages before parsing")
+parser.add_argument('--ring', action="store_true", help="parse and dispatch packets from a ring buffer off the receive thread")
+parser.add_argument('--record', type=str, default=None, help="record all packets into this capture file (implies --ring)")
+parser.add_argument('--shared-state', type=str, default=None, help="publish the latest state in this shared memory block")
+parser.add_argument('--game-clock', action="store_true", help="interpolate the GC timers between packages")
+parser.add_argument('--store', type=str, default=None, help="keep every decoded package in a columnar match store in this directory")
+add_socket_arguments(parser)
+log_pipeline.add_logging_arguments(parser)
 
 
 class GameStateReceiver(object):
@@ -45,7 +68,8 @@ class GameStateReceiver(object):
 
     After this we send a package back to the GC """
 
-    def __init__(self, team, player, addr=(DEFAULT_LISTENING_HOST, GAME_CONTROLLER_LISTEN_PORT), answer_port=GAME_CONTROLLER_LISTEN_PORT):
+    def __init__(self, team, player, addr=(DEFAULT_LISTENING_HOST, GAME_CONTROLLER_LISTEN_PORT), answer_port=GAME_CONTROLLER_LISTEN_PORT,
+                 socket_profile=None):
         # Information that is used when sending the answer to the game controller
         self.team = team
         self.player = player
@@ -59,17 +83,58 @@ class GameStateReceiver(object):
         self.state = None
         self.time = None
 
+        # Wall and monotonic clock and packet parser, replaced by simulation.py to run on virtual time
+        self.clock = time.time
+        self.monotonic = time.monotonic
+        self.parse_packet = GameState.parse
+
         # The socket and whether it is still running
         self.socket = None
         self.running = True
 
+        # Optional shared memory copy of the latest state for other local processes
+        self.shared_state = None
+
+        # Optional match_store.MatchStoreWriter keeping every decoded packet
+        self.match_store = None
+
+        # Optional game_clock.GameClock fed with every valid package, see attach_game_clock()
+        self.game_clock = None
+
+        # Loss, duplicates and reordering per GameController, see sequence.SequenceMonitor
+        self.sequence = SequenceMonitor()
+        # Network delay (from the sequence's delay estimate) next to our own handling delay
+        self.delay_stats = StageLatencyTracker(DELAY_STAGES)
+
+        # Non-blocking twin of the socket, see enable_drain()
+        self.drain_socket = None
+
+        # Optional packet ring, see attach_ring()
+        self.ring = None
+        self.ring_consumers = []
+
+        # Answer packets only depend on these settings, build each one once
+        self._answers = {}
+
+        # Socket options, see socket_profile.SocketProfile
+        self.socket_profile = socket_profile if socket_profile is not None else SocketProfile()
+
         self._open_socket()
 
+        REGISTRY.stage_histograms("gc_delay_seconds", "Network and handler share of the packet delay", self.delay_stats)
+        REGISTRY.gauge("gc_seconds_since_last_packet", "Seconds since the last valid GameController packet",
+                       self.get_time_since_last_package)
+
     def _open_socket(self):
         """ Creates the socket """
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
         self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self.socket.bind(self.addr)
+        self.socket_profile.apply_receive(self.socket)
+        self.socket.bind(self.socket_profile.bind_address(self.addr))
+        self.socket_profile.join_multicast(self.socket)
+        # The answers are sent from the listening socket
+        self.socket_profile.apply_send(self.socket)
+        self.socket_profile.log_results(logger)
         self.socket.settimeout(0.5)
         self.socket2 = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
         self.socket2.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
@@ -87,47 +152,162 @@ class GameStateReceiver(object):
             Calls :func:`on_new_gamestate`
             Sends an answer to the GC """
         try:
-            data, peer = self.socket.recvfrom(GameState.sizeof())
+            data, peer, receive_time = self._receive(self.socket)
+            PACKETS_RECEIVED.inc()
+
+            if self.drain_socket is not None:
+                packets = self._drain_backlog(data, peer, receive_time)
+            elif self._check_sequence(data, peer, receive_time):
+                packets = ((data, peer, receive_time),)
+            else:
+                packets = ()
+            for data, peer, receive_time in packets:
+                if self.ring is not None:
+                    # Everything else happens in the ring consumers
+                    self.ring.publish(data, receive_time, peer)
+                    if data.startswith(PACKET_PREFIX):
+                        self.answer_to_gamecontroller(peer)
+                    continue
+
+                if self.process_packet(data, peer, receive_time):
+                    # Answer the GameController
+                    self.answer_to_gamecontroller(peer)
 
-            print(len(data))
+        except AssertionError as ae:
+            logger.error(ae.message)
+        except socket.timeout:
+            # Normal between packages, the link watchdog reports real silence
+            logger.debug("Socket timeout")
+
+    def _receive(self, sock):
+        """ Reads one datagram, returns (data, peer, receive_time). The receive time
+            is the kernel timestamp if the socket profile got SO_TIMESTAMPNS """
+        if self.socket_profile.timestamping:
+            return recv_timestamped(sock, GameState.sizeof())
+        data, peer = sock.recvfrom(GameState.sizeof())
+        return data, peer, time.time()
+
+    def _check_sequence(self, data, peer, receive_time):
+        """ Tracks the packet number, returns False for a late package that should be dropped """
+        if len(data) <= PACKET_NUMBER_OFFSET or not data.startswith(PACKET_PREFIX):
+            # Left to the parser to complain about
+            return True
+        return self.sequence.accept(peer[0], data[PACKET_NUMBER_OFFSET], receive_time)
+
+    def enable_drain(self):
+        """ After a stall the socket buffer holds a backlog of outdated packages.
+            With draining enabled every wakeup reads all queued datagrams and
+            only the newest valid one of each source is parsed and answered """
+        self.drain_socket = socket.socket(fileno=os.dup(self.socket.fileno()))
+        self.drain_socket.setblocking(False)
+
+    def _drain_backlog(self, data, peer, receive_time):
+        """ Reads everything queued behind *data* without blocking,
+            returns the newest valid (data, peer, receive_time) of each source """
+        datagrams = [(data, peer, receive_time)]
+        while len(datagrams) < MAX_DRAIN:
+            try:
+                datagrams.append(self._receive(self.drain_socket))
+            except BlockingIOError:
+                break
+        PACKETS_RECEIVED.inc(len(datagrams) - 1)
+
+        # Later datagrams of a source replace earlier ones
+        newest = {}
+        malformed = late = 0
+        for data, peer, receive_time in datagrams:
+            if not data.startswith(PACKET_PREFIX):
+                malformed += 1
+            elif self._check_sequence(data, peer, receive_time):
+                newest[peer] = data, receive_time
+            else:
+                late += 1
+        skipped = len(datagrams) - malformed - late - len(newest)
+
+        if malformed:
+            PACKETS_MALFORMED.inc(malformed)
+            logger.warning(f"Dropped {malformed} packages with a foreign header or version")
+        if skipped:
+            PACKETS_COALESCED.inc(skipped)
+            logger.info(f"Skipped {skipped} backlogged packages")
+        return [(data, peer, receive_time) for peer, (data, receive_time) in newest.items()]
+
+    def process_packet(self, data, peer, receive_time=None):
+        """ Parses a package and calls :func:`on_new_gamestate`,
+            returns whether the package was valid """
+        try:
             # Throws a ConstError if it doesn't work
-            parsed_state = GameState.parse(data)
+            parsed_state = self.parse_packet(data)
+            PACKETS_PARSED.inc()
 
             # Assign the new package after it parsed successful to the state
             self.state = parsed_state
-            self.time = time.time()
+            self.time = receive_time if receive_time is not None else self.clock()
+
+            if self.shared_state is not None:
+                self.shared_state.publish(snapshot_from_state(parsed_state, self.team, self.player), data, self.time)
+
+            if self.match_store is not None:
+                self.match_store.append(parsed_state, self.time)
+
+            if self.game_clock is not None:
+                # The clock runs on monotonic time, take out the time spent in the ring
+                self.game_clock.update(parsed_state, self.monotonic() - (self.clock() - self.time))
 
             # Call the handler for the package
             self.on_new_gamestate(self.state)
+            self._record_delay(data, peer)
+            return True
 
-            # Answer the GameController
-            self.answer_to_gamecontroller(peer)
-
-        except AssertionError as ae:
-            logger.error(ae.message)
-        except socket.timeout:
-            logger.warning("Socket timeout")
         except ConstError:
+            PACKETS_MALFORMED.inc()
             logger.warning("Parse Error: Probably using wrong protocol version!")
         except Exception as e:
+            PACKETS_DROPPED.inc()
             logger.exception(e)
-            pass
+        return False
+
+    def _record_delay(self, data, peer):
+        """ Splits the delay of a handled package into network and handler delay """
+        self.delay_stats.record(STAGE_HANDLER, (self.clock() - self.time) * 1000)
+        network = self.sequence.network_delay(peer[0], data[PACKET_NUMBER_OFFSET], self.time) if peer else None
+        if network is not None:
+            self.delay_stats.record(STAGE_NETWORK, network * 1000)
+
+    def attach_ring(self, ring, record_path=None):
+        """ Moves parsing and dispatch off the receive thread: packets go into
+            *ring* (see :mod:`packet_ring`) and consumer threads handle them.
+            Returns the started consumers """
+        from packet_ring import DispatchConsumer, RecorderConsumer, LoggerConsumer, MetricsConsumer
+        consumers = [DispatchConsumer(ring, self), LoggerConsumer(ring, logger)]
+        if record_path:
+            consumers.append(RecorderConsumer(ring, record_path, GameState.sizeof()))
+        consumers.append(MetricsConsumer(ring, consumers))
+        for consumer in consumers:
+            consumer.start()
+        self.ring = ring
+        self.ring_consumers = consumers
+        return consumers
 
     def answer_to_gamecontroller(self, peer):
         """ Sends a life sign to the game controller """
         return_message = 0 if self.man_penalize else 2
 
-        data = Container(
-            header=b"RGrt",
-            version=GAME_CONTROLLER_RESPONSE_VERSION,
-            team=self.team,
-            player=self.player,
-            message=return_message)
+        key = (self.team, self.player, return_message)
+        data = self._answers.get(key)
+        if data is None:
+            data = self._answers[key] = ReturnData.build(Container(
+                header=b"RGrt",
+                version=GAME_CONTROLLER_RESPONSE_VERSION,
+                team=self.team,
+                player=self.player,
+                message=return_message))
         try:
             destination = peer[0], self.answer_port
-            self.socket.sendto(ReturnData.build(data), destination)
+            self.socket.sendto(data, destination)
+            ANSWERS_SENT.inc()
         except Exception as e:
-            logger.log("Network Error: %s" % str(e))
+            logger.error("Network Error: %s" % str(e))
 
     def on_new_gamestate(self, state):
         """ Is called with the new game state after receiving a package
@@ -136,14 +316,62 @@ class GameStateReceiver(object):
         """
         raise NotImplementedError()
 
+    def publish_shared_state(self, name):
+        """ Publishes every decoded packet into the shared memory block *name*
+            (see :mod:`shared_state`) """
+        from shared_state import SharedStatePublisher
+        self.shared_state = SharedStatePublisher(name)
+
+    def record_match(self, directory):
+        """ Appends every decoded packet to the columnar store in *directory*
+            (see :mod:`match_store`) """
+        from match_store import MatchStoreWriter
+        self.match_store = MatchStoreWriter(directory, "2014")
+
+    def attach_game_clock(self):
+        """ Interpolates the GC timers between packages (see :mod:`game_clock`),
+            returns the started clock for callbacks such as the end of the kickoff """
+        from game_clock import GameClock
+        self.game_clock = GameClock(clock=self.monotonic).start()
+        return self.game_clock
+
+    def remaining(self, timer=TIMER_MAIN):
+        """ Seconds left on a GC timer, interpolated if a game clock is attached,
+            else as of the last package. None if there was none yet """
+        if self.game_clock is not None:
+            return self.game_clock.remaining(timer)
+        if self.state is None:
+            return None
+        if timer == TIMER_SECONDARY:
+            return float(self.state.secondary_seconds_remaining)
+        return float(self.state.seconds_remaining)
+
     def get_last_state(self):
         return self.state, self.time
 
     def get_time_since_last_package(self):
-        return time.time() - self.time
+        """ Seconds since the last valid package, None if there was none yet """
+        if self.time is None:
+            return None
+        return self.clock() - self.time
 
     def stop(self):
         self.running = False
+        if self.ring is not None:
+            self.ring.close()
+            for consumer in self.ring_consumers:
+                consumer.join(timeout=2.0)
+        if self.shared_state is not None:
+            self.shared_state.close()
+            self.shared_state = None
+        if self.match_store is not None:
+            self.match_store.close()
+            self.match_store = None
+        if self.game_clock is not None:
+            self.game_clock.stop()
+        if self.drain_socket is not None:
+            self.drain_socket.close()
+            self.drain_socket = None
 
     def set_manual_penalty(self, flag):
         self.man_penalize = flag
@@ -156,5 +384,18 @@ class SampleGameStateReceiver(GameStateReceiver):
 
 if __name__ == '__main__':
     args = parser.parse_args(sys.argv[1:])
-    rec = SampleGameStateReceiver(team=args.team, player=args.player)
+    log_pipeline.setup_from_args(args, LOG_FORMAT)
+    rec = SampleGameStateReceiver(team=args.team, player=args.player, socket_profile=profile_from_args(args))
+    rec.sequence.drop_late = args.drop_late
+    if args.drain:
+        rec.enable_drain()
+    if args.ring or args.record:
+        from packet_ring import PacketRing
+        rec.attach_ring(PacketRing(), args.record)
+    if args.shared_state:
+        rec.publish_shared_state(args.shared_state)
+    if args.store:
+        rec.record_match(args.store)
+    if args.game_clock:
+        rec.attach_game_clock()
     rec.receive_forever()
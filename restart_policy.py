@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+"""
+Restart policies of :mod:`supervisor`, apart from it so command lines can be
+parsed without importing asyncio.
+"""
+
+
+class RestartPolicy(object):
+    """ When and how fast a script that exited on its own is started again """
+
+    NEVER = "never"
+    ON_FAILURE = "on-failure"
+    ALWAYS = "always"
+    MODES = (NEVER, ON_FAILURE, ALWAYS)
+
+    def __init__(self, mode=ON_FAILURE, initial_delay=0.1, max_delay=5.0, factor=2.0, max_restarts=None,
+                 reset_after=10.0):
+        if mode not in self.MODES:
+            raise ValueError(f"Unknown restart mode {mode}, expected one of {', '.join(self.MODES)}")
+        self.mode = mode
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.factor = factor
+        # Consecutive restarts allowed, None for no limit
+        self.max_restarts = max_restarts
+        # A script that ran this long before it exited starts the backoff over
+        self.reset_after = reset_after
+
+    def delay(self, returncode, attempt):
+        """Seconds to wait before restart number *attempt* (0 based), None for no restart"""
+        if self.mode == self.NEVER or (self.mode == self.ON_FAILURE and returncode == 0):
+            return None
+        if self.max_restarts is not None and attempt >= self.max_restarts:
+            return None
+        return min(self.initial_delay * self.factor ** attempt, self.max_delay)
+
+
+def add_restart_arguments(parser):
+    """Adds the restart policy options to an argument parser"""
+    parser.add_argument('--restart', choices=RestartPolicy.MODES, default=RestartPolicy.ON_FAILURE,
+                        help="restart policy of the state scripts")
+    parser.add_argument('--restart-script', action='append', default=[], metavar="SCRIPT=MODE",
+                        help="restart policy of one script, e.g. finished_state.py=never (repeatable)")
+    parser.add_argument('--restart-max', type=int, default=None,
+                        help="give up after this many quick restarts in a row (default: never give up)")
+    parser.add_argument('--restart-backoff', type=float, default=0.1,
+                        help="first restart delay in seconds, doubled for every quick restart in a row")
+
+
+def policies_from_args(args):
+    """(per script policies, default policy) from the options of :func:`add_restart_arguments`"""
+    def policy(mode):
+        return RestartPolicy(mode, initial_delay=args.restart_backoff, max_restarts=args.restart_max)
+    policies = {}
+    for option in args.restart_script:
+        script, _, mode = option.partition("=")
+        policies[script] = policy(mode)
+    return policies, policy(args.restart)
@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+"""
+Hot reload of state scripts from precompiled bytecode.
+
+A :class:`ScriptIndex` polls the script directories from a background
+thread.  Each pass costs one ``stat`` per directory and per known script:
+only a directory whose mtime changed is listed again, and a script is only
+compiled again when its (mtime, size, inode) signature changed.  Changed
+scripts are compiled right away into their regular ``__pycache__`` file, so
+a syntax error shows in the log when the file is saved, not when the state
+it belongs to comes up.
+
+Launchers ask :meth:`ScriptIndex.launch` what to run.  That is the bytecode
+of the last version that compiled, run directly by the interpreter, so the
+transition path never compiles and a broken edit never replaces a working
+version.  The next transition after a successful compile runs the new one::
+
+    index = ScriptIndex(["motion"]).start()
+    env = dict(os.environ)
+    subprocess.Popen([sys.executable, index.launch("motion/playing_state.py", env)], env=env)
+
+Bytecode runs with ``__file__`` pointing to the ``.pyc`` file; the script's
+directory is put on ``PYTHONPATH`` so its imports resolve as from source.
+"""
+
+import os
+import time
+import logging
+import threading
+
+from latency import StageLatencyTracker
+from metrics import REGISTRY
+
+logger = logging.getLogger('script_cache')
+
+# Seconds between two passes over the script directories
+PERIOD = 1.0
+STAGE_COMPILE = "compile"
+
+COMPILE_FAILURES = REGISTRY.counter("gc_script_compile_failures", "Script versions rejected because they do not compile")
+PRECOMPILED_LAUNCHES = REGISTRY.counter("gc_script_launches_precompiled", "Scripts launched from precompiled bytecode")
+SOURCE_LAUNCHES = REGISTRY.counter("gc_script_launches_source", "Scripts launched from source, compiled on the transition path")
+
+
+def _signature(stat):
+    return (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+
+
+class CompiledScript(object):
+    """ What the index knows about one script """
+
+    def __init__(self, source):
+        self.source = source
+        # Of the source at the last compile attempt
+        self.signature = None
+        # Bytecode of the last version that compiled, None if none did
+        self.bytecode = None
+        self.compiled_at = None
+        self.error = None
+
+
+class ScriptIndex(object):
+    """ Watches script directories and keeps their bytecode current, see the module documentation """
+
+    def __init__(self, directories, period=PERIOD):
+        self.directories = {os.path.abspath(directory): None for directory in directories}
+        self.period = period
+        self.scripts = {}
+        self.compile_times = StageLatencyTracker(stages=(STAGE_COMPILE,))
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def scan(self):
+        """One polling pass, compiles what changed, returns the number of compile attempts"""
+        attempts = 0
+        for directory, known in list(self.directories.items()):
+            try:
+                signature = _signature(os.stat(directory))
+            except OSError:
+                continue
+            if signature != known:
+                # Something was created, removed or renamed
+                self.directories[directory] = signature
+                try:
+                    names = [name for name in os.listdir(directory) if name.endswith(".py")]
+                except OSError:
+                    continue
+                with self.lock:
+                    for name in names:
+                        source = os.path.join(directory, name)
+                        if source not in self.scripts:
+                            self.scripts[source] = CompiledScript(source)
+            for script in [script for script in list(self.scripts.values())
+                           if os.path.dirname(script.source) == directory]:
+                try:
+                    signature = _signature(os.stat(script.source))
+                except OSError:
+                    # Removed, the last good version stays available
+                    continue
+                if signature != script.signature:
+                    script.signature = signature
+                    self._compile(script)
+                    attempts += 1
+        return attempts
+
+    def _compile(self, script):
+        # Imported here, a handler without hot reload does not need it
+        import py_compile
+        started = time.perf_counter()
+        try:
+            bytecode = py_compile.compile(script.source, doraise=True)
+        except py_compile.PyCompileError as e:
+            COMPILE_FAILURES.inc()
+            script.error = str(e.exc_value)
+            kept = "keeping the last version that compiled" if script.bytecode else "no version compiled yet"
+            logger.error(f"Rejected {script.source}, {kept}: {script.error}")
+            return
+        except OSError as e:
+            logger.error(f"Could not compile {script.source}: {e}")
+            return
+        compile_ms = (time.perf_counter() - started) * 1000
+        self.compile_times.record(STAGE_COMPILE, compile_ms)
+        with self.lock:
+            replaced = script.bytecode is not None
+            script.bytecode = bytecode
+            script.compiled_at = time.time()
+            script.error = None
+        logger.info(f"{'Reloaded' if replaced else 'Compiled'} {script.source} in {compile_ms:.2f} ms")
+
+    def launch(self, script, env):
+        """
+        The file to run for *script*: its bytecode if a version compiled, else
+        the script itself. Puts the script's directory on ``PYTHONPATH`` in
+        *env* when that is bytecode.
+        """
+        source = os.path.abspath(script)
+        with self.lock:
+            compiled = self.scripts.get(source)
+            bytecode = compiled.bytecode if compiled is not None else None
+        if bytecode is None or not os.path.exists(bytecode):
+            SOURCE_LAUNCHES.inc()
+            return script
+        PRECOMPILED_LAUNCHES.inc()
+        env["PYTHONPATH"] = os.pathsep.join(p for p in (os.path.dirname(source), env.get("PYTHONPATH")) if p)
+        return bytecode
+
+    def run(self):
+        while True:
+            try:
+                self.scan()
+            except Exception as e:
+                logger.exception(e)
+            if self.stop_event.wait(self.period):
+                return
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name="script_cache", daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join(timeout=1.0)
+
+
+def add_hot_reload_arguments(parser):
+    """Adds the hot reload options to an argument parser"""
+    parser.add_argument('--hot-reload', action='store_true',
+                        help="precompile the scripts in the background, reject edits that do not compile and "
+                             "run the new version from the next transition on")
+    parser.add_argument('--hot-reload-period', type=float, default=PERIOD,
+                        help=f"seconds between checks of the script directories (default: {PERIOD})")
+
+
+def index_from_args(args, directories):
+    """A started :class:`ScriptIndex` over *directories* exporting its compile times, None without --hot-reload"""
+    if not args.hot_reload:
+        return None
+    index = ScriptIndex(directories, args.hot_reload_period).start()
+    REGISTRY.stage_histograms("gc_script_compile_seconds", "Time spent compiling state scripts off the transition path",
+                              index.compile_times)
+    return index
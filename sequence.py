@@ -0,0 +1,242 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+"""
+Loss, duplication and reordering statistics from the GC ``packet_number``.
+
+The packet number is a single byte that wraps from 255 to 0, so numbers are
+compared with serial number arithmetic: a difference of 1..127 modulo 256 is
+a step forward, anything else a step back.  Each source keeps the highest
+number seen plus a bitmap of the numbers right below it, which tells a late
+packet that fills an earlier gap (reordered) from one seen before
+(duplicate).  A step back further than the bitmap, or a long silence, is a
+GameController restart and starts the sequence over.
+
+Interarrival jitter follows RFC 3550: the deviation of each interarrival
+time from the send period, smoothed with a gain of 1/16.  The GC has no
+send timestamps, so the period is estimated from the arrivals as well.
+
+Every tracker also feeds a :class:`delay_estimator.DelayEstimator` with the
+unwrapped packet numbers, which splits the receive delay into the part the
+network added (queuing) and the rest, which is ours.
+"""
+
+import time
+import threading
+
+from metrics import REGISTRY
+from delay_estimator import DelayEstimator, WARMUP
+
+# Monotonic, so a skipped number that shows up late is counted here and as reordered
+PACKETS_SKIPPED = REGISTRY.counter("gc_packets_skipped", "Packet numbers missing when a newer packet arrived")
+PACKETS_DUPLICATE = REGISTRY.counter("gc_packets_duplicate", "Packets whose number was seen before")
+PACKETS_REORDERED = REGISTRY.counter("gc_packets_reordered", "Packets that arrived after a newer one")
+SEQUENCE_RESETS = REGISTRY.counter("gc_sequence_resets", "Times a GameController packet sequence started over")
+
+# Verdicts of SequenceTracker.observe
+SEQ_FIRST = "first"
+SEQ_NEXT = "next"
+SEQ_GAP = "gap"
+SEQ_DUPLICATE = "duplicate"
+SEQ_REORDERED = "reordered"
+SEQ_RESET = "reset"
+
+# Late packets that are better not handled
+LATE_VERDICTS = (SEQ_DUPLICATE, SEQ_REORDERED)
+
+SEQUENCE_MODULO = 256
+# Packet numbers below the highest one that are remembered
+WINDOW = 64
+# Without a packet for this long the next one starts a new sequence
+RESET_AFTER = 5.0
+JITTER_GAIN = 1.0 / 16
+
+
+class SequenceTracker(object):
+    """ Sequence state of one packet source """
+
+    def __init__(self, reset_after=RESET_AFTER):
+        self.reset_after = reset_after
+        self.highest = None
+        # Unwrapped number of the highest packet, counting on across wraparounds
+        self.index = 0
+        # Bit i set: packet number highest - i was received
+        self.seen = 0
+        self.last_arrival = None
+        self.received = 0
+        self.lost = 0
+        self.duplicates = 0
+        self.reordered = 0
+        self.resets = 0
+        self.period = None
+        self.jitter = 0.0
+        self.delay = DelayEstimator()
+
+    def observe(self, packet_number, arrival):
+        """Feeds one packet, returns its verdict (one of the SEQ_* constants)"""
+        self.received += 1
+        if self.highest is None:
+            self._restart(packet_number, arrival)
+            return SEQ_FIRST
+        if arrival - self.last_arrival > self.reset_after:
+            self.resets += 1
+            SEQUENCE_RESETS.inc()
+            self._restart(packet_number, arrival)
+            return SEQ_RESET
+
+        delta = (packet_number - self.highest) % SEQUENCE_MODULO
+        if delta == 0:
+            self.duplicates += 1
+            PACKETS_DUPLICATE.inc()
+            return SEQ_DUPLICATE
+
+        if delta < SEQUENCE_MODULO // 2:
+            if delta >= WINDOW and (self.period is None or arrival - self.last_arrival < delta * self.period / 2):
+                # Far more packets skipped than could have been sent in the meantime
+                self.resets += 1
+                SEQUENCE_RESETS.inc()
+                self._restart(packet_number, arrival)
+                return SEQ_RESET
+            # Forward, delta - 1 numbers were skipped (for now)
+            self._update_jitter(arrival - self.last_arrival, delta)
+            self.highest = packet_number
+            self.index += delta
+            self.seen = ((self.seen << delta) | 1) & ((1 << WINDOW) - 1)
+            self.last_arrival = arrival
+            self.delay.observe(self.index, arrival)
+            if delta == 1:
+                return SEQ_NEXT
+            self.lost += delta - 1
+            PACKETS_SKIPPED.inc(delta - 1)
+            return SEQ_GAP
+
+        distance = SEQUENCE_MODULO - delta
+        if distance >= WINDOW:
+            self.resets += 1
+            SEQUENCE_RESETS.inc()
+            self._restart(packet_number, arrival)
+            return SEQ_RESET
+        if self.seen & (1 << distance):
+            self.duplicates += 1
+            PACKETS_DUPLICATE.inc()
+            return SEQ_DUPLICATE
+        # Late, but it fills a gap that was counted as lost
+        self.seen |= 1 << distance
+        self.delay.observe(self.index - distance, arrival)
+        self.reordered += 1
+        self.lost -= 1
+        PACKETS_REORDERED.inc()
+        return SEQ_REORDERED
+
+    def _restart(self, packet_number, arrival):
+        self.highest = packet_number
+        self.index = 0
+        self.seen = 1
+        self.last_arrival = arrival
+        self.period = None
+        self.delay.reset()
+        self.delay.observe(0, arrival)
+
+    def unwrap(self, packet_number):
+        """Unwrapped index of a packet number near the highest one"""
+        delta = (packet_number - self.highest) % SEQUENCE_MODULO
+        if delta >= SEQUENCE_MODULO // 2:
+            delta -= SEQUENCE_MODULO
+        return self.index + delta
+
+    def network_delay(self, packet_number, arrival):
+        """Queuing delay the network added to a packet, None while it is unknown"""
+        if self.highest is None:
+            return None
+        return self.delay.queuing_delay(self.unwrap(packet_number), arrival)
+
+    def _update_jitter(self, interarrival, steps):
+        per_packet = interarrival / steps
+        if self.period is None:
+            self.period = per_packet
+            return
+        deviation = abs(interarrival - steps * self.period)
+        self.jitter += (deviation - self.jitter) * JITTER_GAIN
+        self.period += (per_packet - self.period) * JITTER_GAIN
+
+    def loss_ratio(self):
+        expected = self.received - self.duplicates + self.lost
+        return self.lost / expected if expected else 0.0
+
+    def get_statistics(self):
+        return {
+            "received": self.received,
+            "lost": self.lost,
+            "duplicates": self.duplicates,
+            "reordered": self.reordered,
+            "resets": self.resets,
+            "loss_ratio": self.loss_ratio(),
+            "period_ms": self.period * 1000 if self.period is not None else None,
+            "jitter_ms": self.jitter * 1000,
+            "skew_ppm": self.delay.skew_ppm() if self.delay.count >= WARMUP else None,
+            "queuing_delay_ms": self.delay.get_statistics()["queuing_delay_ms"],
+        }
+
+
+class SequenceMonitor(object):
+    """
+    Sequence trackers of all packet sources, keyed by sender address.
+
+    Usage:
+        monitor = SequenceMonitor(drop_late=True)
+        if monitor.accept(peer[0], packet_number, receive_time):
+            handle(packet)
+    """
+
+    def __init__(self, drop_late=False, reset_after=RESET_AFTER):
+        self.drop_late = drop_late
+        self.reset_after = reset_after
+        self.trackers = {}
+        self.lock = threading.Lock()
+        REGISTRY.gauge("gc_interarrival_jitter_seconds", "Interarrival jitter of the GameController packets",
+                       self.max_jitter)
+
+    def observe(self, source, packet_number, arrival=None):
+        """Feeds one packet, returns its verdict"""
+        if arrival is None:
+            arrival = time.time()
+        with self.lock:
+            tracker = self.trackers.get(source)
+            if tracker is None:
+                tracker = self.trackers[source] = SequenceTracker(self.reset_after)
+            return tracker.observe(packet_number, arrival)
+
+    def accept(self, source, packet_number, arrival=None):
+        """Feeds one packet, returns False if it is late and late packets are dropped"""
+        verdict = self.observe(source, packet_number, arrival)
+        return not (self.drop_late and verdict in LATE_VERDICTS)
+
+    def network_delay(self, source, packet_number, arrival):
+        """Queuing delay the network added to a packet of *source*, None while unknown"""
+        with self.lock:
+            tracker = self.trackers.get(source)
+            return tracker.network_delay(packet_number, arrival) if tracker is not None else None
+
+    def max_jitter(self):
+        with self.lock:
+            return max((tracker.jitter for tracker in self.trackers.values()), default=0.0)
+
+    def get_statistics(self):
+        """Statistics per source"""
+        with self.lock:
+            return {source: tracker.get_statistics() for source, tracker in self.trackers.items()}
+
+    def print_statistics(self, logger):
+        statistics = self.get_statistics()
+        if not statistics:
+            return
+        logger.info("Packet sequence statistics:")
+        for source, stats in statistics.items():
+            period = f"{stats['period_ms']:.1f} ms" if stats['period_ms'] is not None else "-"
+            logger.info(f"  {source}: received={stats['received']} lost={stats['lost']} "
+                        f"({stats['loss_ratio'] * 100:.2f}%) duplicates={stats['duplicates']} "
+                        f"reordered={stats['reordered']} resets={stats['resets']} "
+                        f"period={period} jitter={stats['jitter_ms']:.2f} ms")
+            if stats['queuing_delay_ms'] is not None:
+                skew = f"{stats['skew_ppm']:.0f} ppm" if stats['skew_ppm'] is not None else "-"
+                logger.info(f"  {source}: clock skew={skew} queuing delay={stats['queuing_delay_ms']:.2f} ms")
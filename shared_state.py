@@ -0,0 +1,290 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+"""
+Publishes the latest game state in shared memory for any number of local readers.
+
+The receiver is the only writer.  Every decoded packet is copied into a
+``multiprocessing.shared_memory`` block guarded by a sequence lock: the
+sequence number is odd while a write is in progress, so a reader copies the
+block, re-reads the sequence and retries if it changed.  Reading the latest
+state is therefore a few memory copies and no system call.
+
+Readers that want to sleep until something changes subscribe to a Unix
+datagram socket; the writer sends each subscriber one byte per update and
+forgets subscribers that went away.  A waiting reader that hears nothing for
+a while subscribes again, and attaches to the new block if the writer was
+restarted and replaced it, so a writer restart never leaves it waiting on a
+dead address.
+
+Layout of the block (little endian)::
+
+    0   magic      4s  b"GCsh"
+    4   layout     H
+    6   raw size   H   length of the raw packet below
+    8   sequence   Q   odd while the writer is busy
+    16  recv time  d   time.time() of the packet
+    24  snapshot   state_channel.FIELDS packed back to back
+    ..  raw packet up to RAW_CAPACITY bytes
+"""
+
+import os
+import time
+import socket
+import select
+import struct
+import itertools
+from multiprocessing import shared_memory
+
+from state_channel import FIELDS, FIELD_NAMES
+
+DEFAULT_NAME = "gc_state"
+
+MAGIC = b"GCsh"
+LAYOUT_VERSION = 1
+HEADER = struct.Struct("<4sHH")
+SEQUENCE = struct.Struct("<Q")
+RECEIVE_TIME = struct.Struct("<d")
+SNAPSHOT = struct.Struct("<" + "".join(fmt for _, fmt in FIELDS))
+
+SEQUENCE_OFFSET = HEADER.size
+RECEIVE_TIME_OFFSET = SEQUENCE_OFFSET + SEQUENCE.size
+SNAPSHOT_OFFSET = RECEIVE_TIME_OFFSET + RECEIVE_TIME.size
+RAW_OFFSET = SNAPSHOT_OFFSET + SNAPSHOT.size
+RAW_CAPACITY = 1024
+BLOCK_SIZE = RAW_OFFSET + RAW_CAPACITY
+
+# Blocks written by this process, their resource tracker entry belongs to the writer
+_published = set()
+
+# Readers give up after this many torn reads in a row, the writer has died mid-write
+MAX_READ_ATTEMPTS = 10000
+# A waiting reader subscribes again after this many seconds without a notification
+RESUBSCRIBE_INTERVAL = 1.0
+
+
+def _notify_address(name):
+    # Abstract namespace, nothing to clean up on disk
+    return "\0" + name + ".notify"
+
+
+def _block_inode(name):
+    """Identifies the block currently behind *name*, None if there is none (or no /dev/shm)"""
+    try:
+        return os.stat(f"/dev/shm/{name}").st_ino
+    except OSError:
+        return None
+
+
+class SharedStatePublisher(object):
+    """ Writer side, owned by the receiver """
+
+    def __init__(self, name=DEFAULT_NAME):
+        self.name = name
+        try:
+            self.shm = shared_memory.SharedMemory(name=name, create=True, size=BLOCK_SIZE)
+        except FileExistsError:
+            # Left over from a previous run of the receiver, take it over
+            self.shm = shared_memory.SharedMemory(name=name, create=False)
+        _published.add(name)
+        self.buffer = self.shm.buf
+        HEADER.pack_into(self.buffer, 0, MAGIC, LAYOUT_VERSION, 0)
+        self.sequence = SEQUENCE.unpack_from(self.buffer, SEQUENCE_OFFSET)[0] & ~1
+        SEQUENCE.pack_into(self.buffer, SEQUENCE_OFFSET, self.sequence)
+
+        self.notify_socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.notify_socket.bind(_notify_address(name))
+        self.notify_socket.setblocking(False)
+        self.subscribers = set()
+
+    def publish(self, snapshot, raw=b"", receive_time=None):
+        """Writes a snapshot dict (see :func:`state_channel.snapshot_from_state`) and the raw packet"""
+        raw = raw[:RAW_CAPACITY]
+        buffer = self.buffer
+        self.sequence += 1
+        SEQUENCE.pack_into(buffer, SEQUENCE_OFFSET, self.sequence)
+        RECEIVE_TIME.pack_into(buffer, RECEIVE_TIME_OFFSET, receive_time if receive_time is not None else time.time())
+        SNAPSHOT.pack_into(buffer, SNAPSHOT_OFFSET, *[snapshot[name] for name in FIELD_NAMES])
+        buffer[RAW_OFFSET:RAW_OFFSET + len(raw)] = raw
+        HEADER.pack_into(buffer, 0, MAGIC, LAYOUT_VERSION, len(raw))
+        self.sequence += 1
+        SEQUENCE.pack_into(buffer, SEQUENCE_OFFSET, self.sequence)
+        self._notify()
+
+    def _notify(self):
+        while True:
+            try:
+                _, address = self.notify_socket.recvfrom(16)
+            except BlockingIOError:
+                break
+            self.subscribers.add(address)
+        for address in list(self.subscribers):
+            try:
+                self.notify_socket.sendto(b"!", address)
+            except BlockingIOError:
+                # The reader has unread notifications already
+                pass
+            except OSError:
+                self.subscribers.discard(address)
+
+    def close(self):
+        self.notify_socket.close()
+        self.buffer = None
+        self.shm.close()
+        _published.discard(self.name)
+        try:
+            self.shm.unlink()
+        except FileNotFoundError:
+            pass
+
+
+class SharedStateReader(object):
+    """ Reader side, usable from any local process """
+
+    _ids = itertools.count()
+
+    def __init__(self, name=DEFAULT_NAME):
+        self.name = name
+        self.inode = _block_inode(name)
+        self.shm = self._attach(name)
+        self.buffer = self.shm.buf
+        if bytes(self.buffer[0:4]) != MAGIC:
+            raise ValueError(f"Shared memory {name} does not hold a game state")
+        self.last_sequence = 0
+        self.notify_socket = None
+
+    @staticmethod
+    def _attach(name):
+        try:
+            return shared_memory.SharedMemory(name=name, create=False, track=False)
+        except TypeError:
+            # Before Python 3.13 attaching registers the block with the resource tracker,
+            # which would unlink it when this reader exits
+            shm = shared_memory.SharedMemory(name=name, create=False)
+            if name in _published:
+                return shm
+            try:
+                from multiprocessing import resource_tracker
+                resource_tracker.unregister(shm._name, "shared_memory")
+            except Exception:
+                pass
+            return shm
+
+    def read(self):
+        """
+        Returns (sequence, receive_time, snapshot dict) of the latest packet,
+        or None if nothing was published yet.
+        """
+        buffer = self.buffer
+        for _ in range(MAX_READ_ATTEMPTS):
+            before = SEQUENCE.unpack_from(buffer, SEQUENCE_OFFSET)[0]
+            if before & 1:
+                continue
+            receive_time = RECEIVE_TIME.unpack_from(buffer, RECEIVE_TIME_OFFSET)[0]
+            values = SNAPSHOT.unpack_from(buffer, SNAPSHOT_OFFSET)
+            if SEQUENCE.unpack_from(buffer, SEQUENCE_OFFSET)[0] != before:
+                continue
+            if before == 0:
+                return None
+            self.last_sequence = before
+            return before, receive_time, dict(zip(FIELD_NAMES, values))
+        raise RuntimeError("Shared game state stays inconsistent, is the writer stuck mid-write?")
+
+    def read_raw(self):
+        """Returns (sequence, raw packet bytes) of the latest packet, or None"""
+        buffer = self.buffer
+        for _ in range(MAX_READ_ATTEMPTS):
+            before = SEQUENCE.unpack_from(buffer, SEQUENCE_OFFSET)[0]
+            if before & 1:
+                continue
+            size = HEADER.unpack_from(buffer, 0)[2]
+            raw = bytes(buffer[RAW_OFFSET:RAW_OFFSET + size])
+            if SEQUENCE.unpack_from(buffer, SEQUENCE_OFFSET)[0] != before:
+                continue
+            return (before, raw) if before else None
+        raise RuntimeError("Shared game state stays inconsistent, is the writer stuck mid-write?")
+
+    def changed(self):
+        """True if a newer packet was published since the last read()"""
+        return SEQUENCE.unpack_from(self.buffer, SEQUENCE_OFFSET)[0] > self.last_sequence
+
+    def _subscribe(self):
+        """Asks the writer for notifications, returns False if it is not listening (yet)"""
+        if self.notify_socket is None:
+            self.notify_socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            self.notify_socket.bind(f"\0{self.name}.sub.{os.getpid()}.{next(self._ids)}")
+            self.notify_socket.setblocking(False)
+        try:
+            self.notify_socket.sendto(b"s", _notify_address(self.name))
+        except (ConnectionRefusedError, FileNotFoundError, BlockingIOError):
+            return False
+        return True
+
+    def _reattach(self):
+        """Follows a restarted writer that replaced the block, returns whether it did"""
+        inode = _block_inode(self.name)
+        if inode is None or inode == self.inode:
+            return False
+        try:
+            shm = self._attach(self.name)
+        except FileNotFoundError:
+            return False
+        if bytes(shm.buf[0:4]) != MAGIC:
+            shm.close()
+            return False
+        self.buffer = None
+        self.shm.close()
+        self.shm, self.buffer, self.inode = shm, shm.buf, inode
+        # The new writer counts from zero
+        self.last_sequence = 0
+        return True
+
+    def fileno(self):
+        """Readable whenever the writer published something, subscribes on first use"""
+        if self.notify_socket is None:
+            self._subscribe()
+        return self.notify_socket.fileno()
+
+    def wait(self, timeout=None):
+        """Blocks until a newer packet than the last read() is available, then returns it"""
+        fd = self.fileno()
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not self.changed():
+            remaining = None if deadline is None else max(0.0, deadline - time.monotonic())
+            readable, _, _ = select.select([fd], [], [], min(RESUBSCRIBE_INTERVAL, remaining)
+                                           if remaining is not None else RESUBSCRIBE_INTERVAL)
+            if not readable:
+                # The writer may have restarted and forgotten us, or replaced the block
+                self._reattach()
+                self._subscribe()
+                if remaining is not None and remaining <= RESUBSCRIBE_INTERVAL:
+                    return self.read() if self.changed() else None
+                continue
+            try:
+                while self.notify_socket.recv(64):
+                    pass
+            except BlockingIOError:
+                pass
+        return self.read()
+
+    def close(self):
+        if self.notify_socket is not None:
+            self.notify_socket.close()
+        self.buffer = None
+        self.shm.close()
+
+
+if __name__ == '__main__':
+    # Prints every update published by a running receiver
+    import sys
+    reader = SharedStateReader(sys.argv[1] if len(sys.argv) > 1 else DEFAULT_NAME)
+    try:
+        while True:
+            result = reader.wait(timeout=5.0)
+            if result is None:
+                print("No update for 5 s")
+                continue
+            sequence, receive_time, snapshot = result
+            print(f"#{sequence >> 1} {time.time() - receive_time:.6f}s old {snapshot}")
+    except KeyboardInterrupt:
+        reader.close()
@@ -0,0 +1,629 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+"""
+Virtual-time simulation of the handler logic.
+
+:class:`Simulation` runs the real ``handler_old.GameStateHandler`` without a
+socket, without processes and without waiting: the receiver and the link
+watchdog read a :class:`VirtualClock`, packets come from memory and scripts
+are :class:`FakeProcess` objects that exit, hang on SIGTERM, crash or fail
+to start when the seeded random generator says so.  A full 20 minute match
+plays out in a fraction of a second and the same seed gives the same run,
+down to the digest of its event log.
+
+Packets come from a randomized match (:func:`random_match`), a script of
+game states or a capture file of :mod:`capture`.  A script has one step per
+line, options stay in effect for the following steps::
+
+    # state   seconds  options
+    INITIAL   10
+    READY     30       kickoff=2
+    SET       5
+    PLAYING   300      score=0:1
+    SILENCE   12
+    FINISHED  60       half=2 secondary=TIMEOUT
+
+After every packet and every watchdog period the run checks that the
+handler is not stuck on an old state, that at most one script runs, that it
+is the script of the current state and that the current state does not go
+without its script (failed starts and crashes aside); after ``stop()`` no
+script may be left running.  Everything else is reported as a finding.
+:data:`REGRESSIONS` are scripts of bugs found this way, ``--regressions``
+plays all of them::
+
+    python simulation.py --runs 2000 --processes 4
+    python simulation.py --script match.txt --verbose
+    python simulation.py --capture logs/match.cap
+    python simulation.py --regressions
+
+The exit status is 1 if any run had a finding.
+"""
+
+import os
+import sys
+import copy
+import time
+import random
+import struct
+import hashlib
+import logging
+import argparse
+import subprocess
+
+from construct import Container
+from gamestate import GameState
+from metrics import PACKETS_DROPPED
+import handler_old
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# Where packets come from, the sequence monitor keys its statistics on it
+PEER = ("10.0.0.1", 3838)
+# Arbitrary wall clock start, packets carry it as their receive time
+EPOCH = 1700000000.0
+# Seconds between packets of the GameController
+PACKET_PERIOD = 0.5
+# Seconds between two watchdog checks, as its thread would do
+WATCHDOG_PERIOD = 0.1
+HALF_SECONDS = 600
+# Seconds the current state may go without its script: a transition plus a restart
+MISSING_SCRIPT_AFTER = 1.0
+
+# Byte offsets of the fields that change from packet to packet
+PACKET_NUMBER_OFFSET = 6
+GAME_STATE_OFFSET = 9
+TIMES_OFFSET = 20
+TIMES = struct.Struct("<hh")
+
+BEHAVIOR_NORMAL = "normal"
+BEHAVIOR_SLOW_EXIT = "slow_exit"
+BEHAVIOR_IGNORES_SIGTERM = "ignores_sigterm"
+BEHAVIOR_CRASHES = "crashes"
+BEHAVIOR_START_FAILS = "start_fails"
+# Weights of the behaviors of launched scripts with process faults
+BEHAVIORS = (
+    (BEHAVIOR_NORMAL, 0.85),
+    (BEHAVIOR_SLOW_EXIT, 0.05),
+    (BEHAVIOR_IGNORES_SIGTERM, 0.04),
+    (BEHAVIOR_CRASHES, 0.04),
+    (BEHAVIOR_START_FAILS, 0.02),
+)
+
+STATE_NAMES = {name[len("STATE_"):]: state.value for name, state in handler_old.GameStates.__members__.items()}
+SILENCE = "SILENCE"
+
+
+class VirtualClock(object):
+    """ Time that only moves when the simulation (or a fake wait) moves it """
+
+    def __init__(self, epoch=EPOCH):
+        self.epoch = epoch
+        self.now = 0.0
+
+    def time(self):
+        return self.epoch + self.now
+
+    def monotonic(self):
+        return self.now
+
+    def advance_to(self, now):
+        """Moves to *now*, never backwards"""
+        if now > self.now:
+            self.now = now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+class FakeProcess(object):
+    """ The part of subprocess.Popen the handler uses, exiting on virtual time """
+
+    def __init__(self, launcher, pid, cmd, behavior):
+        self.launcher = launcher
+        self.clock = launcher.clock
+        self.pid = pid
+        self.args = cmd
+        self.script = cmd[1]
+        self.behavior = behavior
+        self.stdout = None
+        self.stderr = None
+        self.returncode = None
+        self.started_at = self.clock.now
+        # Virtual time of the exit, None while it would run forever
+        self.exit_at = None
+        self.exit_code = None
+        if behavior == BEHAVIOR_CRASHES:
+            self._exit_after(launcher.rng.uniform(0.1, 60.0), 1)
+
+    def _exit_after(self, seconds, code):
+        exit_at = self.clock.now + seconds
+        if self.exit_at is None or exit_at < self.exit_at:
+            self.exit_at = exit_at
+            self.exit_code = code
+
+    def poll(self):
+        if self.returncode is None and self.exit_at is not None and self.exit_at <= self.clock.now:
+            self.returncode = self.exit_code
+            self.launcher.log("exit", self.pid, self.returncode, at=self.exit_at)
+        return self.returncode
+
+    def wait(self, timeout=None):
+        if self.poll() is not None:
+            return self.returncode
+        if self.exit_at is None or (timeout is not None and self.exit_at > self.clock.now + timeout):
+            if timeout is None:
+                raise RuntimeError(f"wait() without a timeout on {self.script} (PID: {self.pid}) would block forever")
+            self.clock.sleep(timeout)
+            raise subprocess.TimeoutExpired(self.args, timeout)
+        self.clock.advance_to(self.exit_at)
+        return self.poll()
+
+    def terminate(self):
+        self.launcher.log("terminate", self.pid)
+        if self.behavior == BEHAVIOR_IGNORES_SIGTERM:
+            return
+        slow = self.behavior == BEHAVIOR_SLOW_EXIT
+        self._exit_after(self.launcher.rng.uniform(0.5, 3.0) if slow else self.launcher.rng.uniform(0.001, 0.05), -15)
+
+    def kill(self):
+        self.launcher.log("kill", self.pid)
+        self._exit_after(0.001, -9)
+
+
+class FakeLauncher(object):
+    """ Stands in for subprocess.Popen, keeps every process it handed out """
+
+    def __init__(self, clock, rng, faults=True):
+        self.clock = clock
+        self.rng = rng
+        self.faults = faults
+        self.next_pid = 1000
+        self.processes = []
+        # The processes that did not exit when last asked
+        self.running = []
+        self.events = []
+        # Whether the last launch raised
+        self.last_failed = False
+
+    def log(self, event, *details, at=None):
+        self.events.append((round(self.clock.now if at is None else at, 6), event) + details)
+
+    def __call__(self, cmd, **kwargs):
+        behavior = BEHAVIOR_NORMAL
+        if self.faults:
+            names, weights = zip(*BEHAVIORS)
+            behavior = self.rng.choices(names, weights)[0]
+        self.last_failed = behavior == BEHAVIOR_START_FAILS
+        if self.last_failed:
+            self.log("start_failed", os.path.relpath(cmd[1], HERE))
+            raise OSError(f"simulated start failure of {cmd[1]}")
+        self.next_pid += 1
+        process = FakeProcess(self, self.next_pid, cmd, behavior)
+        self.processes.append(process)
+        self.running.append(process)
+        self.log("launch", process.pid, os.path.relpath(process.script, HERE), behavior)
+        return process
+
+    def alive(self):
+        self.running = [process for process in self.running if process.poll() is None]
+        return self.running
+
+
+class MemoParser(object):
+    """
+    GameState.parse for packets that mostly repeat: packets that only differ
+    in the packet number and the two times are parsed once, later ones are a
+    copy with those three fields patched.
+    """
+
+    def __init__(self):
+        self.parsed = {}
+        self.misses = 0
+
+    def __call__(self, data):
+        key = data[:PACKET_NUMBER_OFFSET] + data[PACKET_NUMBER_OFFSET + 1:TIMES_OFFSET] + data[TIMES_OFFSET + TIMES.size:]
+        template = self.parsed.get(key)
+        if template is None:
+            self.misses += 1
+            template = self.parsed[key] = GameState.parse(data)
+        state = copy.copy(template)
+        state.packet_number = data[PACKET_NUMBER_OFFSET]
+        state.seconds_remaining, state.secondary_seconds_remaining = TIMES.unpack_from(data, TIMES_OFFSET)
+        return state
+
+
+class PacketFactory(object):
+    """ Builds packets, GameState.build only runs once per combination of slow changing fields """
+
+    def __init__(self, team=1, opponent=2):
+        self.team = team
+        self.opponent = opponent
+        self.templates = {}
+
+    def _build(self, state, first_half, kick_off, secondary, score):
+        robot = dict(penalty=0, secs_till_unpenalized=0, number_of_warnings=0, number_of_yellow_cards=0,
+                     number_of_red_cards=0, goalkeeper=False)
+
+        def team(number, goals):
+            return dict(team_number=number, team_color="BLUE" if number == self.team else "RED", score=goals,
+                        penalty_shot=0, single_shots=0, coach_sequence=0, coach_message="", coach=robot,
+                        players=[robot] * 11)
+
+        return GameState.build(Container(
+            packet_number=0, players_per_team=4, game_type=0, game_state=state, first_half=first_half,
+            kick_of_team=kick_off, secondary_state=secondary, secondary_state_info=b"\0\0\0\0",
+            drop_in_team=False, drop_in_time=0, seconds_remaining=0, secondary_seconds_remaining=0,
+            teams=[team(self.team, score[0]), team(self.opponent, score[1])]))
+
+    def packet(self, packet_number, state, seconds, secondary_seconds=0, first_half=True, kick_off=1,
+               secondary="STATE_NORMAL", score=(0, 0)):
+        key = (state, first_half, kick_off, secondary, score)
+        template = self.templates.get(key)
+        if template is None:
+            template = self.templates[key] = self._build(*key)
+        packet = bytearray(template)
+        packet[PACKET_NUMBER_OFFSET] = packet_number & 0xFF
+        TIMES.pack_into(packet, TIMES_OFFSET, seconds, secondary_seconds)
+        return bytes(packet)
+
+
+class Step(object):
+    """ One game state held for a while, or a silence of the GameController """
+
+    def __init__(self, state, seconds, half=1, kick_off=1, secondary="STATE_NORMAL", score=(0, 0)):
+        self.state = state
+        self.seconds = seconds
+        self.half = half
+        self.kick_off = kick_off
+        self.secondary = secondary
+        self.score = score
+
+    def __repr__(self):
+        return f"Step({self.state}, {self.seconds:.1f}, half={self.half}, score={self.score[0]}:{self.score[1]})"
+
+
+def parse_script(lines, source="<script>"):
+    """The steps of the lines of a script, see the module documentation"""
+    steps = []
+    options = dict(half=1, kick_off=1, secondary="STATE_NORMAL", score=(0, 0))
+    for line_number, line in enumerate(lines, 1):
+        words = line.split("#", 1)[0].split()
+        if not words:
+            continue
+        try:
+            name, seconds = words[0].upper(), float(words[1])
+            for word in words[2:]:
+                key, value = word.split("=", 1)
+                if key == "half":
+                    options["half"] = int(value)
+                elif key == "kickoff":
+                    options["kick_off"] = int(value)
+                elif key == "secondary":
+                    options["secondary"] = "STATE_" + value.upper()
+                elif key == "score":
+                    options["score"] = tuple(int(goals) for goals in value.split(":"))
+                else:
+                    raise ValueError(f"unknown option {key}")
+            if name != SILENCE and name not in STATE_NAMES:
+                raise ValueError(f"unknown state {name}")
+        except (IndexError, ValueError) as e:
+            raise ValueError(f"{source}:{line_number}: {e}")
+        steps.append(Step(name, seconds, **options))
+    return steps
+
+
+def load_script(path):
+    """The steps of a script file, see the module documentation"""
+    with open(path) as f:
+        return parse_script(f, path)
+
+
+# (name, script, safe state) of bugs the simulation found, played by --regressions
+REGRESSIONS = (
+    # The safe behavior had nothing to fall back on, yet its state counted as current,
+    # so the first packet of that state never started its script
+    ("silence_before_first_packet", """
+        SILENCE  15
+        INITIAL  5
+        READY    5
+    """, handler_old.GameStates.STATE_INITIAL.value),
+)
+
+
+def regression_runs():
+    """Plays every scenario of :data:`REGRESSIONS` without process faults"""
+    for seed, (name, script, safe_state) in enumerate(REGRESSIONS):
+        packets = packets_from_steps(parse_script(script.splitlines(), name))
+        result = Simulation(packets, seed, safe_state, process_faults=False).run()
+        result.name = name
+        yield result
+
+
+def random_match(rng):
+    """Steps of a randomized two half match with goals, timeouts and GameController silences"""
+    steps = []
+    score = [0, 0]
+    kick_off = rng.choice((1, 2))
+
+    def add(state, seconds, half, secondary="STATE_NORMAL"):
+        steps.append(Step(state, seconds, half, kick_off, secondary, tuple(score)))
+        if rng.random() < 0.08:
+            # Short ones go stale, long ones end in the safe behavior
+            steps.append(Step(SILENCE, rng.choice((rng.uniform(0.5, 3.0), rng.uniform(5.0, 20.0))), half))
+
+    for half in (1, 2):
+        add("INITIAL", rng.uniform(5.0, 60.0), half)
+        remaining = HALF_SECONDS
+        while remaining > 0:
+            if rng.random() < 0.1:
+                add("INITIAL", rng.uniform(10.0, 60.0), half, "STATE_TIMEOUT")
+            add("READY", rng.uniform(5.0, 45.0), half)
+            add("SET", rng.uniform(1.0, 8.0), half)
+            playing = min(remaining, rng.expovariate(1.0 / 200))
+            remaining -= playing
+            add("PLAYING", playing, half)
+            if remaining > 0:
+                scorer = rng.choice((0, 1))
+                score[scorer] += 1
+                kick_off = 2 if scorer == 0 else 1
+        add("FINISHED", rng.uniform(30.0, 120.0) if half == 1 else rng.uniform(5.0, 30.0), half)
+    return steps
+
+
+def packets_from_steps(steps, rng=None, loss=0.0, duplicates=0.0, reorder=0.0, period=PACKET_PERIOD):
+    """(seconds, packet bytes) of the GameController playing *steps*, with optional network faults"""
+    factory = PacketFactory()
+    packets = []
+    now = 0.0
+    packet_number = 0
+    remaining = {1: HALF_SECONDS, 2: HALF_SECONDS}
+    for step in steps:
+        end = now + step.seconds
+        if step.state == SILENCE:
+            now = end
+            continue
+        while now < end:
+            if step.state == "PLAYING":
+                remaining[step.half] = max(0, remaining[step.half] - period)
+            packet = factory.packet(packet_number, "STATE_" + step.state, int(remaining[step.half]),
+                                    first_half=step.half == 1, kick_off=step.kick_off,
+                                    secondary=step.secondary, score=step.score)
+            packet_number += 1
+            now += period
+            if rng is None or rng.random() >= loss:
+                packets.append((now, packet))
+                if rng is not None and rng.random() < duplicates:
+                    packets.append((now + 0.001, packet))
+        now = end
+
+    if rng is not None and reorder:
+        for index in range(len(packets) - 1):
+            if rng.random() < reorder:
+                # The later packet overtakes the earlier one in the network
+                (first, a), (second, b) = packets[index], packets[index + 1]
+                packets[index], packets[index + 1] = (first, b), (second, a)
+    return packets
+
+
+def packets_from_capture(path):
+    """(seconds since the first packet, packet bytes) of a capture file"""
+    from capture import read_capture
+    packets = []
+    start = None
+    for receive_time, data in read_capture(path):
+        if start is None:
+            start = receive_time
+        packets.append((receive_time - start, data))
+    return packets
+
+
+class SimulatedHandler(handler_old.GameStateHandler):
+    """ The real handler with the socket, the clock and the processes replaced """
+
+    def __init__(self, clock, launcher, scripts_directory=HERE, team=1, player=1):
+        super(SimulatedHandler, self).__init__(team, player, scripts_directory=scripts_directory)
+        self.clock = clock.time
+        self.monotonic = clock.monotonic
+        self.parse_packet = MemoParser()
+        self.launcher = launcher
+        self.answers = 0
+
+    def _open_socket(self):
+        pass
+
+    def answer_to_gamecontroller(self, peer):
+        self.answers += 1
+
+    def dispatch_state_change(self, state_value, state):
+        # Deterministic: the transition is over before the next packet
+        self.handle_state_change(state_value, state)
+
+    def deliver(self, data, peer=PEER):
+        """One received packet as receive_once() handles it, returns whether it was valid"""
+        receive_time = self.clock()
+        if not self._check_sequence(data, peer, receive_time):
+            return False
+        if self.process_packet(data, peer, receive_time):
+            self.answer_to_gamecontroller(peer)
+            return True
+        return False
+
+
+class SimulationResult(object):
+    """ What one run did and what it found """
+
+    def __init__(self, seed, packets):
+        self.seed = seed
+        self.name = None
+        self.packets = packets
+        self.transitions = 0
+        self.launches = 0
+        self.findings = []
+        # Virtual seconds the current state had no script running, not counting failed starts and crashes
+        self.script_down = 0.0
+        self.virtual_seconds = 0.0
+        self.wall_seconds = 0.0
+        self.digest = None
+
+    def __str__(self):
+        return (f"{self.name or f'seed {self.seed}'}: {self.packets} packets, {self.transitions} transitions, "
+                f"{self.launches} launches, {self.virtual_seconds:.0f} s in {self.wall_seconds * 1000:.0f} ms, "
+                f"script down {self.script_down:.2f} s, {len(self.findings)} findings, digest {self.digest}")
+
+
+class Simulation(object):
+    """ Plays packets to a :class:`SimulatedHandler` and checks it after every step """
+
+    def __init__(self, packets, seed=0, safe_state=None, process_faults=True, scripts_directory=HERE):
+        self.packets = packets
+        self.seed = seed
+        self.safe_state = safe_state
+        self.process_faults = process_faults
+        self.scripts_directory = scripts_directory
+        # What the handler should be running in each state
+        self.expected_scripts = {state: os.path.join(scripts_directory, script)
+                                 for state, script in handler_old.SCRIPTS.items()}
+
+    def run(self):
+        started = time.perf_counter()
+        result = SimulationResult(self.seed, len(self.packets))
+        clock = VirtualClock()
+        launcher = FakeLauncher(clock, random.Random(f"{self.seed}:processes"), self.process_faults)
+        handler = SimulatedHandler(clock, launcher, self.scripts_directory)
+        handler.start_watchdog(safe_state=self.safe_state, clock=clock.monotonic, start=False)
+        dropped = PACKETS_DROPPED.value()
+
+        reported = [None]
+        # Since when the current state's script has been missing, see check_processes
+        missing_since = [None]
+
+        def finding(message):
+            # A condition that lasts is reported once, not on every check
+            if message == reported[0]:
+                return
+            reported[0] = message
+            result.findings.append(f"t={clock.now:.2f}s: {message}")
+            launcher.log("finding", message)
+
+        def check_processes(elapsed):
+            alive = launcher.alive()
+            if len(alive) > 1:
+                finding(f"{len(alive)} scripts running: " + ", ".join(f"{p.script} ({p.pid})" for p in alive))
+            expected = self.expected_scripts.get(handler.current_state)
+            if alive and alive[-1].script != expected:
+                finding(f"{alive[-1].script} runs in state {handler.current_state}")
+            missing = False
+            if expected is not None and not alive:
+                last = launcher.processes[-1] if launcher.processes else None
+                if not launcher.last_failed and not (last is not None and last.behavior == BEHAVIOR_CRASHES):
+                    result.script_down += elapsed
+                    missing = True
+            if not missing:
+                missing_since[0] = None
+            elif missing_since[0] is None:
+                missing_since[0] = clock.now - elapsed
+            elif clock.now - missing_since[0] > MISSING_SCRIPT_AFTER:
+                finding(f"no script running in state {handler.current_state}")
+
+        next_check = WATCHDOG_PERIOD
+        for at, data in self.packets:
+            while next_check <= at:
+                before = clock.now
+                clock.advance_to(next_check)
+                handler.watchdog.check()
+                check_processes(clock.now - before)
+                next_check += WATCHDOG_PERIOD
+            clock.advance_to(at)
+            before_state = handler.current_state
+            if handler.deliver(data):
+                state = data[GAME_STATE_OFFSET]
+                if handler.current_state != state:
+                    finding(f"stuck in state {handler.current_state} after a packet of state {state}")
+                elif before_state != state:
+                    result.transitions += 1
+            new_drops = PACKETS_DROPPED.value() - dropped
+            if new_drops:
+                dropped += new_drops
+                finding(f"the handler raised on packet {data[PACKET_NUMBER_OFFSET]}")
+
+        try:
+            handler.stop()
+        except Exception as e:
+            finding(f"stop() raised {e!r}")
+        alive = launcher.alive()
+        if alive:
+            finding("left running after stop(): " + ", ".join(f"{p.script} ({p.pid})" for p in alive))
+
+        result.launches = len(launcher.processes)
+        result.virtual_seconds = clock.now
+        result.wall_seconds = time.perf_counter() - started
+        result.digest = hashlib.blake2b(repr(launcher.events).encode(), digest_size=8).hexdigest()
+        return result
+
+
+def random_run(seed):
+    """One randomized match with network and process faults, as :func:`run_batch` runs it"""
+    rng = random.Random(seed)
+    steps = random_match(rng)
+    packets = packets_from_steps(steps, rng, loss=rng.choice((0.0, 0.01, 0.1)),
+                                 duplicates=rng.choice((0.0, 0.01)), reorder=rng.choice((0.0, 0.01)))
+    safe_state = rng.choice((None, handler_old.GameStates.STATE_INITIAL.value))
+    return Simulation(packets, seed, safe_state).run()
+
+
+def _quiet():
+    logging.disable(logging.CRITICAL)
+
+
+def run_batch(seeds, processes=1):
+    """Yields the results of random_run for every seed, on *processes* worker processes"""
+    if processes <= 1:
+        for seed in seeds:
+            yield random_run(seed)
+        return
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(processes, initializer=_quiet) as pool:
+        yield from pool.map(random_run, seeds, chunksize=16)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Run the handler on virtual time against simulated matches")
+    parser.add_argument('--runs', type=int, default=1, help="number of randomized matches (default: 1)")
+    parser.add_argument('--seed', type=int, default=0, help="seed of the first match, the others count up")
+    parser.add_argument('--processes', type=int, default=1, help="worker processes for --runs (default: 1)")
+    parser.add_argument('--script', help="play this script of game states instead of random matches")
+    parser.add_argument('--capture', help="replay this packet capture instead of random matches")
+    parser.add_argument('--regressions', action='store_true', help="play the regression scenarios instead")
+    parser.add_argument('--safe-state', type=int, default=None,
+                        help="state whose script is the safe behavior for --script and --capture")
+    parser.add_argument('--no-process-faults', action='store_true',
+                        help="scripts always start and exit on SIGTERM (--script and --capture)")
+    parser.add_argument('--verbose', action='store_true', help="show the handler's log and every run")
+    args = parser.parse_args()
+
+    if args.verbose:
+        logging.basicConfig(level=logging.DEBUG, format=handler_old.LOG_FORMAT)
+    else:
+        _quiet()
+
+    started = time.perf_counter()
+    if args.regressions:
+        results = regression_runs()
+    elif args.script or args.capture:
+        packets = packets_from_capture(args.capture) if args.capture else packets_from_steps(load_script(args.script))
+        results = [Simulation(packets, args.seed, args.safe_state, not args.no_process_faults).run()]
+    else:
+        results = run_batch(range(args.seed, args.seed + args.runs), args.processes)
+
+    runs = failed = 0
+    for result in results:
+        runs += 1
+        if args.verbose or result.findings or runs == 1:
+            print(result)
+        if result.findings:
+            failed += 1
+            for message in result.findings:
+                print(f"  {message}")
+    print(f"{runs} runs in {time.perf_counter() - started:.2f} s, {failed} with findings")
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,263 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+"""
+Socket tuning for the GameController receive and answer sockets.
+
+A :class:`SocketProfile` bundles the options the receivers apply in
+``_open_socket``: the receive buffer size, kernel receive timestamps
+(``SO_TIMESTAMPNS``), busy polling (``SO_BUSY_POLL``), the TOS/DSCP byte of
+the answer packets and binding to one interface or joining a multicast
+group.  The kernel may refuse or clamp any of these (busy polling and
+interface binding need CAP_NET_ADMIN / CAP_NET_RAW, the receive buffer is
+capped by ``net.core.rmem_max``), so applying a profile never fails; it
+returns what was accepted and the effective values read back.
+
+With timestamps enabled :func:`recv_timestamped` reads the datagram with
+``recvmsg`` and returns the moment the kernel queued it, in ``time.time()``
+terms, so the receive stage no longer includes the time the packet waited
+in the socket buffer for us.
+
+Running the module is a self-test over loopback: it applies a profile,
+reports the outcome of every option and plays GameController for a while to
+measure the delay between the kernel timestamp and user space::
+
+    python socket_profile.py --rcvbuf 1048576 --timestamps --busy-poll 50 --tos 0xb8
+"""
+
+import sys
+import time
+import errno
+import socket
+import struct
+import logging
+import argparse
+
+logger = logging.getLogger('socket_profile')
+
+IS_LINUX = sys.platform.startswith("linux")
+
+# Not every Python build exports these, the values are the Linux ones
+SO_TIMESTAMPNS = getattr(socket, "SO_TIMESTAMPNS", 35)
+SCM_TIMESTAMPNS = SO_TIMESTAMPNS
+SO_BUSY_POLL = getattr(socket, "SO_BUSY_POLL", 46)
+SO_BINDTODEVICE = getattr(socket, "SO_BINDTODEVICE", 25)
+
+# struct timespec of the platform
+TIMESPEC = struct.Struct("@ll")
+ANCILLARY_SIZE = socket.CMSG_SPACE(TIMESPEC.size)
+
+# Option outcomes
+ACCEPTED = "accepted"
+REJECTED = "rejected"
+UNSUPPORTED = "unsupported"
+
+
+class OptionResult(object):
+    """ What happened to one requested option """
+
+    def __init__(self, name, requested, status, effective=None, error=None):
+        self.name = name
+        self.requested = requested
+        self.status = status
+        self.effective = effective
+        self.error = error
+
+    def __str__(self):
+        text = f"{self.name:<16} requested {self.requested!s:<12} {self.status}"
+        if self.effective is not None:
+            text += f", effective {self.effective}"
+        if self.error:
+            text += f" ({self.error})"
+        return text
+
+
+class SocketProfile(object):
+    """
+    Options for the receive socket and the answer packets, all off by default.
+
+    Args:
+        rcvbuf: SO_RCVBUF in bytes, the kernel doubles it and caps it at rmem_max
+        timestamps: Request SO_TIMESTAMPNS kernel receive timestamps
+        busy_poll: SO_BUSY_POLL in microseconds
+        tos: IP_TOS byte of the answers, e.g. 0xb8 for DSCP EF
+        interface: Network interface to bind to (SO_BINDTODEVICE)
+        multicast_group: Multicast group to join on the listening port
+    """
+
+    def __init__(self, rcvbuf=None, timestamps=False, busy_poll=None, tos=None, interface=None,
+                 multicast_group=None):
+        self.rcvbuf = rcvbuf
+        self.timestamps = timestamps
+        self.busy_poll = busy_poll
+        self.tos = tos
+        self.interface = interface
+        self.multicast_group = multicast_group
+        # Results of the last apply_receive / apply_send
+        self.results = []
+        # Whether the kernel agreed to timestamp the receive socket
+        self.timestamping = False
+
+    def bind_address(self, addr):
+        """The address to bind the receive socket to: a multicast group needs the wildcard address"""
+        if self.multicast_group:
+            return "", addr[1]
+        return addr
+
+    def apply_receive(self, sock):
+        """Applies the receive side options to an unbound socket, returns the OptionResults"""
+        results = []
+        if self.rcvbuf is not None:
+            results.append(_set_option(sock, "SO_RCVBUF", socket.SOL_SOCKET, socket.SO_RCVBUF, self.rcvbuf))
+        if self.timestamps:
+            result = _set_option(sock, "SO_TIMESTAMPNS", socket.SOL_SOCKET, SO_TIMESTAMPNS, 1, linux_only=True)
+            self.timestamping = result.status == ACCEPTED
+            results.append(result)
+        if self.busy_poll is not None:
+            results.append(_set_option(sock, "SO_BUSY_POLL", socket.SOL_SOCKET, SO_BUSY_POLL, self.busy_poll,
+                                       linux_only=True))
+        if self.interface:
+            result = _set_option(sock, "SO_BINDTODEVICE", socket.SOL_SOCKET, SO_BINDTODEVICE,
+                                 self.interface.encode() + b"\0", linux_only=True)
+            result.requested = self.interface
+            results.append(result)
+        self.results = results
+        return results
+
+    def join_multicast(self, sock):
+        """Joins the multicast group once the socket is bound"""
+        if not self.multicast_group:
+            return None
+        membership = socket.inet_aton(self.multicast_group) + struct.pack("=I", socket.INADDR_ANY)
+        result = _set_option(sock, "IP_ADD_MEMBERSHIP", socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, membership)
+        result.requested = self.multicast_group
+        result.effective = None
+        self.results.append(result)
+        return result
+
+    def apply_send(self, sock):
+        """Applies the answer side options (the TOS byte)"""
+        if self.tos is None:
+            return None
+        result = _set_option(sock, "IP_TOS", socket.IPPROTO_IP, socket.IP_TOS, self.tos)
+        self.results.append(result)
+        return result
+
+    def log_results(self, log=logger):
+        for result in self.results:
+            if result.status == ACCEPTED:
+                log.info(f"Socket option {result}")
+            else:
+                log.warning(f"Socket option {result}")
+
+
+def _set_option(sock, name, level, option, value, linux_only=False):
+    if linux_only and not IS_LINUX:
+        return OptionResult(name, value, UNSUPPORTED, error="Linux only")
+    try:
+        sock.setsockopt(level, option, value)
+    except OSError as e:
+        status = UNSUPPORTED if e.errno in (errno.ENOPROTOOPT, errno.EINVAL) else REJECTED
+        return OptionResult(name, value, status, error=e.strerror)
+    effective = None
+    if isinstance(value, int):
+        try:
+            effective = sock.getsockopt(level, option)
+        except OSError:
+            pass
+    return OptionResult(name, value, ACCEPTED, effective)
+
+
+def recv_timestamped(sock, bufsize):
+    """
+    Receives one datagram with recvmsg.
+
+    Returns (data, peer, receive_time): receive_time is the kernel timestamp
+    if the socket has SO_TIMESTAMPNS enabled, otherwise the time.time() when
+    recvmsg returned.
+    """
+    data, ancdata, _, peer = sock.recvmsg(bufsize, ANCILLARY_SIZE)
+    for level, kind, payload in ancdata:
+        if level == socket.SOL_SOCKET and kind == SCM_TIMESTAMPNS and len(payload) >= TIMESPEC.size:
+            seconds, nanoseconds = TIMESPEC.unpack_from(payload)
+            return data, peer, seconds + nanoseconds * 1e-9
+    return data, peer, time.time()
+
+
+def add_socket_arguments(parser):
+    """Adds the socket profile options to an argparse parser"""
+    group = parser.add_argument_group("socket tuning")
+    group.add_argument('--rcvbuf', type=int, default=None, help="receive buffer size in bytes")
+    group.add_argument('--timestamps', action='store_true',
+                       help="use kernel receive timestamps (SO_TIMESTAMPNS) for latency accounting")
+    group.add_argument('--busy-poll', type=int, default=None, help="SO_BUSY_POLL in microseconds")
+    group.add_argument('--tos', type=lambda value: int(value, 0), default=None,
+                       help="IP TOS byte of the answer packets, e.g. 0xb8 for DSCP EF")
+    group.add_argument('--interface', type=str, default=None, help="only receive on this network interface")
+    group.add_argument('--multicast-group', type=str, default=None, help="join this multicast group")
+    return group
+
+
+def profile_from_args(args):
+    """A SocketProfile from the options of :func:`add_socket_arguments`"""
+    return SocketProfile(rcvbuf=args.rcvbuf, timestamps=args.timestamps, busy_poll=args.busy_poll, tos=args.tos,
+                         interface=args.interface, multicast_group=args.multicast_group)
+
+
+def self_test(profile, count=200, period=0.005, packet_size=688, host="127.0.0.1"):
+    """
+    Applies *profile* to a fresh loopback socket, sends *count* packets of
+    *packet_size* bytes to it and prints the option results and the latency
+    from send to kernel timestamp and from kernel timestamp to user space.
+    """
+    from latency import LatencyHistogram
+
+    receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+    profile.apply_receive(receiver)
+    receiver.bind((host, 0))
+    profile.join_multicast(receiver)
+    receiver.settimeout(1.0)
+    sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+    profile.apply_send(sender)
+
+    print("Socket options:")
+    for result in profile.results or ():
+        print("  " + str(result))
+    if not profile.results:
+        print("  (none requested)")
+
+    wire = LatencyHistogram()
+    wakeup = LatencyHistogram()
+    padding = b"\0" * max(packet_size - 8, 0)
+    destination = receiver.getsockname()
+    for _ in range(count):
+        sender.sendto(struct.pack("<d", time.time()) + padding, destination)
+        try:
+            data, _, kernel_time = recv_timestamped(receiver, packet_size)
+        except socket.timeout:
+            print("  packet lost")
+            continue
+        user_time = time.time()
+        sent_at, = struct.unpack_from("<d", data)
+        wire.record((kernel_time - sent_at) * 1000)
+        wakeup.record((user_time - kernel_time) * 1000)
+        time.sleep(period)
+
+    receiver.close()
+    sender.close()
+    if not profile.timestamping:
+        print("No kernel timestamps, both latencies are measured in user space")
+    for name, histogram in (("send -> kernel", wire), ("kernel -> user", wakeup)):
+        stats = histogram.get_statistics()
+        if stats and stats["count"]:
+            print(f"{name}: p50 {stats['p50']:.3f} ms, p99 {stats['p99']:.3f} ms, "
+                  f"max {stats['max']:.3f} ms over {stats['count']} packets")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Check which socket options the kernel accepts")
+    add_socket_arguments(parser)
+    parser.add_argument('--count', type=int, default=200, help="packets to send over loopback")
+    parser.add_argument('--period', type=float, default=0.005, help="seconds between packets")
+    args = parser.parse_args()
+    self_test(profile_from_args(args), args.count, args.period)
@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+"""
+Cold start benchmark of a handler: process start -> socket bound -> first
+answer -> first script running.
+
+Every run starts the handler in a fresh directory (so it creates its sample
+scripts), sends it a STATE_READY packet every few milliseconds from the
+moment it was started and watches
+
+* /proc/net/udp for the GameController port to be bound,
+* the answer port for the first answer (handlers that do not answer leave
+  this column empty),
+* the handler's output for the first "... started at <time>" line of a state
+  script.
+
+The handler runs with ``-X importtime``, the imports it spent the most time
+on are listed after the timings::
+
+    python startup_bench.py
+    python startup_bench.py --runs 10 -- python3 handler_old.py --team 1 --player 1 --create-dummy-scripts
+"""
+
+import os
+import re
+import sys
+import time
+import socket
+import signal
+import struct
+import argparse
+import tempfile
+import threading
+import subprocess
+
+from fast_decode import HEADER, VERSION, PACKET_SIZE
+
+GAME_CONTROLLER_PORT = 3838
+ANSWER_PORT = 3939
+STATE_READY = 1
+SCRIPT_STARTED = re.compile(rb"started at (\d+\.\d+)")
+IMPORT_TIME = re.compile(r"^import time:\s+(\d+) \|\s+(\d+) \| (\s*)(\S+)")
+
+MILESTONES = ("bound", "answer", "script")
+
+
+def ready_packet(packet_number):
+    general = struct.pack("<4sHBBBBBBB4sBHhh", HEADER, VERSION, packet_number & 0xFF, 5, 0, STATE_READY, 1, 0,
+                          0, b"\0\0\0\0", 0, 0, 600, 0)
+    return general + b"\0" * (PACKET_SIZE - len(general))
+
+
+def port_bound(port):
+    """Whether some socket is bound to the UDP *port* (Linux)"""
+    suffix = f":{port:04X}"
+    for table in ("/proc/net/udp", "/proc/net/udp6"):
+        try:
+            with open(table) as f:
+                next(f)
+                for line in f:
+                    if line.split(None, 2)[1].endswith(suffix):
+                        return True
+        except OSError:
+            continue
+    return False
+
+
+def run_once(command, period, timeout):
+    """Starts *command* once, returns ({milestone: seconds after start}, -X importtime lines)"""
+    directory = tempfile.mkdtemp(prefix="startup_bench_")
+    here = os.path.dirname(os.path.abspath(__file__))
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [here, os.environ.get("PYTHONPATH")])),
+               PYTHONUNBUFFERED="1")
+    answers = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    answers.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    answers.bind(("127.0.0.1", ANSWER_PORT))
+    answers.settimeout(period)
+    sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    results = {}
+    stderr_lines = []
+    done = threading.Event()
+
+    started = time.time()
+    process = subprocess.Popen([command[0], "-X", "importtime"] + command[1:], cwd=directory, env=env,
+                               stdout=subprocess.PIPE, stderr=subprocess.PIPE, start_new_session=True)
+
+    def read_stdout():
+        for line in process.stdout:
+            match = SCRIPT_STARTED.search(line)
+            if match and "script" not in results:
+                results["script"] = float(match.group(1)) - started
+                done.set()
+
+    def read_stderr():
+        for line in process.stderr:
+            stderr_lines.append(line.decode("utf-8", "replace"))
+
+    readers = [threading.Thread(target=read_stdout, daemon=True), threading.Thread(target=read_stderr, daemon=True)]
+    for reader in readers:
+        reader.start()
+
+    packet_number = 0
+    deadline = started + timeout
+    try:
+        while not done.is_set() and time.time() < deadline and process.poll() is None:
+            if "bound" not in results and port_bound(GAME_CONTROLLER_PORT):
+                results["bound"] = time.time() - started
+            sender.sendto(ready_packet(packet_number), ("127.0.0.1", GAME_CONTROLLER_PORT))
+            packet_number += 1
+            try:
+                answers.recvfrom(64)
+                results.setdefault("answer", time.time() - started)
+            except socket.timeout:
+                pass
+    finally:
+        try:
+            os.killpg(process.pid, signal.SIGINT)
+            process.wait(5)
+        except (ProcessLookupError, subprocess.TimeoutExpired):
+            pass
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        for reader in readers:
+            reader.join(2)
+        answers.close()
+        sender.close()
+    return results, [line for line in stderr_lines if line.startswith("import time:")]
+
+
+def import_breakdown(lines, top=12):
+    """[(cumulative ms, module)] of the top level imports, slowest first, plus their total"""
+    imports = []
+    for line in lines:
+        match = IMPORT_TIME.match(line)
+        # Nested imports are indented, their time is part of the top level one
+        if match and not match.group(3):
+            imports.append((int(match.group(2)) / 1000.0, match.group(4)))
+    imports.sort(reverse=True)
+    return imports[:top], sum(ms for ms, _ in imports)
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2] if values else None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Measure the cold start of a handler")
+    parser.add_argument('--runs', type=int, default=5, help="number of starts, the median is reported")
+    parser.add_argument('--period', type=float, default=0.002, help="seconds between packets sent to the handler")
+    parser.add_argument('--timeout', type=float, default=10.0, help="give up on a start after this many seconds")
+    parser.add_argument('command', nargs='*', default=None,
+                        help="handler command line (default: this interpreter running handler.py)")
+    args = parser.parse_args()
+    command = args.command or [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "handler.py")]
+    # The handler runs in a scratch directory
+    command = [os.path.abspath(part) if part.endswith(".py") and os.path.isfile(part) else part for part in command]
+
+    if port_bound(GAME_CONTROLLER_PORT):
+        sys.exit(f"UDP port {GAME_CONTROLLER_PORT} is already in use")
+
+    runs = []
+    imports = []
+    for run in range(args.runs):
+        results, import_lines = run_once(command, args.period, args.timeout)
+        runs.append(results)
+        imports = imports or import_lines
+        print(f"run {run + 1}: " + "  ".join(
+            f"{milestone}={results[milestone] * 1000:.1f} ms" if milestone in results else f"{milestone}=-"
+            for milestone in MILESTONES))
+
+    print("median: " + "  ".join(
+        f"{milestone}={median([r[milestone] for r in runs if milestone in r]) * 1000:.1f} ms"
+        if any(milestone in r for r in runs) else f"{milestone}=-"
+        for milestone in MILESTONES))
+
+    slowest, total = import_breakdown(imports)
+    print(f"\nimports of the first run: {total:.1f} ms at the top level, slowest:")
+    for ms, name in slowest:
+        print(f"  {ms:8.1f} ms  {name}")
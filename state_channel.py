@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+"""
+Streams game state updates to a running state script over an inherited pipe.
+
+Instead of a one-off argv snapshot, the handler pushes a frame whenever a
+field of the snapshot changes.  A frame is a magic byte, a 32 bit mask of the
+fields it carries and the packed values of those fields in field order, so
+an unchanged packet costs nothing and a timer tick costs 9 bytes.  The first
+frame (and the first one after the pipe ran full) carries every field.
+
+Scripts read it without blocking:
+
+    from state_channel import StateChannelReader
+    channel = StateChannelReader.from_env()
+    snapshot = channel.latest()   # dict, or None before the first frame
+"""
+
+import os
+import struct
+
+STATE_FD_ENV = "GC_STATE_FD"
+
+FRAME_MAGIC = 0xA5
+FRAME_HEADER = struct.Struct("<BI")
+
+# (name, struct format) in frame order; at most 32 fields fit the mask
+FIELDS = (
+    ("packet_number", "B"),
+    ("game_state", "B"),
+    ("first_half", "B"),
+    ("kick_of_team", "B"),
+    ("secondary_state", "B"),
+    ("secondary_state_info", "4s"),
+    ("drop_in_team", "B"),
+    ("drop_in_time", "H"),
+    ("seconds_remaining", "h"),
+    ("secondary_seconds_remaining", "h"),
+    ("team_number", "B"),
+    ("own_score", "B"),
+    ("opponent_score", "B"),
+    ("penalty", "B"),
+    ("secs_till_unpenalized", "B"),
+)
+
+FIELD_NAMES = tuple(name for name, _ in FIELDS)
+_FIELD_STRUCTS = tuple(struct.Struct("<" + fmt) for _, fmt in FIELDS)
+FULL_MASK = (1 << len(FIELDS)) - 1
+
+
+def enum_value(value):
+    """Integer value of a construct enum field (EnumIntegerString implements __int__)"""
+    return int(value)
+
+
+def snapshot_from_state(state, team, player):
+    """
+    Extracts the snapshot fields from a parsed GameState of either protocol version.
+
+    Args:
+        state: The parsed game state
+        team (int): Our team number, selects own and opponent team info
+        player (int): Our player number (1-based), selects the penalty fields
+    """
+    teams = state.teams
+    own, opponent = (teams[0], teams[1]) if teams[0].team_number == team else (teams[1], teams[0])
+    robot = own.players[player - 1] if 0 < player <= len(own.players) else None
+    return {
+        "packet_number": state.packet_number,
+        "game_state": enum_value(state.game_state),
+        "first_half": int(state.first_half),
+        "kick_of_team": state.kick_of_team,
+        "secondary_state": enum_value(state.secondary_state),
+        "secondary_state_info": bytes(getattr(state, "secondary_state_info", b"\0\0\0\0")),
+        "drop_in_team": int(state.drop_in_team),
+        "drop_in_time": state.drop_in_time,
+        "seconds_remaining": state.seconds_remaining,
+        "secondary_seconds_remaining": state.secondary_seconds_remaining,
+        "team_number": own.team_number,
+        "own_score": own.score,
+        "opponent_score": opponent.score,
+        "penalty": robot.penalty if robot is not None else 0,
+        "secs_till_unpenalized": robot.secs_till_unpenalized if robot is not None else 0,
+    }
+
+
+def encode_frame(snapshot, previous=None):
+    """Encodes the fields of *snapshot* that differ from *previous*, None if nothing changed"""
+    mask = 0
+    parts = []
+    for index, name in enumerate(FIELD_NAMES):
+        value = snapshot[name]
+        if previous is None or previous.get(name) != value:
+            mask |= 1 << index
+            parts.append(_FIELD_STRUCTS[index].pack(value))
+    if not mask:
+        return None
+    return FRAME_HEADER.pack(FRAME_MAGIC, mask) + b"".join(parts)
+
+
+def frame_size(mask):
+    return FRAME_HEADER.size + sum(_FIELD_STRUCTS[i].size for i in range(len(FIELDS)) if mask >> i & 1)
+
+
+class StateChannelWriter(object):
+    """ Handler side: pushes snapshot deltas into a pipe without ever blocking """
+
+    def __init__(self, fd):
+        self.fd = fd
+        os.set_blocking(fd, False)
+        self.last_sent = None
+        self.frames_sent = 0
+        self.frames_skipped = 0
+
+    def push(self, snapshot):
+        """Sends the changes since the last frame, returns False if the reader is gone"""
+        frame = encode_frame(snapshot, self.last_sent)
+        if frame is None:
+            return True
+        try:
+            # Frames are far below PIPE_BUF, so the write is all or nothing
+            os.write(self.fd, frame)
+        except BlockingIOError:
+            # The script is not reading; resend everything once it catches up
+            self.last_sent = None
+            self.frames_skipped += 1
+            return True
+        except (BrokenPipeError, OSError):
+            return False
+        self.last_sent = snapshot
+        self.frames_sent += 1
+        return True
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+class StateChannelReader(object):
+    """ Script side: applies all frames received so far without blocking """
+
+    def __init__(self, fd):
+        self.fd = fd
+        if fd is not None:
+            os.set_blocking(fd, False)
+        self.buffer = b""
+        self.snapshot = None
+        self.updates = 0
+
+    @classmethod
+    def from_env(cls):
+        """Reader on the pipe passed by the handler, or a reader that never yields a snapshot"""
+        fd = os.environ.get(STATE_FD_ENV)
+        return cls(int(fd) if fd else None)
+
+    def fileno(self):
+        """Lets scripts select() on the channel if they want to wait for changes"""
+        return self.fd
+
+    def poll(self):
+        """Reads and applies everything available, returns the number of frames applied"""
+        if self.fd is None:
+            return 0
+        while True:
+            try:
+                chunk = os.read(self.fd, 4096)
+            except BlockingIOError:
+                break
+            if not chunk:
+                # The handler closed the channel, keep the last snapshot
+                os.close(self.fd)
+                self.fd = None
+                break
+            self.buffer += chunk
+
+        applied = 0
+        offset = 0
+        while len(self.buffer) - offset >= FRAME_HEADER.size:
+            magic, mask = FRAME_HEADER.unpack_from(self.buffer, offset)
+            if magic != FRAME_MAGIC:
+                raise ValueError("Corrupt state channel frame")
+            size = frame_size(mask)
+            if len(self.buffer) - offset < size:
+                break
+            position = offset + FRAME_HEADER.size
+            snapshot = dict(self.snapshot) if self.snapshot else {}
+            for index, name in enumerate(FIELD_NAMES):
+                if mask >> index & 1:
+                    snapshot[name] = _FIELD_STRUCTS[index].unpack_from(self.buffer, position)[0]
+                    position += _FIELD_STRUCTS[index].size
+            self.snapshot = snapshot
+            offset += size
+            applied += 1
+        self.buffer = self.buffer[offset:]
+        self.updates += applied
+        return applied
+
+    def latest(self):
+        """The newest snapshot as a dict, or None if nothing arrived yet"""
+        self.poll()
+        return self.snapshot
@@ -0,0 +1,44 @@
+# state_report.py
+"""
+Tiny helper for state scripts to tell the handler how far they got.
+
+The handler passes the write end of a pipe and its number in the
+GC_REPORT_FD environment variable. Without it every call is a no-op,
+so scripts keep working when started by hand.
+
+    import state_report
+    state_report.report_ready()          # setup done, about to act
+    state_report.report_first_action()   # first command sent to the robot
+"""
+
+import os
+import time
+
+REPORT_FD_ENV = "GC_REPORT_FD"
+
+EVENT_READY = "ready"
+EVENT_FIRST_ACTION = "first_action"
+
+_fd = int(os.environ[REPORT_FD_ENV]) if os.environ.get(REPORT_FD_ENV) else None
+_reported = set()
+
+
+def report(event, once=True):
+    """Sends an event with the current wall clock time to the handler"""
+    global _fd
+    if _fd is None or (once and event in _reported):
+        return
+    _reported.add(event)
+    try:
+        os.write(_fd, f"{event} {time.time():.6f}\n".encode("ascii"))
+    except OSError:
+        # The handler went away, stop trying
+        _fd = None
+
+
+def report_ready():
+    report(EVENT_READY)
+
+
+def report_first_action():
+    report(EVENT_FIRST_ACTION)
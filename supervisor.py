@@ -0,0 +1,356 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+"""
+asyncio supervisor for state scripts.
+
+One event loop runs everything a child needs, there is no thread per child:
+
+* :meth:`Supervisor.transition` is a coroutine that stops the running script
+  (SIGTERM, SIGKILL after a timeout) and starts the next one, and returns the
+  new :class:`Child` once it runs.  Transitions are serialized, so awaiting
+  one also means every earlier one is done.
+* The next one may also be a :class:`composition.Composition`: its members
+  are started in parallel as far as their dependencies allow, members the
+  running composition shares with it are left running, the others stopped
+  in parallel.  A plain script is a composition of one.
+* Each child has one task forwarding its output as it comes (so a chatty
+  script never blocks on a full pipe), one reading the reports of
+  :mod:`state_report` from an inherited pipe, and one waiting for its exit.
+* A script that exits on its own while it is still part of the current
+  composition is restarted according to its :class:`RestartPolicy`, with exponential
+  backoff between quick successive crashes.
+* With a :class:`hang_detector.HangDetector` every script also gets a
+  heartbeat pipe, one that stops beating is restarted right away whatever
+  its policy says.
+* With a :class:`script_cache.ScriptIndex` scripts run from their
+  precompiled bytecode.
+
+Subclasses hook into the milestones (``on_started``, ``on_first_output``,
+``on_report``, ``on_terminated``, ``on_exit``, ``on_hang``, ``on_restart``) the way
+``handler.py`` records its latency stages::
+
+    supervisor = Supervisor(policies={"playing_state.py": RestartPolicy(RestartPolicy.ON_FAILURE)})
+    child = await supervisor.transition("playing_state.py")
+    child = await supervisor.transition(Composition(Member("vision.py"),
+                                                    Member("playing_state.py", after=["vision.py"])))
+    ...
+    await supervisor.stop()
+"""
+
+import os
+import sys
+import time
+import asyncio
+import logging
+
+from state_report import REPORT_FD_ENV, EVENT_READY
+from restart_policy import RestartPolicy
+from composition import Composition, READY_STARTED
+
+logger = logging.getLogger('supervisor')
+
+# Seconds a script gets to exit after SIGTERM before it is killed
+TERMINATE_TIMEOUT = 2.0
+# Output still buffered in the pipe of a stopped script is forwarded for at most this long
+DRAIN_TIMEOUT = 0.5
+READ_SIZE = 64 * 1024
+
+
+class Child(object):
+    """ One running state script """
+
+    def __init__(self, script, process, context, attempt, spawn_started):
+        self.script = script
+        self.process = process
+        self.pid = process.pid
+        # Whatever the caller of transition() passed along, e.g. a trace span
+        self.context = context
+        # Restarts since the script last ran for a while
+        self.attempt = attempt
+        # Before and after the process was created
+        self.spawn_started = spawn_started
+        self.started_at = time.time()
+        self.started_monotonic = time.monotonic()
+        self.first_output_at = None
+        # Set once it reported ready (or exited), dependents wait for it
+        self.ready = asyncio.Event()
+        self.ready_at = None
+        self.heartbeat = None
+        self.stopping = False
+        self.tasks = []
+
+    @property
+    def returncode(self):
+        return self.process.returncode
+
+    def uptime(self):
+        return time.monotonic() - self.started_monotonic
+
+
+class Supervisor(object):
+    """ Runs the scripts of one state at a time, see the module documentation """
+
+    def __init__(self, command=None, policies=None, default_policy=None, terminate_timeout=TERMINATE_TIMEOUT,
+                 output=None, cwd=None, hang_detector=None, script_index=None):
+        # The script name is appended to this
+        self.command = list(command) if command else [sys.executable]
+        self.policies = dict(policies or {})
+        self.default_policy = default_policy if default_policy is not None else RestartPolicy(RestartPolicy.NEVER)
+        self.terminate_timeout = terminate_timeout
+        self.output = output if output is not None else sys.stdout.buffer
+        self.cwd = cwd
+        self.script_index = script_index
+        self.hang_detector = hang_detector
+        if hang_detector is not None:
+            hang_detector.on_hang = self._heartbeat_lost
+        self.composition = None
+        # script -> Child of the running composition
+        self.children = {}
+        self.closed = False
+        self._lock = asyncio.Lock()
+        self._loop = None
+
+    def policy_for(self, script):
+        return self.policies.get(script, self.default_policy)
+
+    @property
+    def current(self):
+        """The :class:`Child` of the running composition's primary member, None if it does not run"""
+        if self.composition is None:
+            return None
+        return self.children.get(self.composition.primary)
+
+    def is_primary(self, child):
+        return self.composition is not None and child.script == self.composition.primary
+
+    async def transition(self, target, context=None):
+        """Replaces the running scripts by *target*, a script or a :class:`Composition` (None only
+        stops), returns the new primary :class:`Child` or None if it does not run"""
+        async with self._lock:
+            composition = Composition.of(target) if target is not None and not self.closed else None
+            kept = {script: child for script, child in self.children.items()
+                    if composition is not None and script in composition}
+            stopping = [child for script, child in self.children.items() if script not in kept]
+            self.composition = None
+            self.children = kept
+            if stopping:
+                await asyncio.gather(*(self._stop_child(child) for child in stopping))
+            if composition is None:
+                return None
+            for child in kept.values():
+                child.context = context
+            self.composition = composition
+            await self._launch(composition, context)
+            return self.current
+
+    async def _launch(self, composition, context):
+        """Starts the members that do not run yet, each once its prerequisites are ready"""
+        loop = asyncio.get_running_loop()
+        started = {script: loop.create_future() for script in composition.members}
+        for script, child in self.children.items():
+            started[script].set_result(child)
+
+        async def launch(member):
+            for prerequisite in member.after:
+                child = await started[prerequisite]
+                if child is not None:
+                    await self._wait_ready(child, composition.members[prerequisite])
+            child = await self._spawn(member.script, context, 0)
+            if child is not None:
+                self.children[member.script] = child
+            started[member.script].set_result(child)
+
+        await asyncio.gather(*(launch(member) for member in composition if member.script not in self.children))
+
+    async def _wait_ready(self, child, member):
+        if member.ready == READY_STARTED or child.ready.is_set():
+            return
+        try:
+            await asyncio.wait_for(child.ready.wait(), max(member.ready_timeout - child.uptime(), 0))
+        except asyncio.TimeoutError:
+            self.on_ready_timeout(child, member)
+
+    async def stop(self):
+        """Stops the running script, nothing is started or restarted afterwards"""
+        self.closed = True
+        await self.transition(None)
+
+    async def _spawn(self, script, context, attempt):
+        self._loop = asyncio.get_running_loop()
+        report_read, report_write = os.pipe()
+        env = dict(os.environ, PYTHONUNBUFFERED="1", **{REPORT_FD_ENV: str(report_write)})
+        heartbeat = self.hang_detector.watch(script) if self.hang_detector is not None else None
+        if heartbeat is not None:
+            env.update(heartbeat.env())
+        path = script
+        if self.script_index is not None:
+            path = self.script_index.launch(os.path.join(os.path.abspath(self.cwd), script) if self.cwd else script, env)
+        spawn_started = time.time()
+        try:
+            process = await asyncio.create_subprocess_exec(
+                *self.command, path,
+                stdout=asyncio.subprocess.PIPE,
+                pass_fds=(report_write,) + (heartbeat.pass_fds if heartbeat is not None else ()),
+                cwd=self.cwd,
+                env=env)
+        except OSError as e:
+            os.close(report_read)
+            if heartbeat is not None:
+                self.hang_detector.unwatch(heartbeat)
+            self.on_spawn_failed(script, context, e)
+            return None
+        finally:
+            # The child holds its own copy of the write end
+            os.close(report_write)
+        child = Child(script, process, context, attempt, spawn_started)
+        member = self.composition.members.get(script) if self.composition is not None else None
+        if member is None or member.ready == READY_STARTED:
+            child.ready.set()
+        if heartbeat is not None:
+            self.hang_detector.spawned(heartbeat, process)
+            child.heartbeat = heartbeat
+        child.tasks = [
+            asyncio.ensure_future(self._forward_output(child)),
+            asyncio.ensure_future(self._read_reports(child, report_read)),
+            asyncio.ensure_future(self._watch(child)),
+        ]
+        self.on_started(child)
+        return child
+
+    async def _stop_child(self, child):
+        child.stopping = True
+        if child.heartbeat is not None:
+            self.hang_detector.unwatch(child.heartbeat)
+        started = time.time()
+        killed = False
+        if child.process.returncode is None:
+            try:
+                child.process.terminate()
+                await asyncio.wait_for(child.process.wait(), self.terminate_timeout)
+            except ProcessLookupError:
+                pass
+            except asyncio.TimeoutError:
+                killed = True
+                child.process.kill()
+                await child.process.wait()
+        # Forward what it printed last, a grandchild holding the pipe must not stall us
+        await asyncio.wait(child.tasks[:2], timeout=DRAIN_TIMEOUT)
+        for task in child.tasks:
+            task.cancel()
+        self.on_terminated(child, started, killed)
+
+    async def _forward_output(self, child):
+        stream = child.process.stdout
+        while True:
+            data = await stream.read(READ_SIZE)
+            if not data:
+                return
+            if child.first_output_at is None:
+                child.first_output_at = time.time()
+                self.on_first_output(child)
+            self.output.write(data)
+            self.output.flush()
+
+    async def _read_reports(self, child, fd):
+        reader = asyncio.StreamReader()
+        loop = asyncio.get_running_loop()
+        transport, _ = await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader),
+                                                    os.fdopen(fd, "rb", 0))
+        try:
+            async for line in reader:
+                line = line.decode("ascii", "replace")
+                if not child.ready.is_set() and line.split(" ", 1)[0] == EVENT_READY:
+                    child.ready_at = time.time()
+                    child.ready.set()
+                    self.on_ready(child)
+                self.on_report(child, line)
+        finally:
+            transport.close()
+
+    async def _watch(self, child):
+        returncode = await child.process.wait()
+        # Dependents have nothing to wait for anymore
+        child.ready.set()
+        if child.stopping:
+            return
+        self.on_exit(child, returncode)
+        policy = self.policy_for(child.script)
+        attempt = 0 if child.uptime() >= policy.reset_after else child.attempt
+        delay = policy.delay(returncode, attempt)
+        if delay is None:
+            return
+        await asyncio.sleep(delay)
+        async with self._lock:
+            # A transition took over while we waited
+            if self.children.get(child.script) is not child or self.closed:
+                return
+            restarted = await self._replace(child, attempt + 1)
+            if restarted is not None:
+                self.on_restart(restarted, returncode, delay)
+
+    async def _replace(self, child, attempt):
+        """Starts *child*'s script again in its place, under the lock"""
+        del self.children[child.script]
+        restarted = await self._spawn(child.script, child.context, attempt)
+        if restarted is not None:
+            self.children[child.script] = restarted
+        return restarted
+
+    def _heartbeat_lost(self, watch, silence):
+        # Called from the detector thread
+        self._loop.call_soon_threadsafe(self._restart_hung, watch, silence)
+
+    def _restart_hung(self, watch, silence):
+        child = next((child for child in self.children.values() if child.heartbeat is watch), None)
+        if child is None or child.stopping:
+            return
+        self.on_hang(child, silence)
+        asyncio.ensure_future(self._restart(child))
+
+    async def _restart(self, child):
+        async with self._lock:
+            # A transition took over meanwhile
+            if self.children.get(child.script) is not child or self.closed:
+                return
+            await self._stop_child(child)
+            restarted = await self._replace(child, child.attempt + 1)
+            if restarted is not None:
+                self.on_restart(restarted, child.returncode, 0.0)
+
+    # Milestones, subclasses record what they need
+
+    def on_started(self, child):
+        logger.info(f"[SUPERVISOR] {child.script} started (PID: {child.pid})")
+
+    def on_spawn_failed(self, script, context, error):
+        logger.error(f"[SUPERVISOR] Error starting {script}: {error}")
+
+    def on_first_output(self, child):
+        pass
+
+    def on_ready(self, child):
+        logger.debug(f"[SUPERVISOR] {child.script} ready after {child.ready_at - child.started_at:.3f} s")
+
+    def on_ready_timeout(self, child, member):
+        logger.warning(f"[SUPERVISOR] {child.script} not ready after {member.ready_timeout:.1f} s, "
+                       f"starting what waits for it anyway")
+
+    def on_report(self, child, line):
+        pass
+
+    def on_terminated(self, child, started, killed):
+        how = "killed after the termination timeout" if killed else "terminated"
+        logger.info(f"[SUPERVISOR] {child.script} {how} (PID: {child.pid}, return code: {child.returncode})")
+
+    def on_exit(self, child, returncode):
+        logger.warning(f"[SUPERVISOR] {child.script} exited with return code {returncode} "
+                       f"after {child.uptime():.1f} s (PID: {child.pid})")
+
+    def on_hang(self, child, silence):
+        logger.warning(f"[SUPERVISOR] {child.script} stopped beating {silence:.2f} s ago, restarting it "
+                       f"(PID: {child.pid})")
+
+    def on_restart(self, child, returncode, delay):
+        logger.warning(f"[SUPERVISOR] Restarted {child.script} after {delay:.2f} s "
+                       f"(restart {child.attempt}, PID: {child.pid})")
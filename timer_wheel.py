@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+"""
+Hashed timer wheel for many cheap, cancellable timeouts.
+
+Deadlines are rounded up to the next tick and hashed into one of ``slots``
+buckets, so scheduling and cancelling are O(1) and advancing the wheel only
+looks at the buckets of the ticks that passed.  The wheel does not own a
+clock: whoever drives it calls :meth:`TimerWheel.advance` with the current
+time, either :class:`TimerWheelThread` or an event loop.
+"""
+
+import math
+import time
+import logging
+import threading
+
+logger = logging.getLogger('timer_wheel')
+
+
+class TimerHandle(object):
+    """ A scheduled callback, cancel() it to prevent it from running """
+
+    __slots__ = ("tick", "deadline", "callback", "args", "cancelled")
+
+    def __init__(self, tick, deadline, callback, args):
+        self.tick = tick
+        self.deadline = deadline
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class TimerWheel(object):
+
+    def __init__(self, tick=0.01, slots=512, clock=time.monotonic):
+        self.tick = tick
+        self.clock = clock
+        self.slots = [[] for _ in range(slots)]
+        self.current_tick = math.floor(clock() / tick)
+        self.lock = threading.Lock()
+
+    def call_at(self, deadline, callback, *args):
+        """Runs callback(*args) once the wheel advanced past *deadline*"""
+        with self.lock:
+            tick = max(math.ceil(deadline / self.tick), self.current_tick + 1)
+            handle = TimerHandle(tick, deadline, callback, args)
+            self.slots[tick % len(self.slots)].append(handle)
+        return handle
+
+    def call_later(self, delay, callback, *args):
+        return self.call_at(self.clock() + delay, callback, *args)
+
+    def advance(self, now=None):
+        """Runs every callback that became due, returns how many ran"""
+        if now is None:
+            now = self.clock()
+        new_tick = math.floor(now / self.tick)
+        due = []
+        with self.lock:
+            if new_tick <= self.current_tick:
+                return 0
+            # A long stall still only needs one pass over the wheel
+            first = max(self.current_tick + 1, new_tick - len(self.slots) + 1)
+            for tick in range(first, new_tick + 1):
+                slot = self.slots[tick % len(self.slots)]
+                if not slot:
+                    continue
+                remaining = []
+                for handle in slot:
+                    if handle.cancelled:
+                        continue
+                    if handle.tick <= new_tick:
+                        due.append(handle)
+                    else:
+                        remaining.append(handle)
+                slot[:] = remaining
+            self.current_tick = new_tick
+
+        due.sort(key=lambda handle: handle.deadline)
+        for handle in due:
+            if handle.cancelled:
+                continue
+            try:
+                handle.callback(*handle.args)
+            except Exception as e:
+                logger.exception(e)
+        return len(due)
+
+
+class TimerWheelThread(object):
+    """ Advances a wheel once per tick from a daemon thread """
+
+    def __init__(self, wheel):
+        self.wheel = wheel
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def run(self):
+        while not self.stop_event.wait(self.wheel.tick):
+            self.wheel.advance()
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name="timer_wheel", daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join(timeout=1.0)
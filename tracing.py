@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+"""
+Per-transition spans from the triggering packet to the script's first action.
+
+Each :class:`TransitionSpan` collects wall clock timestamps of the pipeline
+milestones of one state change.  :class:`TransitionTracer` keeps the most
+recent spans and exports them in the Chrome trace event format, which can
+be opened in chrome://tracing or https://ui.perfetto.dev.
+"""
+
+import os
+import json
+import threading
+from collections import deque
+
+# Milestones in pipeline order, each phase of the trace ends at one of them
+MILESTONE_RECEIVED = "received"
+MILESTONE_PARSED = "parsed"
+MILESTONE_DISPATCHED = "dispatched"
+MILESTONE_TERMINATED = "terminated"
+MILESTONE_SPAWNED = "spawned"
+MILESTONE_FIRST_OUTPUT = "first_output"
+MILESTONE_READY = "ready"
+MILESTONE_FIRST_ACTION = "first_action"
+
+MILESTONES = (
+    MILESTONE_RECEIVED,
+    MILESTONE_PARSED,
+    MILESTONE_DISPATCHED,
+    MILESTONE_TERMINATED,
+    MILESTONE_SPAWNED,
+    MILESTONE_FIRST_OUTPUT,
+    MILESTONE_READY,
+    MILESTONE_FIRST_ACTION,
+)
+
+
+class TransitionSpan(object):
+    """ Timestamps of one state transition, keyed by milestone """
+
+    def __init__(self, state, packet_number, received_at, script=None):
+        self.state = state
+        self.packet_number = packet_number
+        self.script = script
+        self.pid = None
+        self.marks = {MILESTONE_RECEIVED: received_at}
+
+    def mark(self, milestone, timestamp):
+        """Records a milestone, only the first occurrence counts"""
+        self.marks.setdefault(milestone, timestamp)
+
+    def duration_ms(self, start=MILESTONE_RECEIVED, end=MILESTONE_FIRST_ACTION):
+        if start not in self.marks or end not in self.marks:
+            return None
+        return (self.marks[end] - self.marks[start]) * 1000
+
+    def trace_events(self, pid):
+        """Chrome trace events: one complete event per phase plus the whole span"""
+        # Child reports and our own observations of them may interleave, order by time
+        ordered = sorted(self.marks.items(), key=lambda mark: (mark[1], MILESTONES.index(mark[0])
+                                                               if mark[0] in MILESTONES else len(MILESTONES)))
+        args = {"state": self.state, "packet_number": self.packet_number, "script": self.script,
+                "child_pid": self.pid}
+        events = [{
+            "name": f"transition {self.state}",
+            "cat": "transition",
+            "ph": "X",
+            "ts": ordered[0][1] * 1e6,
+            "dur": (ordered[-1][1] - ordered[0][1]) * 1e6,
+            "pid": pid,
+            "tid": 0,
+            "args": args,
+        }]
+        for (_, begin), (milestone, end) in zip(ordered, ordered[1:]):
+            events.append({
+                "name": milestone,
+                "cat": "phase",
+                "ph": "X",
+                "ts": begin * 1e6,
+                "dur": (end - begin) * 1e6,
+                "pid": pid,
+                "tid": 1,
+                "args": args,
+            })
+        return events
+
+
+class TransitionTracer(object):
+    """ Keeps the last *max_spans* transition spans and writes them as a trace file """
+
+    def __init__(self, max_spans=10000):
+        self.spans = deque(maxlen=max_spans)
+        self.lock = threading.Lock()
+
+    def begin(self, state, packet_number, received_at, script=None):
+        span = TransitionSpan(state, packet_number, received_at, script)
+        with self.lock:
+            self.spans.append(span)
+        return span
+
+    def export_chrome_trace(self, path):
+        """Writes all spans as Chrome trace JSON to *path*"""
+        pid = os.getpid()
+        with self.lock:
+            spans = list(self.spans)
+        events = [{"name": "process_name", "ph": "M", "pid": pid, "args": {"name": "game state handler"}}]
+        for span in spans:
+            events.extend(span.trace_events(pid))
+        with open(path, "w") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+        return len(spans)
+
+
+def read_report_line(span, line):
+    """Applies one ``<event> <timestamp>`` line sent by :mod:`state_report` to a span"""
+    try:
+        event, timestamp = line.split()
+        span.mark(event, float(timestamp))
+    except ValueError:
+        pass
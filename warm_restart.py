@@ -0,0 +1,227 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+"""
+Warm restart of the handler from a snapshot file.
+
+At every transition the handler writes the game state it acts on, the
+script it runs and that script's PID to a small JSON file, atomically
+(temporary file, fsync, rename), so a crash never leaves half a snapshot.
+A restarted handler reads it back before the first packet arrives:
+
+* if the script is still running (same boot, same PID, same process start
+  time, so a reused PID is never mistaken for it), it is adopted,
+* otherwise the state is taken over and its script relaunched at once,
+* the first live packet then confirms the state or corrects it like any
+  other transition.
+
+While the state holds, the handler refreshes the snapshot's modification
+time on valid packets, so its age is the time since the last packet rather
+than since the last transition.  Snapshots older than a limit (a restart
+long after the match moved on) are ignored.  An adopted script is not our child: it is watched through /proc,
+and its output went to the pipe of the previous handler, so scripts that
+print end once they write to it; the handler relaunches them then.
+"""
+
+import os
+import json
+import time
+import signal
+import logging
+
+logger = logging.getLogger('warm_restart')
+
+FORMAT_VERSION = 1
+# Snapshots older than this many seconds are not restored
+MAX_AGE = 60.0
+# The handler refreshes the snapshot at most this often, in seconds
+REFRESH_INTERVAL = 1.0
+# How often AdoptedProcess.wait looks at /proc
+POLL_INTERVAL = 0.01
+
+_CLOCK_TICKS = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+
+
+def boot_id():
+    """Identifies the current boot, None where the kernel does not tell"""
+    try:
+        with open("/proc/sys/kernel/random/boot_id") as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+def process_start_ticks(pid):
+    """Start time of a process in clock ticks after boot, None if it is gone (or a zombie)"""
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            stat = f.read()
+    except OSError:
+        return None
+    # The command name may contain spaces and parentheses, the fields follow the last ")"
+    fields = stat[stat.rindex(")") + 2:].split()
+    if fields[0] == "Z":
+        return None
+    return int(fields[19])
+
+
+def process_started_at(pid="self"):
+    """Wall clock time a process was started, including the interpreter start up"""
+    ticks = process_start_ticks(pid)
+    try:
+        with open("/proc/uptime") as f:
+            uptime = float(f.read().split()[0])
+    except (OSError, ValueError, IndexError):
+        return None
+    return time.time() - (uptime - ticks / _CLOCK_TICKS) if ticks is not None else None
+
+
+class AdoptedProcess(object):
+    """ A script started by an earlier handler, with the part of Popen's interface the monitor uses """
+
+    def __init__(self, pid, start_ticks):
+        self.pid = pid
+        self.start_ticks = start_ticks
+        self.returncode = None
+
+    def poll(self):
+        if self.returncode is None and process_start_ticks(self.pid) != self.start_ticks:
+            # Not our child, the exit status went to whoever reaped it
+            self.returncode = -1
+        return self.returncode
+
+    def wait(self, timeout=None):
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        while self.poll() is None:
+            if deadline is not None and time.monotonic() > deadline:
+                raise TimeoutError(f"Process {self.pid} still running")
+            time.sleep(POLL_INTERVAL)
+        return self.returncode
+
+    def send_signal(self, signum):
+        if self.poll() is None:
+            try:
+                os.kill(self.pid, signum)
+            except ProcessLookupError:
+                pass
+
+    def terminate(self):
+        self.send_signal(signal.SIGTERM)
+
+    def kill(self):
+        self.send_signal(signal.SIGKILL)
+
+
+def save_snapshot(path, state, script=None, process=None, packet_number=None, receive_time=None):
+    """Atomically replaces the snapshot at *path*"""
+    snapshot = {
+        "format": FORMAT_VERSION,
+        "saved_at": time.time(),
+        "boot_id": boot_id(),
+        "state": state,
+        "script": script,
+        "pid": process.pid if process is not None else None,
+        "pid_start_ticks": process_start_ticks(process.pid) if process is not None else None,
+        "packet_number": packet_number,
+        "receive_time": receive_time,
+    }
+    temporary = f"{path}.tmp"
+    with open(temporary, "w") as f:
+        json.dump(snapshot, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temporary, path)
+
+
+def refresh_snapshot(path):
+    """Marks the snapshot at *path* as still current, without rewriting it"""
+    try:
+        os.utime(path)
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        logger.warning(f"Could not refresh snapshot {path}: {e}")
+
+
+def load_snapshot(path, max_age=MAX_AGE):
+    """The snapshot at *path* if there is a usable one, else None"""
+    try:
+        with open(path) as f:
+            refreshed_at = os.fstat(f.fileno()).st_mtime
+            snapshot = json.load(f)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        logger.warning(f"Ignoring unreadable snapshot {path}: {e}")
+        return None
+    if snapshot.get("format") != FORMAT_VERSION or snapshot.get("state") is None:
+        return None
+    age = time.time() - max(snapshot["saved_at"], refreshed_at)
+    if age > max_age:
+        logger.info(f"Ignoring snapshot {path}, it is {age:.0f} s old")
+        return None
+    return snapshot
+
+
+def adopt(snapshot):
+    """The snapshot's script as an :class:`AdoptedProcess` if it still runs, else None"""
+    pid, ticks = snapshot.get("pid"), snapshot.get("pid_start_ticks")
+    if pid is None or ticks is None or snapshot.get("boot_id") != boot_id():
+        return None
+    if process_start_ticks(pid) != ticks:
+        return None
+    return AdoptedProcess(pid, ticks)
+
+
+class Recovery(object):
+    """ What a restart took over from the snapshot and how long it took """
+
+    def __init__(self, snapshot, process, started_at):
+        self.snapshot = snapshot
+        self.state = snapshot["state"]
+        self.script = snapshot["script"]
+        self.process = process
+        self.mode = "adopted" if process is not None else "relaunched"
+        # Handler process start, script running again, first live packet
+        self.started_at = started_at
+        self.ready_at = time.time() if process is not None else None
+        self.confirmed_at = None
+        self.confirmed = None
+
+    def recovery_ms(self):
+        """Process start to the script running again"""
+        return (self.ready_at - self.started_at) * 1000 if self.ready_at is not None else None
+
+    def mark_ready(self, timestamp=None):
+        if self.ready_at is None:
+            self.ready_at = timestamp if timestamp is not None else time.time()
+            logger.info(f"Recovered {self.script} for state {self.state} ({self.mode}) "
+                        f"{self.recovery_ms():.1f} ms after process start")
+
+    def reconcile(self, state, timestamp):
+        """Compares the first live packet's state with the restored one, returns whether they match"""
+        if self.confirmed_at is not None:
+            return self.confirmed
+        self.confirmed_at = timestamp
+        self.confirmed = state == self.state
+        since_start = (timestamp - self.started_at) * 1000
+        if self.confirmed:
+            logger.info(f"First live packet confirms the restored state {state}, {since_start:.1f} ms after "
+                        f"process start")
+        else:
+            logger.warning(f"First live packet has state {state}, not the restored {self.state}, "
+                           f"{since_start:.1f} ms after process start")
+        return self.confirmed
+
+
+def restore(path, max_age=MAX_AGE):
+    """Reads the snapshot and adopts its script if possible, returns a :class:`Recovery` or None"""
+    started_at = process_started_at() or time.time()
+    snapshot = load_snapshot(path, max_age)
+    if snapshot is None:
+        return None
+    recovery = Recovery(snapshot, adopt(snapshot), started_at)
+    if recovery.process is not None:
+        logger.info(f"Adopted {recovery.script} (PID: {recovery.process.pid}) for state {recovery.state}, "
+                    f"{recovery.recovery_ms():.1f} ms after process start")
+    return recovery